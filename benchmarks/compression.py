@@ -0,0 +1,76 @@
+"""
+Benchmark of the compression of the extraction output (`MergeStore.save` and `load_entity_lines`) with each codec
+on a fixture of germplasm objects: CPU time to save and load the JSON file against the time to write and read it
+on a disk of a given throughput.
+
+Usage: python -m benchmarks.compression [number of objects] [disk throughput in MB/s]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from etl.common.compression import DEFAULT_COMPRESSION_LEVEL
+from etl.common.store import MergeStore, load_entity_lines, list_entity_files
+
+NB_OBJECTS = 100000
+# Throughput of a shared network disk
+DISK_THROUGHPUT = 100
+
+CODECS = [(None, None), ('gzip', 1), ('gzip', DEFAULT_COMPRESSION_LEVEL), ('bz2', DEFAULT_COMPRESSION_LEVEL),
+          ('lzma', 1)]
+
+
+def get_germplasm(i):
+    return {
+        'germplasmDbId': 'G' + str(i),
+        'germplasmName': 'Germplasm ' + str(i),
+        'accessionNumber': 'ACC-{:08d}'.format(i),
+        'genus': 'Populus',
+        'species': 'nigra',
+        'commonCropName': 'Poplar',
+        'instituteCode': 'FRA' + str(i % 50).zfill(3),
+        'synonyms': ['SYN-' + str(i), 'Alias ' + str(i * 7)],
+        'donors': [{'donorAccessionNumber': 'D' + str(i), 'donorInstituteCode': 'DEU' + str(i % 20).zfill(3)}],
+        'studyDbIds': sorted('S' + str(j) for j in range(i % 5)),
+    }
+
+
+def run(codec, level, nb_objects, output_dir):
+    store = MergeStore('BENCH', 'germplasm', compression=codec, compression_level=level)
+    for i in range(nb_objects):
+        store.add(get_germplasm(i))
+
+    start = time.perf_counter()
+    store.save(output_dir)
+    save_duration = time.perf_counter() - start
+
+    ((_, json_path),) = list_entity_files(output_dir)
+    start = time.perf_counter()
+    nb_lines = sum(1 for _ in load_entity_lines(('germplasm', json_path)))
+    load_duration = time.perf_counter() - start
+    assert nb_lines == nb_objects
+    size = os.path.getsize(json_path)
+    os.remove(json_path)
+    return size, save_duration, load_duration
+
+
+def main(nb_objects=NB_OBJECTS, disk_throughput=DISK_THROUGHPUT):
+    output_dir = tempfile.mkdtemp()
+    try:
+        print('{} objects, disk at {} MB/s (I/O time estimated from the file size):'.format(nb_objects,
+                                                                                        disk_throughput))
+        for (codec, level) in CODECS:
+            size, save_duration, load_duration = run(codec, level, nb_objects, output_dir)
+            io_duration = size / 1e6 / disk_throughput
+            print('{:>8} {:>4}: {:7.1f} MB, save {:5.2f}s, load {:5.2f}s, disk write+read {:5.2f}s, total {:5.2f}s'
+                  .format(codec or 'none', level or '', size / 1e6, save_duration, load_duration, 2 * io_duration,
+                          save_duration + load_duration + 2 * io_duration))
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else NB_OBJECTS,
+         float(sys.argv[2]) if len(sys.argv) > 2 else DISK_THROUGHPUT)
@@ -0,0 +1,89 @@
+"""
+Benchmark of the JSON backends (`etl.common.json_codec`) on each stage using JSON on a fixture of germplasm objects:
+decoding of list pages, saving of the extraction stores, conversion of JSON array dumps to JSON lines and loading of
+the transformation inputs.
+
+Usage: python -m benchmarks.json_codec [number of objects]
+"""
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.compression import get_germplasm
+from etl.common import json_codec
+from etl.common.json_stream import convert_json_file_to_lines
+from etl.common.store import MergeStore, load_entity_lines
+
+NB_OBJECTS = 100000
+PAGE_SIZE = 1000
+
+
+def decode_pages(objects, work_dir):
+    pages = [json.dumps({'metadata': {}, 'result': {'data': objects[start:start + PAGE_SIZE]}}).encode()
+             for start in range(0, len(objects), PAGE_SIZE)]
+    start = time.perf_counter()
+    for page in pages:
+        json_codec.loads(page)
+    return time.perf_counter() - start
+
+
+def save_store(objects, work_dir):
+    store = MergeStore('BENCH', 'germplasm')
+    for data in objects:
+        store.add(dict(data, studyDbIds=set(data['studyDbIds'])))
+    start = time.perf_counter()
+    store.save(work_dir)
+    return time.perf_counter() - start
+
+
+def convert_dump(objects, work_dir):
+    dump_path = os.path.join(work_dir, 'dump.json')
+    with open(dump_path, 'w') as dump_file:
+        json.dump(objects, dump_file)
+    start = time.perf_counter()
+    convert_json_file_to_lines(dump_path)
+    return time.perf_counter() - start
+
+
+def load_input(objects, work_dir):
+    json_path = os.path.join(work_dir, 'germplasm.json')
+    with open(json_path, 'w') as json_file:
+        for data in objects:
+            json_file.write(json.dumps(data) + '\n')
+    start = time.perf_counter()
+    for (_, line) in load_entity_lines(('germplasm', json_path)):
+        json_codec.loads(line)
+    return time.perf_counter() - start
+
+
+STAGES = [('extract: decode list pages', decode_pages), ('extract: save stores', save_store),
+          ('extract: convert dumps', convert_dump), ('transform: load inputs', load_input)]
+
+
+def main(nb_objects=NB_OBJECTS):
+    objects = [get_germplasm(i) for i in range(nb_objects)]
+    # Keep the garbage collector from scanning the fixture in the timings
+    gc.freeze()
+    backends = ['json'] + (['orjson'] if json_codec.orjson is not None else [])
+    work_dir = tempfile.mkdtemp()
+    print('{} objects ({}):'.format(nb_objects, ' vs '.join(backends)))
+    try:
+        for (stage, run) in STAGES:
+            durations = list()
+            for backend in backends:
+                json_codec.set_backend(backend)
+                durations.append(run(objects, work_dir))
+            print('{:>28}: {}{}'.format(stage, ', '.join('{:.2f}s'.format(duration) for duration in durations),
+                                        ' ({:.1f}x faster)'.format(durations[0] / durations[-1])
+                                        if len(durations) > 1 else ''))
+    finally:
+        json_codec.set_backend()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else NB_OBJECTS)
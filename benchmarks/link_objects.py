@@ -0,0 +1,55 @@
+"""
+Micro-benchmark of the linking of BrAPI objects (`etl.extract.brapi.link_objects`) on a fixture where one study is
+linked to 10k germplasm and 10k studies are linked to the same germplasm.
+
+Usage: python -m benchmarks.link_objects [number of objects]
+"""
+import sys
+import time
+
+from etl.common.store import MergeStore
+from etl.common.utils import remove_empty
+import etl.extract.brapi
+
+NB_OBJECTS = 10000
+
+
+def legacy_link_object(dest_entity_name, dest_object, src_object_id):
+    # Previous implementation: the link set is rebuilt for each link
+    dest_object_ref = dest_entity_name + 'DbIds'
+    dest_object_ids = dest_object.get(dest_object_ref) or set()
+    if not isinstance(dest_object_ids, set):
+        dest_object_ids = set(dest_object_ids)
+    dest_object_ids.add(src_object_id)
+    dest_object[dest_object_ref] = remove_empty(dest_object_ids)
+
+
+def run(nb_objects=NB_OBJECTS):
+    study = {'name': 'study', 'store': MergeStore('BENCH', 'study')}
+    germplasm = {'name': 'germplasm', 'store': MergeStore('BENCH', 'germplasm')}
+    germplasm_by_id = {'G' + str(i): {'germplasmDbId': 'G' + str(i)} for i in range(nb_objects)}
+
+    start = time.perf_counter()
+    # One study linked to every germplasm
+    etl.extract.brapi.link_objects(study, {'studyDbId': 'S0'}, germplasm, germplasm_by_id)
+    # Every study linked to one germplasm
+    for i in range(nb_objects):
+        etl.extract.brapi.link_objects(study, {'studyDbId': 'S' + str(i)}, germplasm,
+                                       {'G0': germplasm_by_id['G0']})
+    return time.perf_counter() - start
+
+
+def main(nb_objects=NB_OBJECTS):
+    link_object = etl.extract.brapi.link_object
+    etl.extract.brapi.link_object = legacy_link_object
+    try:
+        legacy_duration = run(nb_objects)
+    finally:
+        etl.extract.brapi.link_object = link_object
+    duration = run(nb_objects)
+    print('{}x{} links: {:.2f}s (previously {:.2f}s, {:.0f}x faster)'.format(
+        nb_objects, nb_objects, duration, legacy_duration, legacy_duration / duration))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else NB_OBJECTS)
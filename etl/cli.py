@@ -27,6 +27,17 @@ def parse_cli_arguments(config):
     # Extract
     parser_extract = add_sub_parser(config, parser_actions, 'extract', help_message='Extract data from BrAPI endpoints')
     parser_extract.set_defaults(extract=True)
+    parser_extract.add_argument('--async', dest='async_extract', action='store_true',
+                                help='Use the asyncio extraction engine (the calls of all sources run as coroutines '
+                                     'on one event loop with non-blocking HTTP requests)')
+    parser_extract.add_argument('--http-cache', action='store_true',
+                                help='Reuse HTTP responses cached in the data dir by previous extractions '
+                                     '(revalidated with ETag/Last-Modified or reused within the cache TTL)')
+    parser_extract.add_argument('--resume', action='store_true',
+                                help='Resume failed extractions from their journal instead of starting from scratch')
+    parser_extract.add_argument('--refresh-calls', action='store_true',
+                                help='Fetch the calls implemented by BrAPI endpoints even if they were cached by a '
+                                     'previous extraction')
 
     # Transform
     parser_transform = parser_actions.add_parser('transform', aliases=['trans'], help='Transform BrAPI data')
@@ -0,0 +1,264 @@
+"""
+Minimal non-blocking HTTP/1.1 client built on asyncio streams (used by the asyncio extraction engine, see
+`etl.extract.brapi_async`).
+Connections are kept alive and pooled by server. Response bodies are read entirely (delimited by their
+Content-Length, chunked or read until the connection is closed) and decoded (gzip or deflate).
+Connection errors and timeouts raise the `requests` exceptions so that callers handle them as with a
+`requests.Session`. As with the `verify=False` requests of the extraction, HTTPS certificates are not verified.
+"""
+import asyncio
+import collections
+import ssl
+import urllib.parse
+import zlib
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from etl.common import json_codec
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (10, 300)
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class AsyncResponse(object):
+    """
+    HTTP response read by `AsyncHTTPClient` (with the attributes of a `requests.Response` used by the ETL)
+    """
+
+    def __init__(self, url, status_code, headers, content, wire_bytes=0):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        # Number of body bytes received (before decoding)
+        self.wire_bytes = wire_bytes
+        self.encoding = 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    def json(self):
+        return json_codec.loads(self.content)
+
+    def close(self):
+        pass
+
+
+class _StaleConnection(Exception):
+    """
+    A pooled connection was closed by the server before answering
+    """
+
+
+class AsyncHTTPClient(object):
+    """
+    Send HTTP requests from coroutines, keeping at most `pool_size` idle connections by server.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        # Idle (reader, writer) connections by (scheme, host, port)
+        self.connections = collections.defaultdict(list)
+        self.stats = {'requests': 0, 'connections': 0}
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    async def request(self, method, url, params=None, data=None, json=None, headers=None, timeout=None):
+        """
+        Send a request and read its response (`params` are added to the URL query, `json` is sent as a JSON body)
+        """
+        connect_timeout, read_timeout = timeout or self.timeout
+        if params:
+            url = url + ('&' if '?' in url else '?') + urllib.parse.urlencode(params, doseq=True)
+        parsed_url = urllib.parse.urlsplit(url)
+        if parsed_url.scheme not in ('http', 'https'):
+            raise requests.exceptions.InvalidSchema("No connection adapters were found for '{}'".format(url))
+        port = parsed_url.port or (443 if parsed_url.scheme == 'https' else 80)
+        server = (parsed_url.scheme, parsed_url.hostname, port)
+
+        request_headers = CaseInsensitiveDict({
+            'Host': parsed_url.netloc,
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        request_headers.update(headers or {})
+        if json is not None:
+            data = json_codec.dumps(json)
+            request_headers.setdefault('Content-Type', 'application/json')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if data is not None or method in ('POST', 'PUT', 'PATCH'):
+            request_headers['Content-Length'] = str(len(data or b''))
+        target = urllib.parse.urlunsplit(('', '', parsed_url.path or '/', parsed_url.query, ''))
+        head = '{} {} HTTP/1.1\r\n'.format(method, target) + \
+            ''.join('{}: {}\r\n'.format(name, value) for (name, value) in request_headers.items()) + '\r\n'
+        message = head.encode('latin-1') + (data or b'')
+
+        while True:
+            connection = self._get_idle_connection(server)
+            reused = connection is not None
+            if not reused:
+                connection = await self._connect(server, connect_timeout)
+            try:
+                response, keep_alive = await self._exchange(connection, message, method, url, read_timeout)
+            except _StaleConnection:
+                connection[1].close()
+                if reused:
+                    continue
+                raise requests.ConnectionError('Connection closed by {} without response'.format(parsed_url.netloc))
+            except asyncio.TimeoutError:
+                connection[1].close()
+                raise requests.ReadTimeout('Read timed out ({}s) for {}'.format(read_timeout, url))
+            except requests.RequestException:
+                connection[1].close()
+                raise
+            except (OSError, asyncio.IncompleteReadError, ValueError) as error:
+                connection[1].close()
+                if reused and isinstance(error, (ConnectionResetError, BrokenPipeError)):
+                    continue
+                raise requests.ConnectionError('Connection error for {}: {!r}'.format(url, error))
+            except BaseException:
+                # Cancelled while the response was read
+                connection[1].close()
+                raise
+            self.stats['requests'] += 1
+            if keep_alive:
+                self._release_connection(server, connection)
+            else:
+                connection[1].close()
+            return response
+
+    def _get_idle_connection(self, server):
+        idle_connections = self.connections[server]
+        while idle_connections:
+            reader, writer = idle_connections.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _release_connection(self, server, connection):
+        if len(self.connections[server]) < self.pool_size:
+            self.connections[server].append(connection)
+        else:
+            connection[1].close()
+
+    async def _connect(self, server, connect_timeout):
+        scheme, host, port = server
+        try:
+            connection = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=self.ssl_context if scheme == 'https' else None),
+                connect_timeout)
+        except asyncio.TimeoutError:
+            raise requests.ConnectTimeout('Connection to {}:{} timed out ({}s)'.format(host, port, connect_timeout))
+        except OSError as error:
+            raise requests.ConnectionError('Could not connect to {}:{}: {!r}'.format(host, port, error))
+        self.stats['connections'] += 1
+        return connection
+
+    async def _exchange(self, connection, message, method, url, read_timeout):
+        reader, writer = connection
+        writer.write(message)
+        await asyncio.wait_for(writer.drain(), read_timeout)
+
+        status_line = await asyncio.wait_for(reader.readline(), read_timeout)
+        if not status_line:
+            raise _StaleConnection()
+        version, status_code, headers = await self._read_head(reader, status_line, read_timeout)
+        # Skip informational responses (ex: 100 Continue)
+        while 100 <= status_code < 200:
+            status_line = await asyncio.wait_for(reader.readline(), read_timeout)
+            version, status_code, headers = await self._read_head(reader, status_line, read_timeout)
+
+        keep_alive = version == 'HTTP/1.1' and headers.get('Connection', '').lower() != 'close'
+        if method == 'HEAD' or status_code in (204, 304):
+            body = b''
+        elif 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            body = await self._read_chunked(reader, read_timeout)
+        elif 'Content-Length' in headers:
+            body = await self._read_exactly(reader, int(headers['Content-Length']), read_timeout)
+        else:
+            # Body delimited by the end of the connection
+            body = await self._read_until_eof(reader, read_timeout)
+            keep_alive = False
+        return AsyncResponse(url, status_code, headers, decode_content(body, headers), len(body)), keep_alive
+
+    @staticmethod
+    async def _read_head(reader, status_line, read_timeout):
+        version, status_code = status_line.decode('latin-1').split(None, 2)[:2]
+        headers = CaseInsensitiveDict()
+        while True:
+            line = await asyncio.wait_for(reader.readline(), read_timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            name, value = name.strip(), value.strip()
+            # Repeated headers are joined (as by requests)
+            headers[name] = headers[name] + ', ' + value if name in headers else value
+        return version, int(status_code), headers
+
+    @staticmethod
+    async def _read_exactly(reader, size, read_timeout):
+        chunks = list()
+        while size > 0:
+            chunk = await asyncio.wait_for(reader.read(min(size, READ_CHUNK_SIZE)), read_timeout)
+            if not chunk:
+                raise asyncio.IncompleteReadError(b''.join(chunks), size)
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    @staticmethod
+    async def _read_until_eof(reader, read_timeout):
+        chunks = list()
+        while True:
+            chunk = await asyncio.wait_for(reader.read(READ_CHUNK_SIZE), read_timeout)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    async def _read_chunked(self, reader, read_timeout):
+        chunks = list()
+        while True:
+            size_line = await asyncio.wait_for(reader.readline(), read_timeout)
+            if not size_line:
+                raise asyncio.IncompleteReadError(b''.join(chunks), None)
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                break
+            chunks.append(await self._read_exactly(reader, size, read_timeout))
+            await asyncio.wait_for(reader.readline(), read_timeout)
+        # Skip the trailer headers
+        while await asyncio.wait_for(reader.readline(), read_timeout) not in (b'\r\n', b'\n', b''):
+            pass
+        return b''.join(chunks)
+
+    def close(self):
+        for idle_connections in self.connections.values():
+            for (_, writer) in idle_connections:
+                writer.close()
+        self.connections.clear()
+
+
+def decode_content(body, headers):
+    """
+    Decode a response body according to its Content-Encoding (gzip or deflate)
+    """
+    encoding = headers.get('Content-Encoding', '').lower()
+    if not body or encoding not in ('gzip', 'deflate'):
+        return body
+    try:
+        if encoding == 'gzip':
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # Raw deflate stream (without zlib header)
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    except zlib.error as error:
+        raise requests.exceptions.ContentDecodingError('Could not decode {} response: {}'.format(encoding, error))
@@ -1,31 +1,375 @@
 import itertools
 import json
+import queue
 import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from functools import partial
 from itertools import chain
+from multiprocessing.pool import ThreadPool
 from typing import Tuple, List
 import requests
+from json.encoder import encode_basestring_ascii as _encode_json_string
+from requests.adapters import HTTPAdapter
 
+from etl.common.concurrency import OVERLOAD_STATUSES, LatencyTracker, get_retry_delay
+from etl.common import json_codec
+from etl.common.json_stream import JSONArrayStreamParser
 from etl.common.utils import join_url_path, remove_falsey, replace_template, remove_none, is_collection
 from pyhashxx import hashxx
 
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_MAX_RETRY_DELAY = 60
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_MIN_PAGE_SIZE = 50
+DEFAULT_MAX_PAGE_SIZE = 5000
+DEFAULT_PAGE_SIZE_ERROR_TTL = 7 * 24 * 3600
+STREAM_CHUNK_SIZE = 64 * 1024
+# Objects parsed from streamed pages fetched concurrently and not consumed yet
+STREAM_QUEUE_SIZE = 10000
+DEFAULT_SEARCH_PAGE_SIZE = 1000
+DEFAULT_SEARCH_POLL_INTERVAL = 1
+DEFAULT_SEARCH_MAX_WAIT = 300
+
+
+class BrapiSession(requests.Session):
+    """
+    HTTP session shared by every call made to one BrAPI source.
+    Connections are pooled (pool size should match the number of worker threads) and kept alive between calls.
+    Requests are retried when the server is overloaded or unreachable and, with a `limiter`
+    (see `etl.common.concurrency.AdaptiveLimiter`), the number of requests in flight adapts to the server capacity.
+    With a `budget` (see `etl.common.concurrency.RequestBudget`) shared by the sessions of several sources, their
+    requests in flight are also bounded globally and per server.
+
+    The latency of each endpoint is tracked. With a `hedge_percentile`, a GET request still waiting for its response
+    after this percentile of its endpoint latency is sent a second time and the first response received is used
+    (if the limiter and the budget have room for this duplicate request).
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, cache=None, limiter=None, max_retries=DEFAULT_MAX_RETRIES,
+                 retry_base_delay=1.0, max_retry_delay=DEFAULT_MAX_RETRY_DELAY,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+                 hedge_percentile=None, hedge_min_samples=20, max_hedge_ratio=0.1, page_size_tuner=None,
+                 budget=None):
+        super(BrapiSession, self).__init__()
+        self.pool_size = pool_size
+        self.cache = cache
+        self.limiter = limiter
+        self.budget = budget
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.max_retry_delay = max_retry_delay
+        self.retry_count = 0
+        self.timeout = timeout
+        self.latency = LatencyTracker()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.max_hedge_ratio = max_hedge_ratio
+        self.hedge_stats = {'sent': 0, 'won': 0}
+        self.hedge_executor = ThreadPoolExecutor(pool_size) if hedge_percentile else None
+        self.transfer_stats = dict()
+        self.page_size_tuner = page_size_tuner
+        self.lock = threading.Lock()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.headers['Connection'] = 'keep-alive'
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.verify = False
+
+    def request(self, method, url, params=None, data=None, headers=None, endpoint=None, group=None, **kwargs):
+        """
+        Send a request, using the response cache (if any) to avoid downloading unchanged responses.
+        The `endpoint` (ex: 'GET studies/{studyDbId}') groups requests for latency tracking and the call `group`
+        (ex: 'list', 'detail' or 'link') groups requests for transfer accounting.
+        The transfer of streamed responses (`stream=True`) must be counted by the caller once the content is read.
+        """
+        kwargs['endpoint'] = endpoint
+        if not self.cache:
+            response = self._send(method, url, params=params, data=data, headers=headers, **kwargs)
+            if not kwargs.get('stream'):
+                self.count_transfer(group, response)
+            return response
+
+        cache_key = self.cache.get_key(method, url, params or data or kwargs.get('json'))
+        entry = self.cache.get(cache_key)
+        if entry and self.cache.is_fresh(entry):
+            self.cache.count('hit')
+            return self.cache.to_response(entry)
+
+        headers = dict(headers or {})
+        if entry:
+            headers.update(self.cache.get_conditional_headers(entry))
+        # Cached responses are read entirely (no streaming)
+        kwargs.pop('stream', None)
+        response = self._send(method, url, params=params, data=data, headers=headers, **kwargs)
+        self.count_transfer(group, response)
+        if entry and response.status_code == 304:
+            self.cache.count('revalidated')
+            return self.cache.to_response(entry)
+
+        self.cache.count('miss')
+        if response.status_code == 200:
+            self.cache.put(cache_key, response)
+        return response
+
+    def _send(self, method, url, endpoint=None, **kwargs):
+        """
+        Send a request, retrying at most `max_retries` times if the server is overloaded or unreachable
+        (after the delay given by the server 'Retry-After' header or an exponential backoff)
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        host = urllib.parse.urlparse(url).netloc
+        attempt = 0
+        while True:
+            if self.limiter:
+                self.limiter.acquire()
+            if self.budget:
+                self.budget.acquire(host)
+            start = time.perf_counter()
+            try:
+                response = self._hedged_request(method, url, endpoint, host, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._release(host, overloaded=True, endpoint=endpoint)
+                if attempt >= self.max_retries:
+                    raise
+                delay = get_retry_delay(attempt, None, self.retry_base_delay, self.max_retry_delay)
+            except BaseException:
+                self._release(host, endpoint=endpoint)
+                raise
+            else:
+                latency = time.perf_counter() - start
+                overloaded = response.status_code in OVERLOAD_STATUSES
+                self._release(host, latency, overloaded, endpoint)
+                if endpoint and not overloaded:
+                    self.latency.record(endpoint, latency)
+                if not overloaded or attempt >= self.max_retries:
+                    return response
+                delay = get_retry_delay(attempt, response.headers.get('Retry-After'),
+                                        self.retry_base_delay, self.max_retry_delay)
+                response.close()
+
+            attempt += 1
+            with self.lock:
+                self.retry_count += 1
+            time.sleep(delay)
+
+    def _get_hedge_delay(self, method, endpoint):
+        """
+        Delay after which a hedged request should be sent (None if the request should not be hedged)
+        """
+        if not self.hedge_executor or method != 'GET' or not endpoint:
+            return None
+        nb_requests = self.latency.count(endpoint)
+        if nb_requests < self.hedge_min_samples:
+            return None
+        with self.lock:
+            if self.hedge_stats['sent'] >= self.max_hedge_ratio * sum(self.latency.counts.values()):
+                return None
+        return self.latency.percentile(endpoint, self.hedge_percentile)
+
+    def _hedged_request(self, method, url, endpoint, host, **kwargs):
+        send = partial(super(BrapiSession, self).request, method, url, **kwargs)
+        hedge_delay = self._get_hedge_delay(method, endpoint)
+        if hedge_delay is None:
+            return send()
+
+        # The hedge delay runs from the time the primary request is actually sent (not queued in the executor)
+        sent = threading.Event()
+
+        def send_primary():
+            sent.set()
+            return send()
+
+        primary = self.hedge_executor.submit(send_primary)
+        sent.wait()
+        done, _ = wait([primary], timeout=hedge_delay)
+        if done:
+            return primary.result()
+
+        # The duplicate request is a request in flight like any other (within the budget and the limiter)
+        if self.budget and not self.budget.acquire(host, blocking=False):
+            return primary.result()
+        if self.limiter and not self.limiter.acquire(blocking=False):
+            if self.budget:
+                self.budget.release(host)
+            return primary.result()
+        with self.lock:
+            self.hedge_stats['sent'] += 1
+        hedge = self.hedge_executor.submit(send)
+        hedge.add_done_callback(partial(self._release_hedge, host, endpoint))
+        done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+        first = primary if primary in done else hedge
+        other = hedge if first is primary else primary
+        if first.exception() is not None:
+            # Use the other request if the first to answer failed
+            first, other = other, first
+        if first is hedge:
+            with self.lock:
+                self.hedge_stats['won'] += 1
+        other.add_done_callback(lambda future: future.exception() or future.result().close())
+        return first.result()
+
+    def _release_hedge(self, host, endpoint, hedge):
+        error = hedge.exception()
+        overloaded = isinstance(error, (requests.ConnectionError, requests.Timeout)) or \
+            (error is None and hedge.result().status_code in OVERLOAD_STATUSES)
+        self._release(host, overloaded=overloaded, endpoint=endpoint)
+
+    def close(self):
+        super(BrapiSession, self).close()
+        if self.hedge_executor:
+            self.hedge_executor.shutdown(wait=False)
+
+    def _release(self, host, latency=None, overloaded=False, endpoint=None):
+        if self.budget:
+            self.budget.release(host)
+        if self.limiter:
+            self.limiter.release(latency, overloaded, endpoint)
+
+    def count_transfer(self, group, response, decoded_bytes=None):
+        """
+        Count bytes received on the wire (compressed) and decoded for a call group
+        """
+        wire_bytes = response.raw.tell() if response.raw is not None else 0
+        if decoded_bytes is None:
+            decoded_bytes = len(response.content)
+        with self.lock:
+            stats = self.transfer_stats.setdefault(group or 'other', {'requests': 0, 'wire': 0, 'decoded': 0})
+            stats['requests'] += 1
+            stats['wire'] += wire_bytes
+            stats['decoded'] += decoded_bytes
+
+    def get_connection_stats(self):
+        """
+        Count requests sent and connections opened by the session connection pools
+        """
+        nb_requests, nb_connections = 0, 0
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                nb_requests += pool.num_requests
+                nb_connections += pool.num_connections
+        return {'requests': nb_requests, 'connections': nb_connections,
+                'reused': max(nb_requests - nb_connections, 0)}
+
+
+class PageSizeTuner(object):
+    """
+    Learn the page size of each paginated endpoint (ex: 'GET studies/{studyDbId}/germplasm'):
+     - use the page size actually honoured by the server (in metadata.pagination.pageSize) when it is lower,
+     - double it while the latency per item of full pages improves on the best one seen so far,
+     - halve it on server errors or timeouts (without growing it back to the failed page size for `error_ttl`
+       seconds).
+    An endpoint is settled (its page size no longer changes) once bigger pages stop improving the latency per item.
+    The learned state (`get_state`: page sizes, best page size and latency per item, settled endpoints and failed
+    page sizes) can be persisted from one extraction to the next so that each extraction only grows the page sizes
+    against the baseline of the previous ones.
+    """
+
+    def __init__(self, state=None, min_size=DEFAULT_MIN_PAGE_SIZE, max_size=DEFAULT_MAX_PAGE_SIZE,
+                 error_ttl=DEFAULT_PAGE_SIZE_ERROR_TTL):
+        state = state or {}
+        self.sizes = dict(state.get('sizes') or {})
+        self.min_size = min_size
+        self.max_size = max_size
+        self.error_ttl = error_ttl
+        self.best = {endpoint: tuple(best) for (endpoint, best) in (state.get('best') or {}).items()}
+        self.settled = set(state.get('settled') or [])
+        # Page size and time of the last error by endpoint
+        self.errors = {endpoint: tuple(error) for (endpoint, error) in (state.get('errors') or {}).items()
+                       if error[1] + error_ttl > time.time()}
+        self.lock = threading.Lock()
+
+    def get_state(self):
+        with self.lock:
+            return {'sizes': dict(self.sizes), 'best': {endpoint: list(best) for (endpoint, best) in self.best.items()},
+                    'settled': sorted(self.settled),
+                    'errors': {endpoint: list(error) for (endpoint, error) in self.errors.items()}}
+
+    def get_page_size(self, endpoint, default):
+        with self.lock:
+            return self.sizes.get(endpoint, default)
+
+    def record_page(self, endpoint, page_size, honoured_page_size, nb_items, latency):
+        with self.lock:
+            if honoured_page_size and honoured_page_size < page_size:
+                # The server silently caps the page size
+                self.sizes[endpoint] = honoured_page_size
+                self.settled.add(endpoint)
+                return
+            if endpoint in self.settled or nb_items < page_size or nb_items == 0:
+                return
+
+            item_latency = latency / nb_items
+            best_size, best_item_latency = self.best.get(endpoint, (None, None))
+            if best_item_latency is None or item_latency < best_item_latency * 0.9:
+                self.best[endpoint] = (page_size, item_latency)
+                grown_size = min(page_size * 2, self.max_size)
+                if grown_size <= page_size:
+                    # Maximum page size reached
+                    self.settled.add(endpoint)
+                elif self._can_grow(endpoint, grown_size):
+                    self.sizes[endpoint] = grown_size
+            elif page_size > best_size:
+                # Bigger pages no longer improve the latency per item
+                self.sizes[endpoint] = best_size
+                self.settled.add(endpoint)
+
+    def _can_grow(self, endpoint, page_size):
+        error_size, error_time = self.errors.get(endpoint, (None, None))
+        if error_size is None or error_time + self.error_ttl <= time.time():
+            return True
+        return page_size < error_size
+
+    def record_error(self, endpoint, page_size):
+        with self.lock:
+            self.sizes[endpoint] = max(page_size // 2, self.min_size)
+            self.best.pop(endpoint, None)
+            self.errors[endpoint] = (page_size, time.time())
+
+
+# End of a streamed page (see `BreedingAPIIterator.fetch_pages`)
+_PAGE_END = object()
+
+
 class BreedingAPIIterator:
     """
     Iterate through BraPI result pages.
     If no pagination is required, the first and only page will contain the one BrAPI object.
+    With `stream`, the objects of a page are parsed incrementally while its response is read
+    (each page is then an iterator of BrAPI objects instead of a list).
     """
 
-    def __init__(self, brapi_url, call, logger=None):
+    def __init__(self, brapi_url, call, logger=None, session=None, journal=None, group=None, stream=False):
         self.page = 0
-        self.page_size = None
-        self.is_paginated = 'page-size' in call
-        if self.is_paginated:
-            self.page_size = call['page-size']
         self.total_pages = 1
         self.brapi_url = brapi_url
         self.call = call.copy()
         self.logger = logger
+        self.session = session
+        self.journal = journal
+        self.group = group
+        self.call_key = json.dumps([self.call['method'], self.call['path'], self.call.get('param')])
+        self.endpoint = self.call.get('endpoint') or get_call_id(self.call)
+        self.tuner = session.page_size_tuner if session else None
+
+        self.page_size = None
+        self.is_paginated = 'page-size' in call
+        self.stream = stream and self.is_paginated
+        if self.is_paginated:
+            # Keep the page size of a resumed extraction, otherwise use the learned page size
+            self.page_size = self.journal and self.journal.get_page_size(self.call_key)
+            if not self.page_size:
+                self.page_size = call['page-size']
+                if self.tuner:
+                    self.page_size = self.tuner.get_page_size(self.endpoint, self.page_size)
 
     # Py3-style iterator interface
     def __next__(self):
@@ -38,26 +382,142 @@ class BreedingAPIIterator:
         if self.page >= self.total_pages:
             raise StopIteration
 
-        return self.__fetch_page()
-
-    def __fetch_page(self):
+        data = self.__fetch_page(self.page)
+        self.page += 1
+        return data
+
+    def start_from(self, content):
+        """
+        Use the content of a first page fetched by other means (ex: the answer of a search call) and return its
+        objects, the iteration going on from the next page
+        """
+        pagination = (content.get('metadata') or {}).get('pagination') or {}
+        self.total_pages = max(pagination.get('totalPages') or 1, 1)
+        self.page = 1
+        return content['result']['data']
+
+    def fetch_pages(self, concurrency=1, ordered=True):
+        """
+        Iterate through result pages.
+        Once the first page gave the total number of pages, the remaining pages are fetched concurrently
+        (at most `concurrency` pages in flight) and yielded in page order or as soon as they arrive.
+        Streamed pages (see `stream`) are fetched concurrently only when unordered: the objects of the remaining pages
+        are then yielded as one page as soon as they are parsed.
+        """
+        yield self.next()
+        remaining_pages = range(self.page, self.total_pages)
+        if concurrency <= 1 or len(remaining_pages) <= 1 or (self.stream and ordered):
+            yield from self
+            return
+
+        if self.stream:
+            yield self.__stream_pages(remaining_pages, concurrency)
+            return
+
+        pool = ThreadPool(min(concurrency, len(remaining_pages)))
+        try:
+            fetch_pages = pool.imap if ordered else pool.imap_unordered
+            yield from fetch_pages(self.__fetch_page, remaining_pages)
+            self.page = self.total_pages
+        finally:
+            pool.terminate()
+
+    def __stream_pages(self, pages, concurrency):
+        """
+        Iterate through the objects of streamed pages fetched concurrently (in the order they are parsed)
+        """
+        items = queue.Queue(STREAM_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        def put(entry):
+            # Give up if the objects are no longer consumed
+            while not stopped.is_set():
+                try:
+                    items.put(entry, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def stream_page(page):
+            try:
+                page_items = iter(self.__fetch_page(page))
+                try:
+                    for item in page_items:
+                        if stopped.is_set():
+                            return
+                        put((True, item))
+                finally:
+                    if hasattr(page_items, 'close'):
+                        page_items.close()
+            except BaseException as error:
+                put((False, error))
+            put((True, _PAGE_END))
+
+        pool = ThreadPool(min(concurrency, len(pages)))
+        try:
+            pool.map_async(stream_page, pages)
+            nb_pages_done = 0
+            while nb_pages_done < len(pages):
+                success, item = items.get()
+                if not success:
+                    raise item
+                if item is _PAGE_END:
+                    nb_pages_done += 1
+                else:
+                    yield item
+            self.page = self.total_pages
+        finally:
+            stopped.set()
+            pool.terminate()
+
+    def __fetch_page(self, page):
+        if self.journal:
+            journal_page = self.journal.get_page(self.call_key, page)
+            if journal_page:
+                self.total_pages, data = journal_page
+                return data
+
+        if self.stream:
+            return self.__fetch_page_stream(page)
+
+        data = self.__fetch_page_content(page)
+        if self.journal and self.is_paginated:
+            self.journal.record_page(self.call_key, page, self.page_size, self.total_pages, data)
+        return data
+
+    def __send(self, page, stream=False):
         url = join_url_path(self.brapi_url, self.call['path'])
         headers = {'Accept': 'application/json, application/ld+json'}
         params = {}
         if self.is_paginated:
-            params = {'page': self.page, 'pageSize': self.page_size}
+            params = {'page': page, 'pageSize': self.page_size}
         if 'param' in self.call:
             params.update(self.call['param'])
         params_json = json.dumps(params)
 
         if self.logger:
             self.logger.debug('Fetching {} {} {}'.format(self.call['method'], url.encode('utf-8'), params_json))
+        http = self.session or requests
+        if self.session:
+            session_args = {'endpoint': self.endpoint, 'group': self.group}
+        else:
+            session_args = {'timeout': (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)}
         response = None
-        if self.call['method'] == 'GET':
-            response = requests.get(url, params=params, headers=headers, verify=False)
-        elif self.call['method'] == 'POST':
-            headers['Content-type'] = 'application/json'
-            response = requests.post(url, data=params_json, headers=headers, verify=False)
+        try:
+            if self.call['method'] == 'GET':
+                response = http.get(url, params=params, headers=headers, verify=False, stream=stream,
+                                    **session_args)
+            elif self.call['method'] == 'POST':
+                headers['Content-type'] = 'application/json'
+                response = http.post(url, data=params_json, headers=headers, verify=False, stream=stream,
+                                     **session_args)
+        except requests.RequestException:
+            if self.tuner and self.is_paginated:
+                self.tuner.record_error(self.endpoint, self.page_size)
+            raise
+
+        if self.tuner and self.is_paginated and response.status_code >= 500:
+            self.tuner.record_error(self.endpoint, self.page_size)
 
         if response.status_code != 200:
             try:
@@ -66,40 +526,245 @@ class BreedingAPIIterator:
                 message = str(response.content)
             self.total_pages = -1
             raise BrapiServerError(message)
+        return response
 
-        content = response.json()
+    def __record_pagination(self, pagination, nb_items, latency):
+        self.total_pages = max(pagination['totalPages'], 1)
+        if self.tuner:
+            self.tuner.record_page(self.endpoint, self.page_size, pagination.get('pageSize'), nb_items, latency)
 
-        if self.is_paginated:
-            self.total_pages = max(content['metadata']['pagination']['totalPages'], 1)
-            self.page += 1
-        else:
-            self.total_pages = -1
+    def __fetch_page_content(self, page):
+        start = time.perf_counter()
+        response = self.__send(page)
+        latency = time.perf_counter() - start
+        content = json_codec.loads(response.content)
 
         if self.is_paginated:
+            self.__record_pagination(content['metadata']['pagination'], len(content['result']['data']), latency)
             return content['result']['data']
         else:
+            self.total_pages = -1
             return [content['result']]
 
+    def __fetch_page_stream(self, page):
+        """
+        Iterate through the objects of a page while its response is read
+        """
+        start = time.perf_counter()
+        response = self.__send(page, stream=True)
+        parser = JSONArrayStreamParser(['result', 'data'])
+        data = list() if self.journal else None
+        nb_items, decoded_bytes = 0, 0
+        try:
+            for chunk in itertools.chain(response.iter_content(STREAM_CHUNK_SIZE), [None]):
+                if chunk is None:
+                    items = parser.close()
+                else:
+                    decoded_bytes += len(chunk)
+                    items = parser.feed(chunk)
+                for item in items:
+                    nb_items += 1
+                    if data is not None:
+                        data.append(item)
+                    yield item
+        finally:
+            response.close()
+        latency = time.perf_counter() - start
+
+        if self.session and not self.session.cache:
+            # Responses are read entirely (and counted) by the session when cached
+            self.session.count_transfer(self.group, response, decoded_bytes)
+        self.__record_pagination(parser.document['metadata']['pagination'], nb_items, latency)
+        if data is not None:
+            self.journal.record_page(self.call_key, page, self.page_size, self.total_pages, data)
+
     @staticmethod
-    def fetch_all(brapi_url, call, logger=None):
-        """Iterate through all BrAPI objects for given call (does pagination automatically if needed)"""
-        return chain.from_iterable(BreedingAPIIterator(brapi_url, call, logger))
+    def fetch_all(brapi_url, call, logger=None, session=None, concurrency=1, ordered=True, journal=None, group=None,
+                  stream=False):
+        """
+        Iterate through all BrAPI objects for given call (does pagination automatically if needed).
+        With `concurrency` > 1, pages after the first one are fetched concurrently (see `fetch_pages`).
+        With a `journal`, pages already fetched by a previous extraction are read from it and new pages are recorded.
+        With `stream`, objects are parsed and yielded while the responses are read.
+        """
+        iterator = BreedingAPIIterator(brapi_url, call, logger, session, journal, group, stream)
+        return chain.from_iterable(iterator.fetch_pages(concurrency, ordered))
 
 
 class BrapiServerError(Exception):
     pass
 
 
+def fetch_search_results(brapi_url, call, logger=None, session=None, group=None,
+                         poll_interval=DEFAULT_SEARCH_POLL_INTERVAL, max_wait=DEFAULT_SEARCH_MAX_WAIT):
+    """
+    Iterate through the BrAPI objects found by a search call (ex: POST /brapi/v1/germplasm-search with
+    the search parameters in the call 'param').
+    With "async-search" (BrAPI v2 POST /search/{entity}), the server can answer a `searchResultsDbId`: the results
+    are then polled every `poll_interval` seconds (for at most `max_wait` seconds) with
+    GET /search/{entity}/{searchResultsDbId} until available.
+    """
+    call = dict(call)
+    call.setdefault('page-size', DEFAULT_SEARCH_PAGE_SIZE)
+    if not call.get('async-search'):
+        return BreedingAPIIterator.fetch_all(brapi_url, call, logger, session, group=group)
+
+    http = session or requests
+    headers = {'Accept': 'application/json, application/ld+json'}
+    results_endpoint = 'GET ' + call['path'] + '/{searchResultsDbId}'
+    if session:
+        search_args = {'endpoint': call.get('endpoint') or get_call_id(call), 'group': group}
+        results_args = {'endpoint': results_endpoint, 'group': group}
+    else:
+        search_args = results_args = {'timeout': (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)}
+
+    url = join_url_path(brapi_url, call['path'])
+    if logger:
+        logger.debug('Searching POST {} {}'.format(url.encode('utf-8'), json.dumps(call.get('param'))))
+    # Ask for the first page so that results answered directly can be used as is
+    page_params = {'page': 0, 'pageSize': call['page-size']}
+    response = http.post(url, json=dict(page_params, **(call.get('param') or {})), headers=headers, verify=False,
+                         **search_args)
+    if response.status_code not in (200, 202):
+        raise BrapiServerError(str(response.content))
+    content = json_codec.loads(response.content)
+    search_results_id = (content.get('result') or {}).get('searchResultsDbId')
+    if not search_results_id:
+        # Results answered directly (by pages)
+        return _iter_search_results(brapi_url, dict(call, **{'async-search': False}), content, logger, session,
+                                    group)
+
+    results_call = {'method': 'GET', 'path': call['path'] + '/' + search_results_id, 'page-size': call['page-size'],
+                    'endpoint': results_endpoint}
+    results_url = join_url_path(brapi_url, results_call['path'])
+    deadline = time.monotonic() + max_wait
+    while True:
+        response = http.get(results_url, params=page_params, headers=headers, verify=False, **results_args)
+        if response.status_code != 202:
+            break
+        if time.monotonic() > deadline:
+            raise BrapiServerError('Search results {} not available after {}s'.format(search_results_id, max_wait))
+        time.sleep(poll_interval)
+    if response.status_code != 200:
+        raise BrapiServerError(str(response.content))
+    return _iter_search_results(brapi_url, results_call, json_codec.loads(response.content), logger, session, group)
+
+
+def _iter_search_results(brapi_url, call, first_page, logger, session, group):
+    """
+    Iterate through the objects of a first page of search results already fetched, then through the next pages
+    """
+    iterator = BreedingAPIIterator(brapi_url, call, logger, session, group=group)
+    # Next pages of the same size as the first one
+    iterator.page_size = call['page-size']
+    yield from iterator.start_from(first_page)
+    for data in iterator:
+        yield from data
+
+
+class _NotCanonical(Exception):
+    pass
+
+
+def _append_canonical_json(value, parts):
+    """
+    Append the JSON representation of a value without its falsey values and sets to `parts` (with sorted keys and
+    the same formatting as `json.dumps`).
+    Return False if the value was removed entirely.
+    """
+    if isinstance(value, str):
+        if not value:
+            return False
+        parts.append(_encode_json_string(value))
+    elif value is True:
+        parts.append('true')
+    elif value is None or value is False:
+        return False
+    elif isinstance(value, int):
+        if not value:
+            return False
+        parts.append(int.__repr__(value))
+    elif isinstance(value, float):
+        if not value:
+            return False
+        parts.append(_encode_json_float(value))
+    elif isinstance(value, dict):
+        start = len(parts)
+        parts.append('{')
+        for key in sorted(value):
+            if not isinstance(key, str):
+                raise _NotCanonical()
+            if not key:
+                continue
+            entry_start = len(parts)
+            parts.append(', ' if len(parts) > start + 1 else '')
+            parts.append(_encode_json_string(key))
+            parts.append(': ')
+            if not _append_canonical_json(value[key], parts):
+                del parts[entry_start:]
+        if len(parts) == start + 1:
+            del parts[start:]
+            return False
+        parts.append('}')
+    elif isinstance(value, (list, tuple)):
+        start = len(parts)
+        parts.append('[')
+        for element in value:
+            element_start = len(parts)
+            if len(parts) > start + 1:
+                parts.append(', ')
+            if not _append_canonical_json(element, parts):
+                del parts[element_start:]
+        if len(parts) == start + 1:
+            del parts[start:]
+            return False
+        parts.append(']')
+    elif isinstance(value, set):
+        return False
+    else:
+        raise _NotCanonical()
+    return True
+
+
+def _encode_json_float(value):
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return 'Infinity' if value > 0 else '-Infinity'
+    return float.__repr__(value)
+
+
+def get_canonical_json(data):
+    """
+    JSON representation of a BrAPI object without its falsey values and sets, with sorted keys
+    (same as `json.dumps(remove_falsey(data, ...), sort_keys=True)` without the intermediate copy)
+    """
+    parts = list()
+    try:
+        if not _append_canonical_json(data, parts):
+            return 'null'
+    except _NotCanonical:
+        simplified_object = remove_falsey(data, predicate=lambda x: x and not isinstance(x, set))
+        return json.dumps(simplified_object, sort_keys=True)
+    return ''.join(parts)
+
+
+def get_fingerprint(data):
+    """
+    Fingerprint of the content of a BrAPI object (hash of its canonical JSON, see `get_canonical_json`)
+    """
+    return hashxx(get_canonical_json(data).encode())
+
+
 def get_identifier(entity_name, data):
     """
-    Get identifier from BrAPI object or generate one from hashed string json representation
+    Get identifier from BrAPI object or generate one from hashed string json representation.
+    The identifier is memoised in the object DbId field.
     """
     entity_id = entity_name + 'DbId'
     data_id = data.get(entity_id)
     if not data_id:
-        simplified_object = remove_falsey(data, predicate=lambda x: x and not isinstance(x, set))
-        json_rep = json.dumps(simplified_object, sort_keys=True)
-        data_id = str(hashxx(json_rep.encode()))
+        data_id = str(get_fingerprint(data))
     data[entity_id] = str(data_id)
     return data_id
 
@@ -108,16 +773,26 @@ def get_call_id(call):
     return call['method'] + " " + call["path"]
 
 
-def get_implemented_calls(source, logger):
-    implemented_calls = set()
-    calls_call = {'method': 'GET', 'path': '/calls', 'page-size': 100}
+# Call listing the calls implemented by a BrAPI endpoint
+CALLS_CALL = {'method': 'GET', 'path': '/calls', 'page-size': 100}
 
-    for call in BreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], calls_call, logger):
+
+def get_implemented_call_ids(calls):
+    """
+    Get the ids (ex: 'GET studies/{studyDbId}') of the calls listed by a BrAPI endpoint /calls
+    """
+    implemented_calls = set()
+    for call in calls:
         for method in call["methods"]:
             implemented_calls.add(method + " " + call["call"].replace('/brapi/v1/', '').replace(' /', ''))
     return implemented_calls
 
 
+def get_implemented_calls(source, logger, session=None):
+    return get_implemented_call_ids(BreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], CALLS_CALL, logger,
+                                                                  session, group='calls'))
+
+
 def get_implemented_call(source, call_group, context=None):
     calls = call_group['call'].copy()
     if not isinstance(calls, list):
@@ -128,6 +803,7 @@ def get_implemented_call(source, call_group, context=None):
 
         if call_id in source['implemented-calls']:
             call = call.copy()
+            call['endpoint'] = call_id
             if context:
                 call['path'] = replace_template(call['path'], context)
 
@@ -0,0 +1,422 @@
+"""
+Asyncio counterparts of the BrAPI session and iterators of `etl.common.brapi` (used by the asyncio extraction engine,
+see `etl.extract.brapi_async`): requests are sent from coroutines with the non-blocking `AsyncHTTPClient` and pages
+are parsed once read entirely.
+"""
+import asyncio
+import json
+import time
+import urllib.parse
+
+import requests
+
+from etl.common import json_codec
+from etl.common.async_http import AsyncHTTPClient
+from etl.common.brapi import BrapiServerError, get_call_id, get_implemented_call_ids, CALLS_CALL, DEFAULT_POOL_SIZE, \
+    DEFAULT_MAX_RETRIES, DEFAULT_MAX_RETRY_DELAY, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, \
+    DEFAULT_SEARCH_PAGE_SIZE, DEFAULT_SEARCH_POLL_INTERVAL, DEFAULT_SEARCH_MAX_WAIT
+from etl.common.concurrency import OVERLOAD_STATUSES, LatencyTracker, get_retry_delay
+from etl.common.utils import join_url_path
+
+
+class RequestSlots(object):
+    """
+    Wake the coroutines waiting for a request slot (of a limiter or a budget) when a request of any session sharing
+    it ends
+    """
+
+    def __init__(self):
+        self.released = asyncio.Event()
+
+    async def wait(self):
+        await self.released.wait()
+
+    def notify(self):
+        self.released.set()
+        self.released = asyncio.Event()
+
+
+class AsyncBrapiSession(object):
+    """
+    HTTP session shared by every coroutine calling one BrAPI source (see `etl.common.brapi.BrapiSession` for the
+    retries, `limiter`, `budget`, `cache`, hedged requests and `page_size_tuner`).
+    Requests waiting for the limiter or the budget do not block the event loop: they wait on `slots`, which should be
+    shared by the sessions sharing a budget.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, cache=None, limiter=None, max_retries=DEFAULT_MAX_RETRIES,
+                 retry_base_delay=1.0, max_retry_delay=DEFAULT_MAX_RETRY_DELAY,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+                 hedge_percentile=None, hedge_min_samples=20, max_hedge_ratio=0.1, page_size_tuner=None,
+                 budget=None, slots=None):
+        self.client = AsyncHTTPClient(pool_size, timeout)
+        self.cache = cache
+        self.limiter = limiter
+        self.budget = budget
+        self.slots = slots or RequestSlots()
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.max_retry_delay = max_retry_delay
+        self.retry_count = 0
+        self.latency = LatencyTracker()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.max_hedge_ratio = max_hedge_ratio
+        self.hedge_stats = {'sent': 0, 'won': 0}
+        self.transfer_stats = dict()
+        self.page_size_tuner = page_size_tuner
+
+    async def request(self, method, url, params=None, data=None, json=None, headers=None, endpoint=None,
+                      group=None):
+        """
+        Send a request, using the response cache (if any) to avoid downloading unchanged responses
+        (see `etl.common.brapi.BrapiSession.request`)
+        """
+        if not self.cache:
+            response = await self._send(method, url, endpoint, params=params, data=data, json=json, headers=headers)
+            self.count_transfer(group, response)
+            return response
+
+        cache_key = self.cache.get_key(method, url, params or data or json)
+        entry = self.cache.get(cache_key)
+        if entry and self.cache.is_fresh(entry):
+            self.cache.count('hit')
+            return self.cache.to_response(entry)
+
+        headers = dict(headers or {})
+        if entry:
+            headers.update(self.cache.get_conditional_headers(entry))
+        response = await self._send(method, url, endpoint, params=params, data=data, json=json, headers=headers)
+        self.count_transfer(group, response)
+        if entry and response.status_code == 304:
+            self.cache.count('revalidated')
+            return self.cache.to_response(entry)
+
+        self.cache.count('miss')
+        if response.status_code == 200:
+            self.cache.put(cache_key, response)
+        return response
+
+    async def _send(self, method, url, endpoint=None, **kwargs):
+        """
+        Send a request, retrying at most `max_retries` times if the server is overloaded or unreachable
+        """
+        host = urllib.parse.urlparse(url).netloc
+        attempt = 0
+        while True:
+            while not self._acquire(host):
+                await self.slots.wait()
+            start = time.perf_counter()
+            try:
+                response = await self._hedged_request(method, url, endpoint, host, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._release(host, overloaded=True, endpoint=endpoint)
+                if attempt >= self.max_retries:
+                    raise
+                delay = get_retry_delay(attempt, None, self.retry_base_delay, self.max_retry_delay)
+            except BaseException:
+                self._release(host, endpoint=endpoint)
+                raise
+            else:
+                latency = time.perf_counter() - start
+                overloaded = response.status_code in OVERLOAD_STATUSES
+                self._release(host, latency, overloaded, endpoint)
+                if endpoint and not overloaded:
+                    self.latency.record(endpoint, latency)
+                if not overloaded or attempt >= self.max_retries:
+                    return response
+                delay = get_retry_delay(attempt, response.headers.get('Retry-After'),
+                                        self.retry_base_delay, self.max_retry_delay)
+
+            attempt += 1
+            self.retry_count += 1
+            await asyncio.sleep(delay)
+
+    def _get_hedge_delay(self, method, endpoint):
+        """
+        Delay after which a hedged request should be sent (None if the request should not be hedged)
+        """
+        if not self.hedge_percentile or method != 'GET' or not endpoint:
+            return None
+        if self.latency.count(endpoint) < self.hedge_min_samples:
+            return None
+        if self.hedge_stats['sent'] >= self.max_hedge_ratio * sum(self.latency.counts.values()):
+            return None
+        return self.latency.percentile(endpoint, self.hedge_percentile)
+
+    async def _hedged_request(self, method, url, endpoint, host, **kwargs):
+        hedge_delay = self._get_hedge_delay(method, endpoint)
+        if hedge_delay is None:
+            return await self.client.request(method, url, **kwargs)
+
+        primary = asyncio.ensure_future(self.client.request(method, url, **kwargs))
+        try:
+            done, _ = await asyncio.wait([primary], timeout=hedge_delay)
+            if done or not self._acquire(host):
+                return await primary
+
+            self.hedge_stats['sent'] += 1
+            hedge = asyncio.ensure_future(self.client.request(method, url, **kwargs))
+            hedge.add_done_callback(lambda future: self._release_hedge(host, endpoint, future))
+            try:
+                done, _ = await asyncio.wait([primary, hedge], return_when=asyncio.FIRST_COMPLETED)
+                first = primary if primary in done else hedge
+                if first.exception() is not None:
+                    # Use the other request if the first to answer failed
+                    first = hedge if first is primary else primary
+                    await asyncio.wait([first])
+                if first is hedge:
+                    self.hedge_stats['won'] += 1
+                return first.result()
+            finally:
+                hedge.cancel()
+        finally:
+            primary.cancel()
+
+    def _release_hedge(self, host, endpoint, hedge):
+        error = None if hedge.cancelled() else hedge.exception()
+        overloaded = isinstance(error, (requests.ConnectionError, requests.Timeout)) or \
+            (error is None and not hedge.cancelled() and hedge.result().status_code in OVERLOAD_STATUSES)
+        self._release(host, overloaded=overloaded, endpoint=endpoint)
+
+    def _acquire(self, host):
+        """
+        Take a request slot from the budget and the limiter if both have one (without waiting)
+        """
+        if self.budget and not self.budget.acquire(host, blocking=False):
+            return False
+        if self.limiter and not self.limiter.acquire(blocking=False):
+            if self.budget:
+                self.budget.release(host)
+            return False
+        return True
+
+    def _release(self, host, latency=None, overloaded=False, endpoint=None):
+        if self.budget:
+            self.budget.release(host)
+        if self.limiter:
+            self.limiter.release(latency, overloaded, endpoint)
+        self.slots.notify()
+
+    def count_transfer(self, group, response):
+        """
+        Count bytes received on the wire (compressed) and decoded for a call group
+        """
+        stats = self.transfer_stats.setdefault(group or 'other', {'requests': 0, 'wire': 0, 'decoded': 0})
+        stats['requests'] += 1
+        stats['wire'] += response.wire_bytes
+        stats['decoded'] += len(response.content)
+
+    def get_connection_stats(self):
+        """
+        Count requests sent and connections opened by the session
+        """
+        nb_requests, nb_connections = self.client.stats['requests'], self.client.stats['connections']
+        return {'requests': nb_requests, 'connections': nb_connections,
+                'reused': max(nb_requests - nb_connections, 0)}
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncBreedingAPIIterator(object):
+    """
+    Fetch BrAPI result pages from coroutines (see `etl.common.brapi.BreedingAPIIterator`).
+    If no pagination is required, the first and only page contains the one BrAPI object.
+    """
+
+    def __init__(self, brapi_url, call, logger=None, session=None, journal=None, group=None):
+        self.total_pages = 1
+        self.brapi_url = brapi_url
+        self.call = call.copy()
+        self.logger = logger
+        self.session = session
+        self.journal = journal
+        self.group = group
+        self.call_key = json.dumps([self.call['method'], self.call['path'], self.call.get('param')])
+        self.endpoint = self.call.get('endpoint') or get_call_id(self.call)
+        self.tuner = session.page_size_tuner if session else None
+
+        self.page_size = None
+        self.is_paginated = 'page-size' in call
+        if self.is_paginated:
+            # Keep the page size of a resumed extraction, otherwise use the learned page size
+            self.page_size = self.journal and self.journal.get_page_size(self.call_key)
+            if not self.page_size:
+                self.page_size = call['page-size']
+                if self.tuner:
+                    self.page_size = self.tuner.get_page_size(self.endpoint, self.page_size)
+
+    def start_from(self, content):
+        """
+        Use the content of a first page fetched by other means (ex: the answer of a search call) and return its
+        objects
+        """
+        pagination = (content.get('metadata') or {}).get('pagination') or {}
+        self.total_pages = max(pagination.get('totalPages') or 1, 1)
+        return content['result']['data']
+
+    async def fetch_pages(self, concurrency=1, start=0):
+        """
+        Iterate through result pages (from the `start` page).
+        Once the first page gave the total number of pages, the remaining pages are fetched concurrently
+        (at most `concurrency` pages in flight) and yielded as soon as they arrive.
+        """
+        if start == 0:
+            yield await self.fetch_page(0)
+            start = 1
+        pages = iter(range(start, self.total_pages))
+        running = set()
+        try:
+            while True:
+                for page in pages:
+                    running.add(asyncio.ensure_future(self.fetch_page(page)))
+                    if len(running) >= concurrency:
+                        break
+                if not running:
+                    return
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def fetch_page(self, page):
+        if self.journal:
+            journal_page = self.journal.get_page(self.call_key, page)
+            if journal_page:
+                self.total_pages, data = journal_page
+                return data
+
+        start = time.perf_counter()
+        response = await self.__send(page)
+        latency = time.perf_counter() - start
+        content = json_codec.loads(response.content)
+
+        if not self.is_paginated:
+            self.total_pages = -1
+            return [content['result']]
+
+        pagination = content['metadata']['pagination']
+        data = content['result']['data']
+        self.total_pages = max(pagination['totalPages'], 1)
+        if self.tuner:
+            self.tuner.record_page(self.endpoint, self.page_size, pagination.get('pageSize'), len(data), latency)
+        if self.journal:
+            self.journal.record_page(self.call_key, page, self.page_size, self.total_pages, data)
+        return data
+
+    async def __send(self, page):
+        url = join_url_path(self.brapi_url, self.call['path'])
+        headers = {'Accept': 'application/json, application/ld+json'}
+        params = {}
+        if self.is_paginated:
+            params = {'page': page, 'pageSize': self.page_size}
+        if 'param' in self.call:
+            params.update(self.call['param'])
+        params_json = json.dumps(params)
+
+        if self.logger:
+            self.logger.debug('Fetching {} {} {}'.format(self.call['method'], url.encode('utf-8'), params_json))
+        response = None
+        try:
+            if self.call['method'] == 'GET':
+                response = await self.session.request('GET', url, params=params, headers=headers,
+                                                      endpoint=self.endpoint, group=self.group)
+            elif self.call['method'] == 'POST':
+                headers['Content-type'] = 'application/json'
+                response = await self.session.request('POST', url, data=params_json, headers=headers,
+                                                      endpoint=self.endpoint, group=self.group)
+        except requests.RequestException:
+            if self.tuner and self.is_paginated:
+                self.tuner.record_error(self.endpoint, self.page_size)
+            raise
+
+        if self.tuner and self.is_paginated and response.status_code >= 500:
+            self.tuner.record_error(self.endpoint, self.page_size)
+
+        if response.status_code != 200:
+            try:
+                message = json_codec.loads(response.content)['metadata']
+            except (ValueError, KeyError, TypeError):
+                message = str(response.content)
+            self.total_pages = -1
+            raise BrapiServerError(message)
+        return response
+
+    @staticmethod
+    async def fetch_all(brapi_url, call, logger=None, session=None, concurrency=1, journal=None, group=None):
+        """
+        List all BrAPI objects for given call (does pagination automatically if needed)
+        """
+        iterator = AsyncBreedingAPIIterator(brapi_url, call, logger, session, journal, group)
+        data_list = list()
+        async for data in iterator.fetch_pages(concurrency):
+            data_list.extend(data)
+        return data_list
+
+
+async def fetch_search_results(brapi_url, call, logger=None, session=None, group=None,
+                               poll_interval=DEFAULT_SEARCH_POLL_INTERVAL, max_wait=DEFAULT_SEARCH_MAX_WAIT):
+    """
+    List the BrAPI objects found by a search call, polling the results of asynchronous searches
+    (see `etl.common.brapi.fetch_search_results`)
+    """
+    call = dict(call)
+    call.setdefault('page-size', DEFAULT_SEARCH_PAGE_SIZE)
+    if not call.get('async-search'):
+        return await AsyncBreedingAPIIterator.fetch_all(brapi_url, call, logger, session, group=group)
+
+    headers = {'Accept': 'application/json, application/ld+json'}
+    results_endpoint = 'GET ' + call['path'] + '/{searchResultsDbId}'
+    url = join_url_path(brapi_url, call['path'])
+    if logger:
+        logger.debug('Searching POST {} {}'.format(url.encode('utf-8'), json.dumps(call.get('param'))))
+    # Ask for the first page so that results answered directly can be used as is
+    page_params = {'page': 0, 'pageSize': call['page-size']}
+    response = await session.request('POST', url, json=dict(page_params, **(call.get('param') or {})),
+                                     headers=headers, endpoint=call.get('endpoint') or get_call_id(call), group=group)
+    if response.status_code not in (200, 202):
+        raise BrapiServerError(str(response.content))
+    content = json_codec.loads(response.content)
+    search_results_id = (content.get('result') or {}).get('searchResultsDbId')
+    if not search_results_id:
+        # Results answered directly (by pages)
+        return await _fetch_search_results(brapi_url, dict(call, **{'async-search': False}), content, logger,
+                                           session, group)
+
+    results_call = {'method': 'GET', 'path': call['path'] + '/' + search_results_id, 'page-size': call['page-size'],
+                    'endpoint': results_endpoint}
+    results_url = join_url_path(brapi_url, results_call['path'])
+    deadline = time.monotonic() + max_wait
+    while True:
+        response = await session.request('GET', results_url, params=page_params, headers=headers,
+                                         endpoint=results_endpoint, group=group)
+        if response.status_code != 202:
+            break
+        if time.monotonic() > deadline:
+            raise BrapiServerError('Search results {} not available after {}s'.format(search_results_id, max_wait))
+        await asyncio.sleep(poll_interval)
+    if response.status_code != 200:
+        raise BrapiServerError(str(response.content))
+    return await _fetch_search_results(brapi_url, results_call, json_codec.loads(response.content), logger, session,
+                                       group)
+
+
+async def _fetch_search_results(brapi_url, call, first_page, logger, session, group):
+    """
+    List the objects of a first page of search results already fetched and of the next pages
+    """
+    iterator = AsyncBreedingAPIIterator(brapi_url, call, logger, session, group=group)
+    # Next pages of the same size as the first one
+    iterator.page_size = call['page-size']
+    data_list = list(iterator.start_from(first_page))
+    async for data in iterator.fetch_pages(start=1):
+        data_list.extend(data)
+    return data_list
+
+
+async def get_implemented_calls(source, logger, session):
+    return get_implemented_call_ids(await AsyncBreedingAPIIterator.fetch_all(
+        source['brapi:endpointUrl'], CALLS_CALL, logger, session, group='calls'))
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from etl.common import json_codec
+
+DEFAULT_TTL = 86400
+PAGINATION_PARAMS = ['page', 'pageSize']
+
+
+def normalise_param(name, value):
+    if name in PAGINATION_PARAMS:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            pass
+    return value
+
+
+class ResponseCache(object):
+    """
+    On-disk HTTP response cache.
+    Entries are keyed by a hash of the request (method + URL + params, see `get_key`), not of the response content.
+    Responses with an ETag or Last-Modified header are revalidated with a conditional request, others are reused while
+    younger than `ttl` seconds.
+    """
+
+    def __init__(self, cache_dir, ttl=DEFAULT_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.stats = {'hit': 0, 'revalidated': 0, 'miss': 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(method, url, params=None):
+        """
+        Hash the request method, URL and params (a dict or a JSON body).
+        The pagination params are normalised as integers (page '2' and page 2 share the same entry) but stay part of
+        the key since a page holds different objects for each page size: the pages of a list whose page size was
+        changed by the `PageSizeTuner` are downloaded again, and reused from the cache once the tuned size stops
+        changing.
+        """
+        if isinstance(params, (str, bytes)):
+            try:
+                params = json.loads(params)
+            except ValueError:
+                params = params.decode('utf-8', 'replace') if isinstance(params, bytes) else params
+        if isinstance(params, dict):
+            params = {name: normalise_param(name, value) for (name, value) in params.items()}
+        params = json.dumps(params or {}, sort_keys=True)
+        return hashlib.sha256('\n'.join([method, url, params]).encode()).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, key):
+        try:
+            with open(self._get_path(key), 'r') as entry_file:
+                return json_codec.loads(entry_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, response):
+        validators = {name: response.headers[name]
+                      for name in ['ETag', 'Last-Modified'] if name in response.headers}
+        entry = {'url': response.url, 'time': time.time(), 'validators': validators, 'content': response.text}
+
+        # Write to a temporary file first so that concurrent readers never see a partial entry
+        entry_path = self._get_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path))
+        with os.fdopen(fd, 'w') as entry_file:
+            entry_file.write(json_codec.dumps(entry))
+        os.replace(tmp_path, entry_path)
+
+    def is_fresh(self, entry):
+        return not entry['validators'] and time.time() - entry['time'] < self.ttl
+
+    @staticmethod
+    def get_conditional_headers(entry):
+        headers = dict()
+        if 'ETag' in entry['validators']:
+            headers['If-None-Match'] = entry['validators']['ETag']
+        if 'Last-Modified' in entry['validators']:
+            headers['If-Modified-Since'] = entry['validators']['Last-Modified']
+        return headers
+
+    @staticmethod
+    def to_response(entry):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = entry['url']
+        response.headers = CaseInsensitiveDict(entry['validators'])
+        response.encoding = 'utf-8'
+        response._content = entry['content'].encode('utf-8')
+        response.from_cache = True
+        return response
@@ -0,0 +1,63 @@
+import bz2
+import gzip
+import lzma
+import os
+
+# Extension added to the files compressed with each codec
+CODEC_EXTENSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'lzma': '.xz'}
+# Fast compression with a good ratio on JSON lines (1 to 9 for all the codecs)
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+def get_codec(path):
+    """
+    Get the compression codec of a file from its extension (None if not compressed)
+    """
+    for (codec, extension) in CODEC_EXTENSIONS.items():
+        if path.endswith(extension):
+            return codec
+    return None
+
+
+def get_compressed_path(path, codec):
+    """
+    Add the extension of a compression codec to a file path (ex: 'study.json' => 'study.json.gz')
+    """
+    if not codec:
+        return path
+    if codec not in CODEC_EXTENSIONS:
+        raise ValueError("Unknown compression codec '{}' (expected one of {})"
+                         .format(codec, ', '.join(sorted(CODEC_EXTENSIONS))))
+    return path + CODEC_EXTENSIONS[codec]
+
+
+def find_file(path):
+    """
+    Get the path of a file or of its compressed version (None if none exists)
+    """
+    for candidate in [path] + [path + extension for extension in CODEC_EXTENSIONS.values()]:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def open_file(path, mode='r', level=DEFAULT_COMPRESSION_LEVEL):
+    """
+    Open a file transparently compressed with the codec of its extension (in UTF-8 text mode unless 'b' is in `mode`)
+    """
+    codec = get_codec(path)
+    # JSON text is always UTF-8 (whatever the locale)
+    encoding = None if 'b' in mode else 'utf-8'
+    if codec is None:
+        return open(path, mode, encoding=encoding)
+    if 'b' not in mode and 't' not in mode:
+        mode += 't'
+    writing = any(flag in mode for flag in 'wax')
+    if codec == 'gzip':
+        return gzip.open(path, mode, compresslevel=level, encoding=encoding) if writing \
+            else gzip.open(path, mode, encoding=encoding)
+    if codec == 'bz2':
+        return bz2.open(path, mode, compresslevel=level, encoding=encoding) if writing \
+            else bz2.open(path, mode, encoding=encoding)
+    return lzma.open(path, mode, preset=level, encoding=encoding) if writing \
+        else lzma.open(path, mode, encoding=encoding)
@@ -0,0 +1,300 @@
+import collections
+import email.utils
+import queue
+import random
+import threading
+import time
+from functools import partial
+
+# HTTP status of responses telling that the server is overloaded (the request can be retried later)
+OVERLOAD_STATUSES = {429, 502, 503, 504}
+
+
+class AdaptiveLimiter(object):
+    """
+    Limit the number of requests in flight to a server.
+    The limit adapts with AIMD (additive increase, multiplicative decrease): it grows by one every `limit` successful
+    responses and is halved when the server is overloaded (429/5xx responses, connection errors, timeouts)
+    or when the recent latency of an endpoint gets much higher than its usual latency (endpoints are compared to
+    themselves so that slow but healthy calls, ex: big list pages, do not read as latency spikes).
+    """
+
+    def __init__(self, max_limit, min_limit=1, latency_factor=2.0):
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.limit = float(max(self.min_limit, self.max_limit // 2))
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        # Short and long moving averages of the latency by endpoint
+        self.latencies = dict()
+        self.last_decrease = 0
+        self.stats = {'requests': 0, 'overloaded': 0}
+        self.condition = threading.Condition()
+
+    def acquire(self, blocking=True):
+        """
+        Wait for the number of requests in flight to get below the limit (return False instead of waiting if not
+        `blocking`)
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.in_flight += 1
+            return True
+
+    def release(self, latency=None, overloaded=False, endpoint=None):
+        with self.condition:
+            self.in_flight -= 1
+            self.stats['requests'] += 1
+            if overloaded:
+                self.stats['overloaded'] += 1
+                self._decrease(self.latencies.get(endpoint, (None, None))[1])
+            elif latency is not None:
+                averages = self._update_latency(endpoint, latency)
+                if averages[0] > averages[1] * self.latency_factor:
+                    self._decrease(averages[1])
+                    averages[0] = averages[1]
+                else:
+                    self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self.condition.notify_all()
+
+    def _decrease(self, round_trip=None):
+        # Decrease at most once per round-trip so that a burst of errors only counts once
+        now = time.monotonic()
+        if now - self.last_decrease >= (round_trip or 1.0):
+            self.limit = max(self.limit / 2, self.min_limit)
+            self.last_decrease = now
+
+    def _update_latency(self, endpoint, latency):
+        # Exponential moving averages of the latency over the last few responses and over a longer period
+        averages = self.latencies.get(endpoint)
+        if averages is None:
+            averages = self.latencies[endpoint] = [latency, latency]
+        else:
+            averages[0] += (latency - averages[0]) * 0.2
+            averages[1] += (latency - averages[1]) * 0.01
+        return averages
+
+
+def get_retry_delay(attempt, retry_after=None, base_delay=1.0, max_delay=60.0):
+    """
+    Delay before retrying a request: the server 'Retry-After' header value (in seconds or as an HTTP date)
+    if any, an exponential backoff with jitter otherwise.
+    """
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0), max_delay)
+    return min(base_delay * (2 ** attempt), max_delay) * random.uniform(0.5, 1)
+
+
+class LatencyTracker(object):
+    """
+    Track the latency of the last `window` responses of each endpoint to compute latency percentiles
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.latencies = dict()
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, latency):
+        with self.lock:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = collections.deque(maxlen=self.window)
+            self.latencies[endpoint].append(latency)
+            self.counts[endpoint] += 1
+
+    def count(self, endpoint):
+        return self.counts[endpoint]
+
+    def percentile(self, endpoint, percent):
+        with self.lock:
+            latencies = sorted(self.latencies.get(endpoint) or [])
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * percent / 100), len(latencies) - 1)]
+
+    def get_stats(self):
+        """
+        Number of calls, p50 and p99 latency by endpoint
+        """
+        return {endpoint: (self.counts[endpoint], self.percentile(endpoint, 50), self.percentile(endpoint, 99))
+                for endpoint in list(self.latencies)}
+
+
+class RequestBudget(object):
+    """
+    Global budget of HTTP requests in flight shared by the sessions of all the sources (see `BrapiSession`):
+    at most `max_requests` requests in flight and at most `max_per_host` to the same server.
+    """
+
+    def __init__(self, max_requests, max_per_host=None):
+        self.max_requests = max(max_requests, 1)
+        self.max_per_host = max_per_host or self.max_requests
+        self.in_flight = 0
+        self.in_flight_by_host = collections.Counter()
+        self.condition = threading.Condition()
+
+    def acquire(self, host, blocking=True):
+        """
+        Wait for a request slot (return False instead of waiting if not `blocking`)
+        """
+        with self.condition:
+            while self.in_flight >= self.max_requests or self.in_flight_by_host[host] >= self.max_per_host:
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.in_flight += 1
+            self.in_flight_by_host[host] += 1
+            return True
+
+    def release(self, host):
+        with self.condition:
+            self.in_flight -= 1
+            self.in_flight_by_host[host] -= 1
+            self.condition.notify_all()
+
+
+class WorkScheduler(object):
+    """
+    Run the tasks of several sources on `max_workers` shared worker threads (global concurrency budget):
+     - at most `max_per_host` tasks of sources hosted on the same server run at the same time,
+     - a source with a `limiter` (see `AdaptiveLimiter`) only gets a worker when it has fewer tasks running than its
+       limit of requests in flight (instead of a worker waiting for the limiter),
+     - idle workers take the next task of the source with the most remaining work (largest first)
+    so that the largest source gets every worker the smaller ones no longer need.
+    Each source submits its tasks through a pool-like `SchedulerPool` (see `get_pool`).
+    The requests sent by the tasks are bounded by the sessions `RequestBudget`, not by the scheduler.
+    """
+
+    def __init__(self, max_workers, max_per_host=None):
+        self.max_per_host = max_per_host or max_workers
+        self.pools = list()
+        self.running_by_host = collections.Counter()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(max(max_workers, 1))]
+        for worker in self.workers:
+            worker.start()
+
+    def get_pool(self, host, limiter=None):
+        pool = SchedulerPool(self, host, limiter)
+        with self.condition:
+            self.pools.append(pool)
+        return pool
+
+    def submit(self, pool, tasks):
+        with self.condition:
+            pool.tasks.extend(tasks)
+            self.condition.notify_all()
+
+    def cancel(self, pool, results=None):
+        """
+        Cancel the pending tasks of a pool (only those sending their results to `results` if given)
+        """
+        with self.condition:
+            if results is None:
+                pool.tasks.clear()
+            else:
+                pending = [task for task in pool.tasks if task[1] is not results]
+                pool.tasks.clear()
+                pool.tasks.extend(pending)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _next_task(self):
+        candidates = [pool for pool in self.pools
+                      if pool.tasks and self.running_by_host[pool.host] < self.max_per_host and pool.has_capacity()]
+        if not candidates:
+            return None
+        pool = max(candidates, key=lambda candidate: len(candidate.tasks))
+        return pool, pool.tasks.popleft()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                next_task = None
+                while not self.closed and not next_task:
+                    next_task = self._next_task()
+                    if not next_task:
+                        self.condition.wait()
+                if self.closed:
+                    return
+                pool, (function, results) = next_task
+                self.running_by_host[pool.host] += 1
+                pool.running += 1
+            try:
+                results.put((True, function()))
+            except BaseException as exception:
+                results.put((False, exception))
+            finally:
+                with self.condition:
+                    self.running_by_host[pool.host] -= 1
+                    pool.running -= 1
+                    self.condition.notify_all()
+
+
+class SchedulerPool(object):
+    """
+    Pool-like interface (see `multiprocessing.pool.ThreadPool`) of a source on a `WorkScheduler`
+    """
+
+    def __init__(self, scheduler, host, limiter=None):
+        self.scheduler = scheduler
+        self.host = host
+        self.limiter = limiter
+        self.tasks = collections.deque()
+        self.running = 0
+
+    def has_capacity(self):
+        return self.limiter is None or self.running < int(self.limiter.limit)
+
+    def imap_unordered(self, function, iterable, chunksize=1):
+        """
+        Submit function calls for each argument and iterate through the results as soon as they are available.
+        Remaining calls are cancelled if one of them fails.
+        """
+        results = queue.Queue()
+        tasks = [(partial(function, args), results) for args in iterable]
+        self.scheduler.submit(self, tasks)
+        return self._iter_results(results, len(tasks))
+
+    def _iter_results(self, results, nb_results):
+        try:
+            for _ in range(nb_results):
+                success, result = results.get()
+                if not success:
+                    raise result
+                yield result
+        finally:
+            self.scheduler.cancel(self, results)
+
+    def terminate(self):
+        """
+        Cancel the pending tasks and stop accepting tasks (running tasks go on, see `join`)
+        """
+        self.scheduler.cancel(self)
+        with self.scheduler.condition:
+            if self in self.scheduler.pools:
+                self.scheduler.pools.remove(self)
+
+    def join(self):
+        """
+        Wait for the running tasks
+        """
+        with self.scheduler.condition:
+            while self.running:
+                self.scheduler.condition.wait()
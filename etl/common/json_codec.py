@@ -0,0 +1,76 @@
+"""
+JSON encoding and decoding of the ETL data (extraction pages and stores, transformation inputs and outputs).
+The fastest installed backend is used (orjson, or the standard library json module otherwise), use `set_backend` to
+change it.
+Sets and other iterables are encoded as lists and bytes as UTF-8 strings with both backends, and both write the
+same compact JSON with non-ASCII characters as is (not escaped).
+
+Object identifiers are hashed from the standard library JSON (see `etl.common.brapi.get_canonical_json`) so that
+they do not depend on the backend.
+"""
+import json
+
+from etl.common.utils import is_list_like
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKENDS = ['orjson', 'json']
+backend = None
+
+
+def set_backend(name=None):
+    """
+    Select the JSON backend by name (the fastest installed one by default)
+    """
+    global backend
+    if name is None:
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in BACKENDS:
+        raise ValueError("Unknown JSON backend '{}' (expected one of {})".format(name, ', '.join(BACKENDS)))
+    if name == 'orjson' and orjson is None:
+        raise ImportError("The orjson JSON backend is not installed")
+    backend = name
+
+
+def _default(obj):
+    if isinstance(obj, bytes):
+        return obj.decode()
+    if is_list_like(obj):
+        return list(obj)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def dumps(data):
+    """
+    Encode data as a JSON string
+    """
+    if backend == 'orjson':
+        try:
+            return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS).decode()
+        except orjson.JSONEncodeError:
+            # Not supported by orjson (ex: integers over 64 bits)
+            pass
+    return json.dumps(data, default=_default, ensure_ascii=False, separators=(',', ':'))
+
+
+def loads(text):
+    """
+    Decode a JSON string (str or UTF-8 bytes)
+    """
+    if backend == 'orjson':
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def dump_line(data, json_file):
+    """
+    Write data as one JSON line in a text file
+    """
+    json_file.write(dumps(data))
+    json_file.write('\n')
+
+
+set_backend()
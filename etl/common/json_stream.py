@@ -0,0 +1,255 @@
+import codecs
+import json
+import os
+
+from etl.common import json_codec
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+
+# Number of bytes read at once when converting JSON files
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class JSONArrayStreamParser(object):
+    """
+    Incremental parser of the elements of the JSON array found at `path` (ex: ['result', 'data'], or () for a
+    document that is an array) in a JSON document fed by chunks (bytes or str).
+    Elements are returned as soon as they are complete. The rest of the document (with an empty array at `path`)
+    is available in `document` after `close`.
+    """
+
+    def __init__(self, path=()):
+        self.path = list(path)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.skeleton = list()
+        self.stack = list()
+        self.in_array = False
+        self.array_done = False
+        self.document = None
+
+    def feed(self, chunk):
+        """
+        Add a chunk of the JSON document and return the array elements completed by it
+        """
+        if isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk)
+        self.buffer += chunk
+        elements = list()
+        while self.position < len(self.buffer):
+            if self.array_done:
+                self.position = len(self.buffer)
+            elif self.in_array:
+                if not self._parse_element(elements):
+                    break
+            elif not self._scan_token():
+                break
+        self._compact()
+        return elements
+
+    def close(self):
+        """
+        End of the JSON document: return the last elements and parse the rest of the document
+        """
+        elements = self.feed(self.decoder.decode(b'', final=True))
+        if self.in_array:
+            raise ValueError('Unterminated JSON array at ' + '.'.join(self.path))
+        self.skeleton.append(self.buffer)
+        self.buffer = ''
+        self.document = json.loads(''.join(self.skeleton))
+        return elements
+
+    def _compact(self):
+        # Move consumed text to the skeleton (outside of the array) or drop it (array elements)
+        if not self.in_array:
+            self.skeleton.append(self.buffer[:self.position])
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+
+    def _skip_whitespace(self):
+        while self.position < len(self.buffer) and self.buffer[self.position] in _whitespace:
+            self.position += 1
+        return self.position < len(self.buffer)
+
+    def _parse_element(self, elements):
+        if not self._skip_whitespace():
+            return False
+        char = self.buffer[self.position]
+        if char == ']':
+            self.in_array = False
+            self.array_done = True
+            self.skeleton.append(']')
+            self.position += 1
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+            return True
+        if char == ',':
+            self.position += 1
+            return True
+        try:
+            element, end = _decoder.raw_decode(self.buffer, self.position)
+        except json.JSONDecodeError:
+            # Incomplete element
+            return False
+        # A number is only complete once followed by a delimiter (ex: '12' in '12.5')
+        if end >= len(self.buffer) or self.buffer[end] not in _whitespace + ',]':
+            return False
+        elements.append(element)
+        self.position = end
+        return True
+
+    def _scan_token(self):
+        """
+        Scan one JSON token outside of the array, tracking the object keys leading to the current position
+        """
+        if not self._skip_whitespace():
+            return False
+        char = self.buffer[self.position]
+        if char == '"':
+            try:
+                string, end = json.decoder.scanstring(self.buffer, self.position + 1)
+            except json.JSONDecodeError:
+                return False
+            if self.stack and self.stack[-1][0] == 'object' and self.stack[-1][2] == 'key':
+                self.stack[-1][1] = string
+            self.position = end
+        elif char == '{':
+            self.stack.append(['object', None, 'key'])
+            self.position += 1
+        elif char == '[':
+            self.position += 1
+            if self._is_at_path():
+                self.skeleton.append(self.buffer[:self.position])
+                self.buffer = self.buffer[self.position:]
+                self.position = 0
+                self.in_array = True
+            else:
+                self.stack.append(['array', None, 'value'])
+        elif char in '}]':
+            self.stack.pop()
+            self.position += 1
+        elif char == ':':
+            self.stack[-1][2] = 'value'
+            self.position += 1
+        elif char == ',':
+            if self.stack[-1][0] == 'object':
+                self.stack[-1][2] = 'key'
+            self.position += 1
+        else:
+            # Literal or number
+            end = self.position
+            while end < len(self.buffer) and self.buffer[end] not in _whitespace + ',]}':
+                end += 1
+            if end >= len(self.buffer):
+                return False
+            self.position = end
+        return True
+
+    def _is_at_path(self):
+        if len(self.stack) != len(self.path):
+            return False
+        return all(frame[0] == 'object' and frame[2] == 'value' and frame[1] == key
+                   for (frame, key) in zip(self.stack, self.path))
+
+
+def iter_json_array_stream(chunks, path=()):
+    """
+    Iterate through the elements of the JSON array at `path` in a JSON document read by chunks.
+    Return the rest of the document (with an empty array at `path`) as generator return value.
+    """
+    parser = JSONArrayStreamParser(path)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+    return parser.document
+
+
+def is_json_array_file(json_path):
+    """
+    Tell if a JSON file contains a JSON array (rather than JSON lines) from its first non-whitespace byte
+    """
+    with open(json_path, 'rb') as json_file:
+        while True:
+            chunk = json_file.read(4096)
+            if not chunk:
+                return False
+            chunk = chunk.lstrip(codecs.BOM_UTF8 + _whitespace.encode())
+            if chunk:
+                return chunk.startswith(b'[')
+
+
+class JSONLinesWriter(object):
+    """
+    Write a JSON document fed by chunks (bytes) in a file as JSON lines, in constant memory: the elements of a JSON
+    array are written one per line and a document already in JSON lines is copied as is.
+    The format is sniffed from the first non-whitespace byte, so that a document can be converted while it is
+    downloaded.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.output_file = open(output_path, 'wb')
+        self.parser = None
+        self.is_array = None
+        self.head = b''
+
+    def feed(self, chunk):
+        if self.is_array is None:
+            # Skip the byte order mark and whitespaces before the first JSON value
+            self.head += chunk
+            head = self.head[len(codecs.BOM_UTF8):] if self.head.startswith(codecs.BOM_UTF8) else self.head
+            chunk = head.lstrip(_whitespace.encode())
+            if not chunk:
+                return
+            self.head = None
+            self.is_array = chunk.startswith(b'[')
+            if self.is_array:
+                self.parser = JSONArrayStreamParser()
+        if self.is_array:
+            self._write_elements(self.parser.feed(chunk))
+        else:
+            self.output_file.write(chunk)
+
+    def close(self):
+        try:
+            if self.is_array:
+                self._write_elements(self.parser.close())
+        finally:
+            self.output_file.close()
+
+    def discard(self):
+        """
+        Close and remove the output file (ex: incomplete document)
+        """
+        self.output_file.close()
+        os.remove(self.output_path)
+
+    def _write_elements(self, elements):
+        for element in elements:
+            self.output_file.write(json_codec.dumps(element).encode())
+            self.output_file.write(b'\n')
+
+
+def convert_json_file_to_lines(json_path, output_path=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Convert a JSON array file into a JSON lines file in constant memory (in place without `output_path`).
+    The output is written atomically. A file already in JSON lines is only copied to `output_path`.
+    Return True if the file was a JSON array.
+    """
+    is_array = is_json_array_file(json_path)
+    if output_path is None:
+        if not is_array:
+            return False
+        output_path = json_path
+
+    writer = JSONLinesWriter(output_path + '.tmp')
+    try:
+        with open(json_path, 'rb') as json_file:
+            for chunk in iter(lambda: json_file.read(chunk_size), b''):
+                writer.feed(chunk)
+    finally:
+        writer.close()
+    os.replace(output_path + '.tmp', output_path)
+    return is_array
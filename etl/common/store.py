@@ -1,12 +1,22 @@
 import collections
-import json
+import copy
+import itertools
 import os
 import re
+import sqlite3
+import threading
 
-from etl.common.brapi import get_identifier
-from etl.common.utils import get_file_path, is_list_like, remove_empty
+from etl.common.brapi import get_identifier, get_fingerprint
+from etl.common.compression import open_file, get_compressed_path, DEFAULT_COMPRESSION_LEVEL
+from etl.common.json_codec import dumps, loads, dump_line
+from etl.common.utils import get_file_path, remove_empty
 from collections import abc
 
+# Number of objects kept in memory by a MergeStore spilled to disk
+DEFAULT_HOT_CACHE_SIZE = 100000
+# Kinds of changes of the objects since the previous extraction (see `load_change_set`)
+CHANGES = ['added', 'changed', 'removed']
+
 
 def dict_merge(into, merge_dct):
     """ Recursive dict merge. Inspired by :meth:``dict.update()``, instead of
@@ -27,7 +37,8 @@ def dict_merge(into, merge_dct):
 
 def list_entity_files(json_dir):
     for file_name in os.listdir(json_dir):
-        matches = re.search(r'^([a-zA-Z]+).*\.json$', file_name)
+        # JSON files can be compressed (see `etl.common.compression`)
+        matches = re.search(r'^([a-zA-Z]+).*\.json(\.gz|\.bz2|\.xz)?$', file_name)
         if not matches:
             continue
         entity_name = matches.groups()[0]
@@ -37,35 +48,41 @@ def list_entity_files(json_dir):
 
 def load_entity_lines(options):
     entity_name, file_path = options
-    with open(file_path, 'r') as json_data_file:
+    with open_file(file_path, 'r') as json_data_file:
         for line in json_data_file:
             yield (entity_name, line)
 
 
-class CustomJSONEncoder(json.JSONEncoder):
-    """JSON encoder that encodes sets and iterables as list"""
-
-    @classmethod
-    def dump(cls, data, json_file):
-        json.dump(data, json_file, cls=cls)
-
-    def default(self, obj):
-        if is_list_like(obj):
-            return list(obj)
-        if isinstance(obj, bytes):
-            return obj.decode()
-        return json.JSONEncoder.default(self, obj)
-
-
 class MergeStore(dict):
     """
-    BrAPI entity in memory data store that can merge object by id and save objects in JSON file.
+    BrAPI entity data store that can merge object by id and save objects in JSON file.
+    The ids of the objects added or changed (through `add`) since the last `reset_dirty` are tracked in `dirty_ids`.
+
+    Objects are kept in memory until the store holds more than `spill_threshold` objects. The store then spills its
+    objects to an SQLite database in `spill_dir` and only keeps the `hot_cache_size` most recently used objects in
+    memory (objects leaving this cache are written back to the database as they might have been changed in place).
+    Link sets stay sets through the database so that spilled objects are saved like the others.
+
+    The JSON file can be compressed with a `compression` codec (see `etl.common.compression`).
     """
+    BATCH_SIZE = 1000
 
-    def __init__(self, source_id, entity_name):
+    def __init__(self, source_id, entity_name, spill_threshold=None, spill_dir=None,
+                 hot_cache_size=DEFAULT_HOT_CACHE_SIZE, compression=None, compression_level=DEFAULT_COMPRESSION_LEVEL):
         super(MergeStore, self).__init__()
         self.entity_name = entity_name
         self.source_id = source_id
+        self.dirty_ids = set()
+        self.spill_threshold = spill_threshold if spill_dir else None
+        self.spill_dir = spill_dir
+        self.hot_cache_size = max(hot_cache_size, 1)
+        self.database = None
+        # Ids of the objects kept in memory once spilled, from the least to the most recently used
+        self.recent_ids = collections.OrderedDict()
+        self.count = 0
+        self.lock = threading.RLock()
+        self.compression = compression
+        self.compression_level = compression_level
 
     def add(self, data):
         # Compact object by removing nulls and empty
@@ -73,34 +90,271 @@ class MergeStore(dict):
         if data:
             data['source'] = self.source_id
             data_id = get_identifier(self.entity_name, data)
-            if data_id in self:
-                dict_merge(self[data_id], data)
+            with self.lock:
+                if data_id in self:
+                    dict_merge(self[data_id], data)
+                else:
+                    self._insert(data_id, data)
+                self.dirty_ids.add(data_id)
+
+    def is_redundant(self, data):
+        """
+        Tell if adding an object would not change the object already stored with the same id
+        """
+        data = remove_empty(data)
+        if not data:
+            return True
+        data['source'] = self.source_id
+        data_id = get_identifier(self.entity_name, data)
+        with self.lock:
+            if data_id not in self:
+                return False
+            stored_data = self[data_id]
+            merged_data = copy.deepcopy(stored_data)
+            dict_merge(merged_data, data)
+            return merged_data == stored_data
+
+    def reset_dirty(self):
+        """
+        Return the ids of objects added or changed since the last reset and start tracking changes again
+        """
+        dirty_ids, self.dirty_ids = self.dirty_ids, set()
+        return dirty_ids
+
+    def _insert(self, data_id, data):
+        if self.database is None:
+            dict.__setitem__(self, data_id, data)
+            if self.spill_threshold and dict.__len__(self) > self.spill_threshold:
+                self._spill()
+        else:
+            self.database.execute('INSERT INTO objects (id, data) VALUES (?, ?)', (data_id, self._dump(data)))
+            self.count += 1
+            self._cache(data_id, data)
+
+    def _spill(self):
+        """
+        Move the objects to an SQLite database, keeping the most recently added ones in memory
+        """
+        os.makedirs(self.spill_dir, exist_ok=True)
+        database_path = os.path.join(self.spill_dir, self.entity_name + '.sqlite')
+        if os.path.exists(database_path):
+            os.remove(database_path)
+        database = sqlite3.connect(database_path, check_same_thread=False, isolation_level=None)
+        # Temporary database: no need for durability
+        database.execute('PRAGMA journal_mode = OFF')
+        database.execute('PRAGMA synchronous = OFF')
+        database.execute('CREATE TABLE objects (id TEXT PRIMARY KEY, data TEXT)')
+        database.execute('BEGIN')
+        database.executemany('INSERT INTO objects (id, data) VALUES (?, ?)',
+                             ((data_id, self._dump(data)) for (data_id, data) in dict.items(self)))
+        database.execute('COMMIT')
+        self.count = dict.__len__(self)
+        self.database = database
+        # Keep the most recently added objects (rebuilt in one pass)
+        recent_items = list(itertools.islice(reversed(dict.items(self)), self.hot_cache_size))[::-1]
+        dict.clear(self)
+        dict.update(self, recent_items)
+        self.recent_ids = collections.OrderedDict.fromkeys(data_id for (data_id, _) in recent_items)
+
+    @staticmethod
+    def _dump(data):
+        # Link sets are written as sorted lists along with their keys to be restored as sets (see `_load`)
+        set_keys = [key for (key, value) in data.items() if isinstance(value, set)]
+        if set_keys:
+            data = dict(data, **{key: sorted(data[key], key=str) for key in set_keys})
+        return dumps([set_keys, data])
+
+    @staticmethod
+    def _load(data_json):
+        set_keys, data = loads(data_json)
+        for key in set_keys:
+            data[key] = set(data[key])
+        return data
+
+    def _cache(self, data_id, data):
+        # Most recently used objects are at the end of `recent_ids`
+        if data_id in self.recent_ids:
+            self.recent_ids.move_to_end(data_id)
+        else:
+            self.recent_ids[data_id] = None
+        dict.__setitem__(self, data_id, data)
+        evicted_ids = list()
+        while len(self.recent_ids) > self.hot_cache_size:
+            evicted_ids.append(self.recent_ids.popitem(last=False)[0])
+        if evicted_ids:
+            self.database.executemany('UPDATE objects SET data = ? WHERE id = ?',
+                                      [(self._dump(dict.pop(self, evicted_id)), evicted_id)
+                                       for evicted_id in evicted_ids])
+
+    def flush(self):
+        """
+        Write the objects in memory back to the database (if the store spilled)
+        """
+        with self.lock:
+            if self.database is not None:
+                self.database.executemany('UPDATE objects SET data = ? WHERE id = ?',
+                                          [(self._dump(data), data_id) for (data_id, data) in dict.items(self)])
+
+    def __contains__(self, data_id):
+        if dict.__contains__(self, data_id):
+            return True
+        if self.database is None:
+            return False
+        with self.lock:
+            return dict.__contains__(self, data_id) or self.database.execute(
+                'SELECT 1 FROM objects WHERE id = ?', (data_id,)).fetchone() is not None
+
+    def __getitem__(self, data_id):
+        if self.database is None:
+            try:
+                return dict.__getitem__(self, data_id)
+            except KeyError:
+                # Unless the store just spilled
+                if self.database is None:
+                    raise
+        with self.lock:
+            if dict.__contains__(self, data_id):
+                data = dict.__getitem__(self, data_id)
             else:
-                self[data_id] = data
+                row = self.database.execute('SELECT data FROM objects WHERE id = ?', (data_id,)).fetchone()
+                if row is None:
+                    raise KeyError(data_id)
+                data = self._load(row[0])
+            self._cache(data_id, data)
+            return data
+
+    def get(self, data_id, default=None):
+        try:
+            return self[data_id]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        if self.database is None:
+            return dict.__len__(self)
+        return self.count
+
+    def __iter__(self):
+        return iter(self.keys())
 
-    def save(self, output_dir):
+    def _iter_rows(self):
+        # Read the database by batches so that objects can be written back while iterating (the objects in memory
+        # are written back first: they might leave the cache before their row is reached)
+        last_rowid = 0
+        while True:
+            with self.lock:
+                self.flush()
+                rows = self.database.execute('SELECT rowid, id, data FROM objects WHERE rowid > ? ORDER BY rowid '
+                                             'LIMIT ?', (last_rowid, self.BATCH_SIZE)).fetchall()
+            if not rows:
+                return
+            for (_, data_id, data_json) in rows:
+                yield data_id, data_json
+            last_rowid = rows[-1][0]
+
+    def keys(self):
+        if self.database is None:
+            return dict.keys(self)
+        return (data_id for (data_id, _) in self._iter_rows())
+
+    def items(self):
+        if self.database is None:
+            return dict.items(self)
+        return self._iter_items()
+
+    def _iter_items(self):
+        for (data_id, data_json) in self._iter_rows():
+            with self.lock:
+                data = dict.get(self, data_id)
+                if data is None:
+                    data = self._load(data_json)
+                self._cache(data_id, data)
+            yield data_id, data
+
+    def values(self):
+        if self.database is None:
+            return dict.values(self)
+        return (data for (_, data) in self._iter_items())
+
+    def clear(self):
+        with self.lock:
+            super(MergeStore, self).clear()
+            self.recent_ids.clear()
+            if self.database is not None:
+                self.database.close()
+                self.database = None
+                os.remove(os.path.join(self.spill_dir, self.entity_name + '.sqlite'))
+            self.count = 0
+
+    def save(self, output_dir, fingerprints=None):
+        """
+        Save the objects in a JSON file (one object per line) and add their content fingerprint by id in
+        `fingerprints` (if given)
+        """
         if len(self) <= 0:
             return
-        json_path = get_file_path([output_dir, self.entity_name], ext='.json', create=True)
+        json_path = get_file_path([output_dir, self.entity_name],
+                                  ext=get_compressed_path('.json', self.compression), create=True)
 
-        with open(json_path, 'w') as json_file:
-            for data in self.values():
+        if self.database is None:
+            objects = self.values()
+        else:
+            # Stream objects from the database (without going through the cache)
+            self.flush()
+            objects = (self._load(data_json) for (_, data_json) in self._iter_rows())
+
+        with open_file(json_path, 'w', self.compression_level) as json_file:
+            for data in objects:
                 if 'etl:detailed' in data:
                     del data['etl:detailed']
-                CustomJSONEncoder.dump(data, json_file)
-                json_file.write('\n')
+                # Link sets are saved as sorted lists
+                for (key, value) in data.items():
+                    if isinstance(value, set):
+                        data[key] = sorted(value, key=str)
+                if fingerprints is not None:
+                    fingerprints[data[self.entity_name + 'DbId']] = get_fingerprint(data)
+                dump_line(data, json_file)
+
+
+def get_change_set(previous_fingerprints, fingerprints):
+    """
+    Get the ids of the objects added, changed and removed from the content fingerprints by id of two extractions
+    """
+    return {
+        'added': sorted(fingerprints.keys() - previous_fingerprints.keys()),
+        'changed': sorted(data_id for (data_id, fingerprint) in fingerprints.items()
+                          if data_id in previous_fingerprints and previous_fingerprints[data_id] != fingerprint),
+        'removed': sorted(previous_fingerprints.keys() - fingerprints.keys()),
+    }
+
+
+def load_change_set(json_dir, entity_name):
+    """
+    Load the ids of the objects of an entity added, changed and removed since the previous extraction of a source
+    (None if unknown, ex: first extraction)
+    """
+    change_set_path = get_file_path([json_dir, 'changes', entity_name], ext='.json')
+    if not os.path.exists(change_set_path):
+        return None
+    with open(change_set_path, 'r') as change_set_file:
+        change_set = loads(change_set_file.read())
+    return {change: set(change_set[change]) for change in CHANGES}
 
 
 class JSONSplitStore(object):
     """
-    Store JSON in JSON files split by file size.
+    Store JSON in JSON files split by file size (size before compression with a `compression` codec).
     """
     DEFAULT_MAX_FILE_SIZE = 10000000
 
-    def __init__(self, output_dir, base_json_name, buffer_size=1000, max_file_byte_size=DEFAULT_MAX_FILE_SIZE):
+    def __init__(self, output_dir, base_json_name, buffer_size=1000, max_file_byte_size=DEFAULT_MAX_FILE_SIZE,
+                 compression=None, compression_level=DEFAULT_COMPRESSION_LEVEL):
         self.output_dir = output_dir
         self.base_json_name = base_json_name
+        self.compression = compression
+        self.compression_level = compression_level
         self.file_index = 0
+        self.file_size = 0
         self.json_file = self._new_file()
         self.max_file_byte_size = max_file_byte_size
         self.data_buffer = list()
@@ -111,19 +365,22 @@ class JSONSplitStore(object):
         json_path = None
         while not json_path or os.path.exists(json_path):
             self.file_index += 1
-            json_path = get_file_path([self.output_dir, self.base_json_name], ext="-" + str(self.file_index) + ".json")
+            json_path = get_file_path([self.output_dir, self.base_json_name],
+                                      ext=get_compressed_path("-" + str(self.file_index) + ".json", self.compression))
             if self.file_index > 1000000:
                 raise Exception('Max file index exceeded')
-        return open(json_path, 'a')
+        self.file_size = 0
+        return open_file(json_path, 'a', self.compression_level)
 
     def _should_switch_file(self):
-        return not self.json_file or self.json_file.tell() >= self.max_file_byte_size
+        return not self.json_file or self.file_size >= self.max_file_byte_size
 
     def flush(self):
         if self.data_buffer:
             for element in self.data_buffer:
-                CustomJSONEncoder.dump(element, self.json_file)
-                self.json_file.write('\n')
+                line = dumps(element) + '\n'
+                self.json_file.write(line)
+                self.file_size += len(line)
             self.data_buffer.clear()
             if self._should_switch_file():
                 if self.json_file:
@@ -150,3 +407,63 @@ class JSONSplitStore(object):
         self.data_buffer.extend(data)
         if len(self.data_buffer) >= self.buffer_size:
             self.flush()
+
+
+class ExtractionJournal(object):
+    """
+    Append-only JSON lines journal of the work completed while extracting a source (list pages, object details and
+    external object links) so that a failed extraction can be resumed without fetching it again.
+    """
+
+    def __init__(self, journal_path, resume=False):
+        self.journal_path = journal_path
+        self.pages = dict()
+        self.page_sizes = dict()
+        self.details = list()
+        self.links = dict()
+        if resume and os.path.exists(journal_path):
+            self._load()
+        self.lock = threading.Lock()
+        self.journal_file = open(journal_path, 'a' if resume else 'w')
+
+    def _load(self):
+        with open(self.journal_path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    record = loads(line)
+                except ValueError:
+                    # Last record might have been partially written when the extraction crashed
+                    continue
+                if record['type'] == 'page':
+                    self.pages[(record['call'], record['page'])] = (record['total-pages'], record['data'])
+                    self.page_sizes[record['call']] = record['page-size']
+                elif record['type'] == 'detail':
+                    self.details.append((record['entity'], record['data']))
+                elif record['type'] == 'link':
+                    self.links[tuple(record['key'])] = record['data']
+
+    def _record(self, record):
+        with self.lock:
+            dump_line(record, self.journal_file)
+            self.journal_file.flush()
+
+    def get_page(self, call_key, page):
+        return self.pages.get((call_key, page))
+
+    def get_page_size(self, call_key):
+        return self.page_sizes.get(call_key)
+
+    def record_page(self, call_key, page, page_size, total_pages, data):
+        self._record({'type': 'page', 'call': call_key, 'page': page, 'page-size': page_size,
+                      'total-pages': total_pages, 'data': data})
+
+    def record_detail(self, entity_name, data):
+        self._record({'type': 'detail', 'entity': entity_name, 'data': data})
+
+    def record_link(self, link_key, data):
+        self._record({'type': 'link', 'key': link_key, 'data': data})
+
+    def close(self, remove=False):
+        self.journal_file.close()
+        if remove:
+            os.remove(self.journal_path)
@@ -1,23 +1,48 @@
 
+import collections
+import ftplib
 import os
+import random
 import shutil
 import threading
+import time
 import traceback
 from copy import deepcopy
 
+import requests
 import urllib3
-import urllib.request
+import urllib.parse
 from multiprocessing.pool import ThreadPool
-import json
 
-from etl.common.brapi import BreedingAPIIterator, get_implemented_calls, get_implemented_call
-from etl.common.brapi import get_identifier
-from etl.common.store import MergeStore
+from etl.common.brapi import BreedingAPIIterator, BrapiSession, get_implemented_calls, get_implemented_call, \
+    DEFAULT_MAX_RETRIES, DEFAULT_MAX_RETRY_DELAY, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, PageSizeTuner, \
+    DEFAULT_MAX_PAGE_SIZE, DEFAULT_PAGE_SIZE_ERROR_TTL
+from etl.common.brapi import get_identifier, get_fingerprint, fetch_search_results, BrapiServerError, \
+    DEFAULT_SEARCH_POLL_INTERVAL, STREAM_CHUNK_SIZE
+from etl.common.cache import ResponseCache, DEFAULT_TTL
+from etl.common.json_stream import JSONLinesWriter, convert_json_file_to_lines
+from etl.common import json_codec
+from etl.common.compression import DEFAULT_COMPRESSION_LEVEL
+from etl.common.concurrency import AdaptiveLimiter, RequestBudget, WorkScheduler
+from etl.common.store import MergeStore, ExtractionJournal, JSONSplitStore, DEFAULT_HOT_CACHE_SIZE, CHANGES, \
+    get_change_set
 from etl.common.utils import get_folder_path, get_in, remove_falsey, create_logger, get_file_path, remove_none, \
-    as_list, remove_empty
+    as_list, remove_empty, join_url_path
 
 urllib3.disable_warnings()
 
+NB_THREADS = 10
+# Maximum number of pages of one list call fetched concurrently
+PAGE_CONCURRENCY = 4
+# Maximum number of calls in flight for all sources
+MAX_GLOBAL_CONCURRENCY = 40
+# Number of objects detailed by one bulk detail call
+DEFAULT_BULK_DETAIL_BATCH_SIZE = 100
+# Number of objects detailed to detect whether details add anything to the list objects
+DEFAULT_DETAIL_SAMPLE_SIZE = 10
+# Number of seconds the calls implemented by an endpoint are cached
+DEFAULT_CALLS_TTL = 7 * 86400
+
 
 class BrokenLink(Exception):
     pass
@@ -27,12 +52,18 @@ class EndPointError(Exception):
 
 
 def link_object(dest_entity_name, dest_object, src_object_id):
+    """
+    Add an object id in the link set of another object (ex: add a study id in `germplasm.studyDbIds`).
+    Link sets are kept as sets during the extraction (see `MergeStore.save`).
+    """
+    if not src_object_id:
+        return
     dest_object_ref = dest_entity_name + 'DbIds'
-    dest_object_ids = dest_object.get(dest_object_ref) or set()
+    dest_object_ids = dest_object.get(dest_object_ref)
     if not isinstance(dest_object_ids, set):
-        dest_object_ids = set(dest_object_ids)
+        dest_object_ids = set(remove_empty(as_list(dest_object_ids)) or [])
+        dest_object[dest_object_ref] = dest_object_ids
     dest_object_ids.add(src_object_id)
-    dest_object[dest_object_ref] = remove_empty(dest_object_ids)
 
 
 def link_objects(entity, object, linked_entity, linked_objects_by_id):
@@ -57,6 +88,24 @@ def link_objects(entity, object, linked_entity, linked_objects_by_id):
             linked_entity['store'].add(linked_object)
 
 
+def add_in_store(source_name, entity, data):
+    """
+    Add one BrAPI object in the entity MergeStore
+    """
+    if source_name == 'WUR' and entity['name'] == 'study':
+        data = dict(data, startDate=data['startDate'] + "-01-01")
+    entity['store'].add(data)
+
+
+def add_all_in_store(source_name, entities, results):
+    """
+    Collect fetch function results in the entity MergeStore
+    """
+    for (entity_name, data_list) in results:
+        for data in data_list:
+            add_in_store(source_name, entities[entity_name], data)
+
+
 def fetch_all_in_store(entities, fetch_function, arguments, pool):
     """
     Run a fetch function with arguments in a pool worker and collect results in the entity MergeStore
@@ -66,36 +115,51 @@ def fetch_all_in_store(entities, fetch_function, arguments, pool):
     if not results:
         return
 
-    for (entity_name, data_list) in results:
-        for data in data_list:
-            if source_name == 'WUR' and entity_name == 'study':
-                data['startDate'] = data['startDate'] + "-01-01"
-            entities[entity_name]['store'].add(data)
+    add_all_in_store(source_name, entities, results)
 
 
 def fetch_details(options):
     """
-    Fetch details call for a BrAPI object (ex: /brapi/v1/studies/{id})
+    Fetch details call for a BrAPI object (ex: /brapi/v1/studies/{id}) or for a batch of objects
+    (see `fetch_bulk_details`)
     """
     source, logger, entity, object_id = options
     if 'detail' not in entity:
         return
+    if isinstance(object_id, list):
+        return fetch_bulk_details(options)
+
+    detail_call = get_detail_call(source, entity, object_id)
+    if not detail_call:
+        return
+
+    details = BreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], detail_call, logger,
+                                            source.get('session'), group='detail').__next__()
+    return record_details(source, logger, entity, detail_call, details)
+
+
+def get_detail_call(source, entity, object_id):
+    """
+    Get the details call of a BrAPI object (None if it is not implemented or if the object needs no details)
+    """
     detail_call_group = entity['detail']
 
     in_store = object_id in entity['store']
     skip_if_in_store = detail_call_group.get('skip-if-in-store')
     already_detailed = get_in(entity['store'], [object_id, 'etl:detailed'])
     if in_store and (skip_if_in_store or already_detailed):
-        return
+        return None
 
-    entity_name = entity['name']
-    entity_id = entity_name + 'DbId'
-    detail_call = get_implemented_call(source, detail_call_group, {entity_id: object_id})
+    entity_id = entity['name'] + 'DbId'
+    return get_implemented_call(source, detail_call_group, {entity_id: object_id})
 
-    if not detail_call:
-        return
 
-    details = BreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], detail_call, logger).__next__()
+def record_details(source, logger, entity, detail_call, details):
+    """
+    Mark the details fetched for a BrAPI object and record them in the journal
+    """
+    entity_name = entity['name']
+    detail_call_group = entity['detail']
     details['etl:detailed'] = True
 
     # -----------------------------------------------------------------
@@ -106,25 +170,188 @@ def fetch_details(options):
     if 'data' in details and len(details['data']) == 1:
         details = details['data'][0]
     # -----------------------------------------------------------------
-    
+
+    if source.get('journal'):
+        source['journal'].record_detail(entity_name, details)
     return entity_name, [details]
 
 
-def fetch_all_details(source, logger, entities, pool):
+def fetch_bulk_details(options):
+    """
+    Fetch details of a batch of BrAPI objects with one search call (ex: POST /brapi/v1/germplasm-search or
+    POST /brapi/v2/search/germplasm with the object ids in the "ids-param").
+    Objects missing from the search results (or all objects if the search fails) are detailed one by one.
+    """
+    source, logger, entity, object_ids = options
+    entity_name = entity['name']
+    bulk_call, poll_interval = get_bulk_detail_call(source, entity, object_ids)
+
+    details_by_id = dict()
+    try:
+        for details in fetch_search_results(source['brapi:endpointUrl'], bulk_call, logger, source.get('session'),
+                                            group='detail', poll_interval=poll_interval):
+            details['etl:detailed'] = True
+            details_by_id[get_identifier(entity_name, details)] = details
+    except (BrapiServerError, requests.RequestException) as error:
+        logger.warning("Could not fetch {} details in bulk ({}), fetching them one by one.".format(entity_name, error))
+        details_by_id = dict()
+
+    details_list = record_bulk_details(source, entity, object_ids, details_by_id)
+    for object_id in object_ids:
+        if object_id not in details_by_id:
+            result = fetch_details((source, logger, entity, object_id))
+            if result:
+                details_list.extend(result[1])
+    return entity_name, details_list
+
+
+def get_bulk_detail_call(source, entity, object_ids):
+    """
+    Get the search call detailing a batch of BrAPI objects and the interval at which its results are polled
+    """
+    bulk_detail_call_group = entity['bulk-detail']
+    bulk_call = get_implemented_call(source, bulk_detail_call_group)
+    bulk_call['param'] = dict(bulk_call.get('param') or {}, **{bulk_detail_call_group['ids-param']: object_ids})
+    return bulk_call, bulk_detail_call_group.get('poll-interval', DEFAULT_SEARCH_POLL_INTERVAL)
+
+
+def record_bulk_details(source, entity, object_ids, details_by_id):
+    """
+    List the details found by a bulk detail call (in the order of the object ids) and record them in the journal
+    """
+    details_list = list()
+    for object_id in object_ids:
+        if object_id in details_by_id:
+            details = details_by_id[object_id]
+            if source.get('journal'):
+                source['journal'].record_detail(entity['name'], details)
+            details_list.append(details)
+    return details_list
+
+
+def replay_details(source, entities):
+    """
+    Add the object details recorded in the journal of a previous extraction in the entity MergeStore
+    """
+    journal = source.get('journal')
+    if journal and journal.details:
+        add_all_in_store(source['schema:identifier'], entities,
+                         [(entity_name, [data]) for (entity_name, data) in journal.details])
+
+
+def get_detail_sample_arguments(source, logger, entities):
     """
-    Fetch all details for each object of each entity
+    List the detail calls of a random sample of listed objects for each entity
+    (see "sample-size" in the detail call group, 0 to always fetch details)
     """
     args = list()
     for (entity_name, entity) in entities.items():
-        for (_, object) in entity['store'].items():
-            object_id = get_identifier(entity_name, object)
+        if 'list' not in entity or 'detail' not in entity or entity['detail'].get('skip-if-in-store'):
+            continue
+        sample_size = entity['detail'].get('sample-size', DEFAULT_DETAIL_SAMPLE_SIZE)
+        store = entity['store']
+        object_ids = [object_id for object_id in store.keys() if not get_in(store, [object_id, 'etl:detailed'])]
+        # Not worth sampling small entities
+        if sample_size <= 0 or len(object_ids) <= sample_size * 2:
+            continue
+        for object_id in random.sample(object_ids, sample_size):
             args.append((source, logger, entity, object_id))
-    fetch_all_in_store(entities, fetch_details, args, pool)
+    return args
+
+
+def check_redundant_details(source, logger, entities, results):
+    """
+    Compare the details of the sampled objects (see `get_detail_sample_arguments`) with their list payloads and add
+    them in the entity MergeStore.
+    Return the names of the entities for which the details add nothing to the list payloads.
+    """
+    redundant_entity_names = set()
+    details_by_entity = collections.defaultdict(list)
+    for (entity_name, details_list) in remove_empty(results) or []:
+        details_by_entity[entity_name].extend(details_list)
+
+    for (entity_name, details_list) in details_by_entity.items():
+        store = entities[entity_name]['store']
+        redundant = all(store.is_redundant({key: value for (key, value) in details.items() if key != 'etl:detailed'})
+                        for details in details_list)
+        if redundant:
+            redundant_entity_names.add(entity_name)
+            logger.info("Skipping {} details: {} sampled details add nothing to the list objects."
+                        .format(entity_name, len(details_list)))
+        else:
+            logger.debug("Fetching {} details: sampled details differ from the list objects.".format(entity_name))
+
+    add_all_in_store(source['schema:identifier'], entities, details_by_entity.items())
+    return redundant_entity_names
+
+
+def detect_redundant_details(source, logger, entities, pool):
+    """
+    Detect the entities for which detail calls are redundant with list calls from a sample of objects
+    """
+    args = get_detail_sample_arguments(source, logger, entities)
+    if not args:
+        return set()
+    return check_redundant_details(source, logger, entities, list(pool.imap_unordered(fetch_details, args)))
+
+
+def get_detail_arguments(source, logger, entities, object_ids_by_entity=None, skip_entity_names=()):
+    """
+    List the detail calls to fetch for each object of each entity (or only for the given object ids by entity).
+    Objects of entities with an implemented "bulk-detail" call are detailed by batches of ids.
+    """
+    args = list()
+    for (entity_name, entity) in entities.items():
+        if 'detail' not in entity or entity['detail'].get('skip-if-in-store') or entity_name in skip_entity_names:
+            continue
+        store = entity['store']
+        if object_ids_by_entity is None:
+            object_ids = store.keys()
+        else:
+            object_ids = [object_id for object_id in object_ids_by_entity.get(entity_name, []) if object_id in store]
+        object_ids = [object_id for object_id in object_ids if not get_in(store, [object_id, 'etl:detailed'])]
+
+        bulk_detail_call_group = entity.get('bulk-detail')
+        if bulk_detail_call_group and get_implemented_call(source, bulk_detail_call_group):
+            batch_size = bulk_detail_call_group.get('batch-size', DEFAULT_BULK_DETAIL_BATCH_SIZE)
+            for start in range(0, len(object_ids), batch_size):
+                args.append((source, logger, entity, object_ids[start:start + batch_size]))
+        else:
+            for object_id in object_ids:
+                args.append((source, logger, entity, object_id))
+    return args
+
+
+def fetch_all_details(source, logger, entities, pool, object_ids_by_entity=None, skip_entity_names=()):
+    """
+    Fetch all details for each object of each entity (or only for the given object ids by entity)
+    """
+    args = get_detail_arguments(source, logger, entities, object_ids_by_entity, skip_entity_names)
+    if args:
+        fetch_all_in_store(entities, fetch_details, args, pool)
+
+
+def end_phase(logger, entities, phase):
+    """
+    Log how many objects of each entity were added or changed during an extraction phase and start tracking the
+    changes of the next phase.
+    Return the ids of the objects added or changed by entity.
+    """
+    dirty_ids_by_entity = dict()
+    for (entity_name, entity) in entities.items():
+        dirty_ids = entity['store'].reset_dirty()
+        if dirty_ids:
+            logger.info("{}: {} of {} {} objects added or changed.".format(
+                phase, len(dirty_ids), len(entity['store']), entity_name))
+        dirty_ids_by_entity[entity_name] = dirty_ids
+    return dirty_ids_by_entity
 
 
 def list_object(options):
     """
-    Fetch list for one entity (studies-search, germplasm-search, etc.)
+    Fetch list for one entity (studies-search, germplasm-search, etc.) and add the objects in the entity MergeStore
+    as they are received.
+    With "stream-parse" in the list call group, the objects of each page are parsed while the page is read.
     """
     source, logger, entity = options
     if 'list' not in entity:
@@ -134,21 +361,185 @@ def list_object(options):
     if call is None:
         return
 
-    data_list = list(BreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], call, logger))
-    return entity['name'], data_list
+    data_list = BreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], call, logger, source.get('session'),
+                                              concurrency=PAGE_CONCURRENCY, ordered=False,
+                                              journal=source.get('journal'), group='list',
+                                              stream=entity['list'].get('stream-parse', False))
+    for data in data_list:
+        add_in_store(source['schema:identifier'], entity, data)
+
+
+def get_list_arguments(source, logger, entities):
+    args = list()
+    for (entity_name, entity) in entities.items():
+        # Streamed entities are listed separately (see `stream_entity`)
+        if entity.get('stream'):
+            continue
+        args.append((source, logger, entity))
+    return args
 
 
 def fetch_all_list(source, logger, entities, pool):
     """
     Fetch entities list for all entities
     """
+    args = get_list_arguments(source, logger, entities)
+    fetch_all_in_store(entities, list_object, args, pool)
+
+
+def stream_entity(source, logger, entity, entities, output_dir):
+    """
+    Fetch the list of a high-volume entity (with "stream": true, ex: observationUnit) and write its objects straight
+    to JSON files split by size (see `EntityStream`)
+    """
+    call = get_implemented_call(source, entity['list'])
+    if call is None:
+        return
+
+    data_list = BreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], call, logger, source.get('session'),
+                                              concurrency=PAGE_CONCURRENCY, ordered=False, group='list',
+                                              stream=entity['list'].get('stream-parse', False))
+    with EntityStream(source, logger, entity, entities, output_dir) as entity_stream:
+        for data in data_list:
+            entity_stream.dump(data)
+
+
+class EntityStream(object):
+    """
+    Write the objects of a high-volume entity straight to JSON files split by size (see `JSONSplitStore`) without
+    merging them by id.
+    Internal links of the streamed objects are checked against the set of ids of the linked entity objects: linked
+    objects missing from the stores are added with their id and name (as in `fetch_all_links`) but the streamed
+    object ids are not added to the linked objects.
+    """
+
+    def __init__(self, source, logger, entity, entities, output_dir):
+        self.source_name = source['schema:identifier']
+        self.logger = logger
+        self.entity = entity
+        self.entities = entities
+        self.links = [link for link in entity.get('links') or []
+                      if link['type'] == 'internal' and link['entity'] in entities
+                      and not entities[link['entity']].get('stream')]
+        # Compact sets of the linked object ids (instead of the linked objects)
+        self.link_ids_by_entity = {link['entity']: set(map(str, entities[link['entity']]['store'].keys()))
+                                   for link in self.links}
+        self.split_store = JSONSplitStore(output_dir, entity['name'], compression=entity['store'].compression,
+                                          compression_level=entity['store'].compression_level)
+        # Content fingerprints of the streamed objects (see `save_change_sets`)
+        entity['fingerprints'] = self.fingerprints = dict()
+        self.object_count = 0
+        self.missing_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, *_):
+        self.split_store.close()
+        if error_type is None:
+            self.logger.info("Streamed {} {} objects to {} files ({} linked objects added by id)."
+                             .format(self.object_count, self.entity['name'], self.split_store.file_index,
+                                     self.missing_count))
+
+    def dump(self, data):
+        entity_name = self.entity['name']
+        data = remove_empty(data)
+        if not data:
+            return
+        data['source'] = self.source_name
+        object_id = get_identifier(entity_name, data)
+
+        for link in self.links:
+            linked_entity = self.entities[link['entity']]
+            link_id_field = linked_entity['name'] + 'DbId'
+            link_name_field = linked_entity['name'] + 'Name'
+            link_ids = self.link_ids_by_entity[link['entity']]
+
+            link_path = link['json-path']
+            link_values = remove_none(as_list(get_in(data, remove_empty(link_path.split('.')))))
+            if not link_values:
+                if link.get('required'):
+                    raise BrokenLink("Could not find required field '{}' in {} object id '{}'"
+                                     .format(link_path, entity_name, object_id))
+                continue
+
+            for link_value in link_values:
+                link_id = link_value.get(link_id_field)
+                if not link_id:
+                    continue
+                link_id = str(link_id)
+                if link_id not in link_ids:
+                    linked_entity['store'].add({link_id_field: link_id,
+                                                link_name_field: link_value.get(link_name_field)})
+                    link_ids.add(link_id)
+                    self.missing_count += 1
+                link_object(linked_entity['name'], data, link_id)
+
+        # Link sets are saved as sorted lists (as in `MergeStore.save`)
+        for (key, value) in data.items():
+            if isinstance(value, set):
+                data[key] = sorted(value, key=str)
+        self.fingerprints[data[entity_name + 'DbId']] = get_fingerprint(data)
+        self.split_store.dump(data)
+        self.object_count += 1
+
+
+def stream_all_entities(source, logger, entities, output_dir):
+    """
+    Stream the objects of each entity with "stream": true to files (see `stream_entity`)
+    """
+    for (entity_name, entity) in entities.items():
+        if entity.get('stream') and 'list' in entity:
+            stream_entity(source, logger, entity, entities, output_dir)
+
+
+def fetch_link_values(options):
+    """
+    Fetch objects linked to a BrAPI object through a dedicated call (ex: /brapi/v1/studies/{id}/germplasm)
+    """
+    source, logger, link_key, call = options
+    link_values = list(BreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], call, logger,
+                                                     source.get('session'), group='link'))
+    if source.get('journal'):
+        source['journal'].record_link(link_key, link_values)
+    return link_key, link_values
+
+
+def get_external_link_arguments(source, logger, entities, link_values_by_key=None):
+    """
+    List the external object link calls to fetch for each object of each entity
+    (skipping the links which values are already in `link_values_by_key`)
+    """
+    link_values_by_key = link_values_by_key or dict()
     args = list()
     for (entity_name, entity) in entities.items():
-        args.append((source, logger, entity))
-    fetch_all_in_store(entities, list_object, args, pool)
+        for (link_index, link) in enumerate(entity.get('links') or []):
+            if link['type'] != 'external-object':
+                continue
+            for (object_id, object) in entity['store'].items():
+                link_key = (entity_name, link_index, object_id)
+                if link_key in link_values_by_key:
+                    continue
+                call = get_implemented_call(source, link, context=object)
+                if call:
+                    args.append((source, logger, link_key, call))
+    return args
 
 
-def fetch_all_links(source, logger, entities):
+def fetch_all_link_values(source, logger, entities, pool):
+    """
+    Fetch external object link values for each object of each entity in pool workers
+    (link values fetched by a previous extraction are read from the journal)
+    """
+    link_values_by_key = dict(source['journal'].links) if source.get('journal') else dict()
+    args = get_external_link_arguments(source, logger, entities, link_values_by_key)
+    if args:
+        logger.info("Fetching {} external object links...".format(len(args)))
+        link_values_by_key.update(pool.imap_unordered(fetch_link_values, args))
+    return link_values_by_key
+
+
+def fetch_all_links(source, logger, entities, link_values_by_key=None, fetch_function=fetch_link_values):
     """
     Link objects across entities.
      - Internal: link an object (ex: study) to another using an identifier inside the JSON object
@@ -157,12 +548,17 @@ def fetch_all_links(source, logger, entities):
       (ex: link a location via study.location.locationDbId)
      - External object: link an object (ex: study) to another using a dedicated call
       (ex: link to observation variables via /brapi/v1/studies/{id}/observationVariables)
+
+    External object link values already fetched can be given in `link_values_by_key`
+    (see `fetch_all_link_values`), the others are fetched here one by one (with `fetch_function`).
+    Objects are linked on the calling thread only.
     """
+    link_values_by_key = link_values_by_key or dict()
     for (entity_name, entity) in entities.items():
         if 'links' not in entity:
             continue
 
-        for link in entity['links']:
+        for (link_index, link) in enumerate(entity['links']):
             for (object_id, object) in entity['store'].items():
                 linked_entity_name = link['entity']
                 linked_entity = entities[linked_entity_name]
@@ -194,11 +590,15 @@ def fetch_all_links(source, logger, entities):
                                 linked_objects_by_id[link_id] = {link_id_field: link_id, link_name_field: link_name}
 
                 elif link['type'] == 'external-object':
-                    call = get_implemented_call(source, link, context=object)
-                    if not call:
-                        continue
+                    link_key = (entity_name, link_index, object_id)
+                    if link_key in link_values_by_key:
+                        link_values = link_values_by_key[link_key]
+                    else:
+                        call = get_implemented_call(source, link, context=object)
+                        if not call:
+                            continue
+                        _, link_values = fetch_function((source, logger, link_key, call))
 
-                    link_values = list(BreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], call, logger))
                     for link_value in link_values:
                         link_id = get_identifier(linked_entity_name, link_value)
                         linked_objects_by_id[link_id] = link_value
@@ -225,83 +625,492 @@ def remove_internal_objects(entities):
                     del link_context[last]
 
 
-def extract_source(source, entities, config, output_dir):
+def get_http_config(config):
+    return config.get('extract-brapi', {}).get('http', {})
+
+
+def get_store_config(config):
+    return config.get('extract-brapi', {}).get('store', {})
+
+
+def get_http_option(source, config, option, default):
+    """
+    Get an HTTP option from the source configuration (ex: 'etl:max-concurrency') or the extraction configuration
+    """
+    return source.get('etl:' + option, get_http_config(config).get(option, default))
+
+
+def get_source_state_dir(config, source_name):
+    """
+    Directory persisting the extraction state of a source from one run to the next
+    """
+    return get_folder_path([config['data-dir'], 'extract-state', source_name], create=True)
+
+
+def load_source_state(config, source_name, state_name):
+    """
+    Load a JSON extraction state persisted by a previous run (None if there is none)
+    """
+    state_path = get_file_path([get_source_state_dir(config, source_name), state_name], ext='.json')
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, 'r') as state_file:
+        return json_codec.loads(state_file.read())
+
+
+def save_source_state(config, source_name, state_name, state):
+    state_path = get_file_path([get_source_state_dir(config, source_name), state_name], ext='.json')
+    with open(state_path + '.tmp', 'w') as state_file:
+        state_file.write(json_codec.dumps(state))
+    os.replace(state_path + '.tmp', state_path)
+
+
+def fetch_implemented_calls(source, logger, config):
+    """
+    Get the calls implemented by a BrAPI endpoint from the cache of a previous extraction (if younger than the
+    'calls-ttl' and not refreshed with --refresh-calls) or from its /calls (the expired cache is used if it fails)
+    """
+    implemented_calls, cached_calls = load_implemented_calls(source, logger, config)
+    if implemented_calls is not None:
+        return implemented_calls
+
+    try:
+        implemented_calls = get_implemented_calls(source, logger, source.get('session'))
+    except (BrapiServerError, requests.RequestException) as error:
+        return get_expired_implemented_calls(source, logger, cached_calls, error)
+    return save_implemented_calls(source, logger, config, implemented_calls)
+
+
+def load_implemented_calls(source, logger, config):
+    """
+    Load the calls implemented by a BrAPI endpoint cached by a previous extraction.
+    Return the implemented calls (None if they should be fetched again) and the cache (None if there is none).
+    """
+    source_name = source['schema:identifier']
+    cached_calls = load_source_state(config, source_name, 'calls')
+    if cached_calls and cached_calls['url'] != source['brapi:endpointUrl']:
+        cached_calls = None
+    if cached_calls and not config['options'].get('refresh_calls'):
+        age = time.time() - cached_calls['time']
+        if age < get_http_option(source, config, 'calls-ttl', DEFAULT_CALLS_TTL):
+            logger.info("Using {} implemented calls of BrAPI {} cached {:.1f} hours ago."
+                        .format(len(cached_calls['calls']), source_name, age / 3600))
+            return set(cached_calls['calls']), cached_calls
+    return None, cached_calls
+
+
+def get_expired_implemented_calls(source, logger, cached_calls, error):
+    """
+    Get the calls implemented by a BrAPI endpoint from an expired cache when its /calls failed (raise the error if
+    there is no cache)
+    """
+    if not cached_calls:
+        raise error
+    logger.warning("Could not fetch implemented calls of BrAPI {} ({}), using the expired cache."
+                   .format(source['schema:identifier'], error))
+    return set(cached_calls['calls'])
+
+
+def save_implemented_calls(source, logger, config, implemented_calls):
+    source_name = source['schema:identifier']
+    logger.info("Fetched {} implemented calls of BrAPI {} from /calls.".format(len(implemented_calls), source_name))
+    save_source_state(config, source_name, 'calls', {'url': source['brapi:endpointUrl'], 'time': time.time(),
+                                                     'calls': sorted(implemented_calls)})
+    return implemented_calls
+
+
+def init_source_extraction(source, entities, config, budget=None, session_factory=BrapiSession):
     """
-    Full JSON BrAPI source extraction process
+    Create the source extraction logger, HTTP session (created by `session_factory`, sending its requests within the
+    global `budget` if any) and JSON merge stores
     """
     source_name = source['schema:identifier']
     action = 'extract-' + source_name
     log_file = get_file_path([config['log-dir'], action], ext='.log', recreate=True)
     logger = create_logger(action, log_file, config['options']['verbose'])
-    pool = ThreadPool(10)
+
+    cache = None
+    if config['options'].get('http_cache'):
+        cache_dir = get_folder_path([get_source_state_dir(config, source_name), 'http-cache'], create=True)
+        cache = ResponseCache(cache_dir, ttl=get_http_config(config).get('cache-ttl', DEFAULT_TTL))
+
+    # Requests in flight adapting to the server capacity (between the source min and max concurrency)
+    max_concurrency = get_http_option(source, config, 'max-concurrency', NB_THREADS)
+    limiter = AdaptiveLimiter(max_concurrency, get_http_option(source, config, 'min-concurrency', 1))
+
+    # One pooled keep-alive HTTP session for all the calls to this source
+    # (sized for the list calls fetching their pages concurrently)
+    source['session'] = session_factory(
+        pool_size=max_concurrency * PAGE_CONCURRENCY, cache=cache, limiter=limiter,
+        max_retries=get_http_option(source, config, 'max-retries', DEFAULT_MAX_RETRIES),
+        max_retry_delay=get_http_option(source, config, 'max-retry-delay', DEFAULT_MAX_RETRY_DELAY),
+        timeout=(get_http_option(source, config, 'connect-timeout', DEFAULT_CONNECT_TIMEOUT),
+                 get_http_option(source, config, 'read-timeout', DEFAULT_READ_TIMEOUT)),
+        hedge_percentile=get_http_option(source, config, 'hedge-percentile', None),
+        hedge_min_samples=get_http_option(source, config, 'hedge-min-samples', 20),
+        max_hedge_ratio=get_http_option(source, config, 'max-hedge-ratio', 0.1),
+        page_size_tuner=PageSizeTuner(load_source_state(config, source_name, 'page-sizes'),
+                                      max_size=get_http_option(source, config, 'max-page-size', DEFAULT_MAX_PAGE_SIZE),
+                                      error_ttl=get_http_option(source, config, 'page-size-error-ttl',
+                                                                DEFAULT_PAGE_SIZE_ERROR_TTL)),
+        budget=budget
+    )
+
+    # Journal of the completed work (to resume the extraction in case of failure)
+    journal_path = get_file_path([get_source_state_dir(config, source_name), 'journal'], ext='.jsonl')
+    source['journal'] = ExtractionJournal(journal_path, resume=config['options'].get('resume'))
+    if config['options'].get('resume'):
+        journal = source['journal']
+        logger.info("Resuming BrAPI {} extraction from journal: {} list pages, {} details and {} links already "
+                    "fetched.".format(source_name, len(journal.pages), len(journal.details), len(journal.links)))
+
+    # Stores spill to disk above a number of objects (and can save compressed JSON files)
+    store_config = get_store_config(config)
+    spill_dir = os.path.join(get_source_state_dir(config, source_name), 'spill')
+    for (entity_name, entity) in entities.items():
+        entity['store'] = MergeStore(source['schema:identifier'], entity['name'],
+                                     spill_threshold=store_config.get('spill-threshold'), spill_dir=spill_dir,
+                                     hot_cache_size=store_config.get('hot-cache-size', DEFAULT_HOT_CACHE_SIZE),
+                                     compression=store_config.get('compression'),
+                                     compression_level=store_config.get('compression-level',
+                                                                        DEFAULT_COMPRESSION_LEVEL))
+    return logger, log_file
+
+
+def end_source_extraction(source, entities, config, logger, log_file, output_dir, error=None):
+    """
+    Log the source extraction result and save the JSON merge stores (in a '-failed' directory on error)
+    """
+    source_name = source['schema:identifier']
+    if error:
+        logger.debug(error)
+        # Keep the objects already streamed to files (see `stream_entity`) with the failed extraction data
+        failed_output_dir = output_dir + '-failed'
+        if os.path.exists(failed_output_dir):
+            shutil.rmtree(failed_output_dir)
+        os.rename(output_dir, failed_output_dir)
+        output_dir = failed_output_dir
+        logger.info("FAILED Extracting BrAPI {}.\n"
+                    "=> Check the logs ({}) and data ({}) for more details."
+                    .format(source_name, log_file, output_dir))
+    else:
+        logger.info("SUCCEEDED Extracting BrAPI {}.".format(source_name))
+
+    logger.info("HTTP connections for BrAPI {}: {connections} opened for {requests} requests ({reused} reused)."
+                .format(source_name, **source['session'].get_connection_stats()))
+    limiter = source['session'].limiter
+    logger.info("HTTP concurrency for BrAPI {}: limit {:.0f} (max {}), {} overloaded responses, {} retries."
+                .format(source_name, limiter.limit, limiter.max_limit, limiter.stats['overloaded'],
+                        source['session'].retry_count))
+    for (group, stats) in sorted(source['session'].transfer_stats.items()):
+        logger.info("HTTP transfer for BrAPI {} {} calls: {} requests, {:.1f} MB on the wire, {:.1f} MB decoded."
+                    .format(source_name, group, stats['requests'], stats['wire'] / 1e6, stats['decoded'] / 1e6))
+    for (endpoint, (count, p50, p99)) in sorted(source['session'].latency.get_stats().items()):
+        logger.info("HTTP latency for BrAPI {} {}: {} calls, p50 {:.3f}s, p99 {:.3f}s."
+                    .format(source_name, endpoint, count, p50, p99))
+    if source['session'].hedge_percentile:
+        logger.info("HTTP hedged requests for BrAPI {}: {sent} sent, {won} answered first."
+                    .format(source_name, **source['session'].hedge_stats))
+    page_size_state = source['session'].page_size_tuner.get_state()
+    if page_size_state['sizes']:
+        logger.info("Learned page sizes for BrAPI {}: {}.".format(
+            source_name, ', '.join('{} {}'.format(endpoint, size)
+                                   for (endpoint, size) in sorted(page_size_state['sizes'].items()))))
+        save_source_state(config, source_name, 'page-sizes', page_size_state)
+    if source['session'].cache:
+        logger.info("HTTP cache for BrAPI {}: {hit} hits, {revalidated} revalidated, {miss} misses."
+                    .format(source_name, **source['session'].cache.stats))
+    source['session'].close()
+    # The journal is only kept for a failed extraction to be resumed
+    source['journal'].close(remove=not error)
+
+    # Save to file
+    logger.info("Saving BrAPI {} to '{}'...".format(source_name, output_dir))
+    fingerprints_by_entity = dict()
+    for (entity_name, entity) in entities.items():
+        if entity['store'].database is not None:
+            logger.info("{} {} objects spilled to disk.".format(len(entity['store']), entity_name))
+        fingerprints_by_entity[entity_name] = entity.pop('fingerprints', None) or dict()
+        entity['store'].save(output_dir, fingerprints_by_entity[entity_name])
+        entity['store'].clear()
+
+    if not error:
+        save_change_sets(source, logger, config, output_dir, fingerprints_by_entity)
+
+
+def save_change_sets(source, logger, config, output_dir, fingerprints_by_entity):
+    """
+    Compare the content fingerprints of the extracted objects with those of the previous extraction and save the ids
+    of the objects added, changed and removed of each entity in '<output_dir>/changes/<entity>.json'
+    (see `etl.common.store.load_change_set`).
+    The fingerprints are kept for the next extraction.
+    """
+    source_name = source['schema:identifier']
+    previous_fingerprints_by_entity = load_source_state(config, source_name, 'fingerprints') or dict()
+    for (entity_name, fingerprints) in fingerprints_by_entity.items():
+        previous_fingerprints = previous_fingerprints_by_entity.get(entity_name)
+        if previous_fingerprints is None:
+            # First extraction of this entity
+            continue
+        change_set = get_change_set(previous_fingerprints, fingerprints)
+        change_set_path = get_file_path([output_dir, 'changes', entity_name], ext='.json', create=True)
+        with open(change_set_path, 'w') as change_set_file:
+            change_set_file.write(json_codec.dumps(change_set))
+        if any(change_set.values()):
+            logger.info("{} changes since the previous extraction of BrAPI {}: {} added, {} changed, {} removed."
+                        .format(entity_name, source_name, *map(len, (change_set[change] for change in CHANGES))))
+    save_source_state(config, source_name, 'fingerprints', fingerprints_by_entity)
+
+
+def extract_source(source, entities, config, output_dir, scheduler=None, budget=None):
+    """
+    Full JSON BrAPI source extraction process.
+    The calls are run on the workers of the given `scheduler` (see `WorkScheduler`, shared with other sources) or on
+    a dedicated thread pool, and the requests are sent within the global `budget` (see `RequestBudget`) if any.
+    """
+    source_name = source['schema:identifier']
+    logger, log_file = init_source_extraction(source, entities, config, budget)
+    limiter = source['session'].limiter
+    if scheduler:
+        pool = scheduler.get_pool(urllib.parse.urlparse(source['brapi:endpointUrl']).netloc, limiter)
+    else:
+        pool = ThreadPool(limiter.max_limit)
 
     logger.info("Extracting BrAPI {}...".format(source_name))
+    error = None
     try:
-        # Initialize JSON merge stores
-        for (entity_name, entity) in entities.items():
-            entity['store'] = MergeStore(source['schema:identifier'], entity['name'])
-
         # Fetch server implemented calls
         if 'implemented-calls' not in source:
-            source['implemented-calls'] = get_implemented_calls(source, logger)
+            source['implemented-calls'] = fetch_implemented_calls(source, logger, config)
 
         # Fetch entities lists
         fetch_all_list(source, logger, entities, pool)
+        end_phase(logger, entities, 'List')
 
         # Detail entities
-        fetch_all_details(source, logger, entities, pool)
+        replay_details(source, entities)
+        redundant_entity_names = detect_redundant_details(source, logger, entities, pool)
+        fetch_all_details(source, logger, entities, pool, skip_entity_names=redundant_entity_names)
+        end_phase(logger, entities, 'Details')
 
-        # Link entities (internal links, internal object links and external object links)
-        fetch_all_links(source, logger, entities)
+        # Stream high-volume entities to files (linked objects missing from the stores are linked and detailed next)
+        stream_all_entities(source, logger, entities, output_dir)
 
-        # Detail entities (for object that might have been discovered by links)
-        fetch_all_details(source, logger, entities, pool)
+        # Link entities (internal links, internal object links and external object links fetched concurrently)
+        link_values_by_key = fetch_all_link_values(source, logger, entities, pool)
+        fetch_all_links(source, logger, entities, link_values_by_key)
+        linked_ids_by_entity = end_phase(logger, entities, 'Links')
 
-        remove_internal_objects(entities)
+        # Detail entities (only for objects that might have been discovered by links)
+        fetch_all_details(source, logger, entities, pool, linked_ids_by_entity)
+        end_phase(logger, entities, 'Linked object details')
 
-        logger.info("SUCCEEDED Extracting BrAPI {}.".format(source_name))
+        remove_internal_objects(entities)
     except:
-        logger.debug(traceback.format_exc())
-        shutil.rmtree(output_dir)
-        output_dir = output_dir + '-failed'
-        logger.info("FAILED Extracting BrAPI {}.\n"
-                    "=> Check the logs ({}) and data ({}) for more details."
-                    .format(source_name, log_file, output_dir))
-    pool.close()
+        error = traceback.format_exc()
+    # Cancel the pending calls and wait for the running ones (still adding objects in the stores) before saving
+    pool.terminate()
+    pool.join()
 
-    # Save to file
-    logger.info("Saving BrAPI {} to '{}'...".format(source_name, output_dir))
-    for (entity_name, entity) in entities.items():
-        entity['store'].save(output_dir)
-        entity['store'].clear()
+    end_source_extraction(source, entities, config, logger, log_file, output_dir, error)
 
 
-def extract_statics_files(source, output_dir, entities, config):
+def is_same_remote_file(remote, other):
+    """
+    Tell if two remote file descriptions (url, size, ETag and modification date) are of the same file version
+    """
+    if not remote or not other or remote['url'] != other['url'] or remote.get('size') != other.get('size'):
+        return False
+    if remote.get('etag') and other.get('etag'):
+        return remote['etag'] == other['etag']
+    if remote.get('modified') and other.get('modified'):
+        return remote['modified'] == other['modified']
+    return False
 
+
+def download_http_file(url, part_path, previous, on_start, timeout):
+    """
+    Download a file over HTTP in `part_path`, resuming a partial download of the same file version (Range request)
+    and skipping the download if the previously downloaded file is unchanged (conditional request).
+    Return the remote file description and the offset the download was resumed at (None if not downloaded).
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    # Ranges are offsets in the file bytes (not in the compressed response)
+    headers = {'Accept-Encoding': 'identity'}
+    if previous and previous.get('complete'):
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('modified'):
+            headers['If-Modified-Since'] = previous['modified']
+    elif previous and offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        if previous.get('etag') or previous.get('modified'):
+            headers['If-Range'] = previous.get('etag') or previous.get('modified')
+
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            return previous, None
+        restart = response.status_code == 416 and 'Range' in headers
+        if restart:
+            # Nothing to download past the partial download: complete if it has the file size (bytes */<size>)
+            size = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if size.isdigit() and int(size) == offset:
+                return dict(previous, size=offset), offset
+        else:
+            response.raise_for_status()
+            remote = {'url': url, 'etag': response.headers.get('ETag'),
+                      'modified': response.headers.get('Last-Modified')}
+            if response.status_code == 206:
+                remote['size'] = int(response.headers['Content-Range'].rpartition('/')[2])
+            else:
+                offset = 0
+                content_length = response.headers.get('Content-Length')
+                remote['size'] = int(content_length) if content_length else None
+            # Server ignoring conditional requests
+            if previous and previous.get('complete') and is_same_remote_file(previous, remote):
+                return previous, None
+
+            on_chunk = on_start(remote, offset)
+            with open(part_path, 'ab' if offset else 'wb') as part_file:
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    part_file.write(chunk)
+                    if on_chunk:
+                        on_chunk(chunk)
+    if restart:
+        # The partial download does not match the remote file: download it again from the start
+        os.remove(part_path)
+        return download_http_file(url, part_path, None, on_start, timeout)
+    return remote, offset
+
+
+def download_ftp_file(url, part_path, previous, on_start, timeout):
+    """
+    Download a file over FTP in `part_path`, resuming a partial download of the same file version (REST command)
+    and skipping the download if the previously downloaded file is unchanged (same size and modification date).
+    Return the remote file description and the offset the download was resumed at (None if not downloaded).
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    with ftplib.FTP(parsed_url.hostname, timeout=timeout) as ftp:
+        ftp.login(parsed_url.username or 'anonymous', parsed_url.password or '')
+        ftp.voidcmd('TYPE I')
+        remote = {'url': url, 'size': ftp.size(parsed_url.path)}
+        try:
+            remote['modified'] = ftp.voidcmd('MDTM ' + parsed_url.path)[4:].strip()
+        except ftplib.error_perm:
+            pass
+        if previous and previous.get('complete') and is_same_remote_file(previous, remote):
+            return previous, None
+
+        offset = 0
+        if previous and not previous.get('complete') and is_same_remote_file(previous, remote) \
+                and os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+        on_chunk = on_start(remote, offset)
+        with open(part_path, 'ab' if offset else 'wb') as part_file:
+            def write(chunk):
+                part_file.write(chunk)
+                if on_chunk:
+                    on_chunk(chunk)
+            ftp.retrbinary('RETR ' + parsed_url.path, write, blocksize=STREAM_CHUNK_SIZE, rest=offset or None)
+    return remote, offset
+
+
+def download_static_file(options):
+    """
+    Download one document type JSON file of a static file source (if changed since the previous download) and
+    convert it into a JSON file with one object per line
+    """
+    source, logger, config, document_type, output_dir, downloads, lock = options
+    source_name = source['schema:identifier']
+    url = join_url_path(source['brapi:static-file-repository-url'], document_type + '.json')
+    json_path = get_file_path([output_dir, document_type], ext='.json')
+    part_path = json_path + '.part'
+    previous = downloads.get(document_type)
+    if previous and previous.get('complete') and not os.path.exists(json_path):
+        previous = None
+
+    def save_download(remote):
+        with lock:
+            downloads[document_type] = remote
+            save_source_state(config, source_name, 'static-files', downloads)
+
+    writers = list()
+
+    def on_start(remote, offset):
+        save_download(dict(remote, complete=False))
+        if not offset:
+            # Convert to JSON lines while downloading (resumed downloads are converted once complete)
+            writers.append(JSONLinesWriter(json_path + '.tmp'))
+            return writers[-1].feed
+
+    timeout = (get_http_option(source, config, 'connect-timeout', DEFAULT_CONNECT_TIMEOUT),
+               get_http_option(source, config, 'read-timeout', DEFAULT_READ_TIMEOUT))
+    download_file = download_ftp_file if url.startswith('ftp://') else download_http_file
+    start = time.perf_counter()
+    try:
+        if previous and not previous.get('complete') and os.path.exists(part_path) \
+                and os.path.getsize(part_path) == previous.get('size'):
+            # Downloaded by a previous extraction but not converted
+            remote, offset = previous, previous['size']
+        else:
+            remote, offset = download_file(url, part_path, previous, on_start, timeout)
+        if offset is None:
+            logger.info("{}.json unchanged since the previous download.".format(document_type))
+            return document_type, True
+
+        size = os.path.getsize(part_path)
+        if remote.get('size') is not None and size != remote['size']:
+            raise IOError("Incomplete download of {}: {} of {} bytes".format(url, size, remote['size']))
+        duration = time.perf_counter() - start
+        resumed = ' (resumed at {:.1f} MB)'.format(offset / 1e6) if offset else ''
+        logger.info("Downloaded {}.json{}: {:.1f} MB in {:.1f}s ({:.1f} MB/s)."
+                    .format(document_type, resumed, (size - offset) / 1e6, duration,
+                            (size - offset) / 1e6 / max(duration, 1e-6)))
+
+        if writers:
+            writers.pop().close()
+            os.replace(json_path + '.tmp', json_path)
+        else:
+            convert_json_file_to_lines(part_path, json_path)
+        os.remove(part_path)
+        save_download(dict(remote, complete=True))
+        logger.info("Extracting BrAPI {}.json".format(document_type))
+        return document_type, True
+    except (requests.RequestException, ftplib.Error, OSError, ValueError) as error:
+        for writer in writers:
+            writer.discard()
+        logger.warning("Could not download {}.json from {} ({}).".format(document_type, url, error))
+        return document_type, False
+
+
+def extract_statics_files(source, output_dir, entities, config):
+    """
+    Download the document type JSON files of a static file source concurrently.
+    Interrupted downloads are resumed and unchanged files are not downloaded again (see `download_static_file`).
+    """
     source_name = source['schema:identifier']
     action = 'extract-' + source_name
     log_file = get_file_path([config['log-dir'], action], ext='.log', recreate=True)
     logger = create_logger(action, log_file, config['options']['verbose'])
 
     logger.info("Downloading files from {}...".format(source_name))
-    for document_type in entities:
-        try:
-            local_filename = urllib.request.urlretrieve(source["brapi:static-file-repository-url"] + "/" + document_type + ".json", output_dir + "/" + document_type + ".json")
-
-            with open(output_dir + "/" + document_type + ".json", 'r') as f:
-                json_data = json.load(f)
-            with open(output_dir + "/" + document_type + ".json", 'w') as outfile:
-                for entry in json_data:
-                    json.dump(entry, outfile)
-                    outfile.write('\n')
-
-            logger.info("Extracting BrAPI {}.json".format(document_type))
-
-        except :
-            continue
+    downloads = load_source_state(config, source_name, 'static-files') or dict()
+    lock = threading.Lock()
+    args = [(source, logger, config, document_type, output_dir, downloads, lock) for document_type in entities]
+    pool = ThreadPool(max(1, min(len(args), get_http_option(source, config, 'max-concurrency', NB_THREADS))))
+    try:
+        results = dict(pool.imap_unordered(download_static_file, args))
+    finally:
+        pool.close()
+    failed = sorted(document_type for (document_type, succeeded) in results.items() if not succeeded)
+    if failed:
+        logger.info("Could not download {} from {}.".format(', '.join(failed), source_name))
 
 
-def main(config):
+def prepare_sources(config):
+    """
+    Prepare the output directory and entities configuration of each source to extract
+    """
     entities = config["extract-brapi"]["entities"]
     for (entity_name, entity) in entities.items():
         entity['name'] = entity_name
@@ -309,27 +1118,42 @@ def main(config):
     json_dir = get_folder_path([config['data-dir'], 'json'], create=True)
     sources = config['sources']
 
-    threads = list()
     for source_name in sources:
-        
-        source_json_dir = get_folder_path([json_dir, source_name], recreate=True)
+        # Files of static file sources are kept to resume or skip their download (see `extract_statics_files`)
+        is_static = "brapi:endpointUrl" not in sources[source_name]
+        source_json_dir = get_folder_path([json_dir, source_name], create=True, recreate=not is_static)
         source_json_dir_failed = source_json_dir + '-failed'
         if os.path.exists(source_json_dir_failed):
             shutil.rmtree(source_json_dir_failed)
 
-        source = deepcopy(sources[source_name])
-        entities_copy = deepcopy(entities)
-        if "brapi:endpointUrl" in sources[source_name]:
+        yield sources[source_name], entities, source_json_dir
+
+
+def main(config):
+    # Calls of all sources are scheduled on shared worker threads and their requests in flight are bounded
+    # (with a global and a per host concurrency limit)
+    http_config = get_http_config(config)
+    max_global_concurrency = http_config.get('max-global-concurrency', MAX_GLOBAL_CONCURRENCY)
+    max_host_concurrency = http_config.get('max-host-concurrency', NB_THREADS)
+    scheduler = WorkScheduler(max_global_concurrency, max_host_concurrency)
+    budget = RequestBudget(max_global_concurrency, max_host_concurrency)
+    threads = list()
+    for (source, entities, source_json_dir) in prepare_sources(config):
+        if "brapi:endpointUrl" in source:
             thread = threading.Thread(target=extract_source,
-                                      args=(source, entities_copy, config, source_json_dir))
+                                      args=(deepcopy(source), deepcopy(entities), config, source_json_dir,
+                                            scheduler, budget))
             thread.daemon = True
             thread.start()
             threads.append(thread)
-        
-        elif "brapi:static-file-repository-url" in sources[source_name]:
-            extract_statics_files(sources[source_name], source_json_dir, entities, config)
-        
+
+        elif "brapi:static-file-repository-url" in source:
+            thread = threading.Thread(target=extract_statics_files, args=(source, source_json_dir, entities, config))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
     for thread in threads:
         while thread.is_alive():
             thread.join(500)
-
+    scheduler.close()
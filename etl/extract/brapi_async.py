@@ -0,0 +1,283 @@
+"""
+Asyncio BrAPI extraction engine (`extract --async`).
+The list, detail and external object link calls of all the sources run as coroutines on one event loop and send their
+requests with non-blocking sessions (see `etl.common.brapi_async.AsyncBrapiSession`) instead of blocking pool
+threads. The extraction goes through the same phases and writes the same MergeStore output as
+`etl.extract.brapi.extract_source`.
+"""
+import asyncio
+import threading
+import traceback
+from contextlib import aclosing
+from copy import deepcopy
+from functools import partial
+
+import requests
+
+from etl.common.brapi import BrapiServerError, get_implemented_call, get_identifier
+from etl.common.brapi_async import AsyncBrapiSession, AsyncBreedingAPIIterator, RequestSlots, fetch_search_results, \
+    get_implemented_calls
+from etl.common.concurrency import RequestBudget
+from etl.extract.brapi import NB_THREADS, PAGE_CONCURRENCY, MAX_GLOBAL_CONCURRENCY, EntityStream, add_in_store, \
+    add_all_in_store, get_detail_call, record_details, get_bulk_detail_call, record_bulk_details, replay_details, \
+    get_detail_sample_arguments, check_redundant_details, get_detail_arguments, get_list_arguments, \
+    get_external_link_arguments, fetch_all_links, remove_internal_objects, end_phase, load_implemented_calls, \
+    get_expired_implemented_calls, save_implemented_calls, init_source_extraction, end_source_extraction, \
+    get_http_config, prepare_sources, extract_statics_files
+
+
+async def run_all(function, arguments, concurrency, add_result=None):
+    """
+    Run a coroutine function with each of the arguments (at most `concurrency` at a time) and pass their results to
+    `add_result` as soon as they complete.
+    On error, no other coroutine is started and the running ones are awaited before raising the error (as
+    `etl.extract.brapi.extract_source` waits for its running calls).
+    """
+    arguments = iter(arguments)
+    running = set()
+    try:
+        while True:
+            for argument in arguments:
+                running.add(asyncio.ensure_future(function(argument)))
+                if len(running) >= concurrency:
+                    break
+            if not running:
+                return
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            errors = [task.exception() for task in done if task.exception() is not None]
+            for task in done:
+                if task.exception() is None and task.result() and add_result:
+                    add_result(task.result())
+            if errors:
+                raise errors[0]
+    finally:
+        if running:
+            await asyncio.wait(running)
+            for task in running:
+                if not task.cancelled():
+                    # Retrieve their errors (only the first error is raised)
+                    task.exception()
+
+
+async def fetch_all_in_store(source, entities, fetch_function, arguments, concurrency):
+    """
+    Run a fetch coroutine function with arguments and collect results in the entity MergeStore
+    """
+    source_name = source['schema:identifier']
+    await run_all(fetch_function, arguments, concurrency,
+                  lambda result: add_all_in_store(source_name, entities, [result]))
+
+
+async def fetch_implemented_calls(source, logger, config):
+    """
+    Get the calls implemented by a BrAPI endpoint (see `etl.extract.brapi.fetch_implemented_calls`)
+    """
+    implemented_calls, cached_calls = load_implemented_calls(source, logger, config)
+    if implemented_calls is not None:
+        return implemented_calls
+
+    try:
+        implemented_calls = await get_implemented_calls(source, logger, source['session'])
+    except (BrapiServerError, requests.RequestException) as error:
+        return get_expired_implemented_calls(source, logger, cached_calls, error)
+    return save_implemented_calls(source, logger, config, implemented_calls)
+
+
+async def list_object(options):
+    """
+    Fetch list for one entity and add the objects in the entity MergeStore as the pages are received
+    """
+    source, logger, entity = options
+    if 'list' not in entity:
+        return
+
+    call = get_implemented_call(source, entity['list'])
+    if call is None:
+        return
+
+    iterator = AsyncBreedingAPIIterator(source['brapi:endpointUrl'], call, logger, source['session'],
+                                        source.get('journal'), group='list')
+    async with aclosing(iterator.fetch_pages(PAGE_CONCURRENCY)) as pages:
+        async for data_list in pages:
+            for data in data_list:
+                add_in_store(source['schema:identifier'], entity, data)
+
+
+async def fetch_details(options):
+    """
+    Fetch details call for a BrAPI object or for a batch of objects (see `etl.extract.brapi.fetch_details`)
+    """
+    source, logger, entity, object_id = options
+    if 'detail' not in entity:
+        return
+    if isinstance(object_id, list):
+        return await fetch_bulk_details(options)
+
+    detail_call = get_detail_call(source, entity, object_id)
+    if not detail_call:
+        return
+
+    details = await AsyncBreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], detail_call, logger,
+                                                       source['session'], group='detail')
+    return record_details(source, logger, entity, detail_call, details[0])
+
+
+async def fetch_bulk_details(options):
+    """
+    Fetch details of a batch of BrAPI objects with one search call, the objects missing from the search results
+    being detailed one by one (see `etl.extract.brapi.fetch_bulk_details`)
+    """
+    source, logger, entity, object_ids = options
+    entity_name = entity['name']
+    bulk_call, poll_interval = get_bulk_detail_call(source, entity, object_ids)
+
+    details_by_id = dict()
+    try:
+        for details in await fetch_search_results(source['brapi:endpointUrl'], bulk_call, logger, source['session'],
+                                                  group='detail', poll_interval=poll_interval):
+            details['etl:detailed'] = True
+            details_by_id[get_identifier(entity_name, details)] = details
+    except (BrapiServerError, requests.RequestException) as error:
+        logger.warning("Could not fetch {} details in bulk ({}), fetching them one by one.".format(entity_name, error))
+        details_by_id = dict()
+
+    details_list = record_bulk_details(source, entity, object_ids, details_by_id)
+    for object_id in object_ids:
+        if object_id not in details_by_id:
+            result = await fetch_details((source, logger, entity, object_id))
+            if result:
+                details_list.extend(result[1])
+    return entity_name, details_list
+
+
+async def fetch_link_values(options):
+    """
+    Fetch objects linked to a BrAPI object through a dedicated call (ex: /brapi/v1/studies/{id}/germplasm)
+    """
+    source, logger, link_key, call = options
+    link_values = await AsyncBreedingAPIIterator.fetch_all(source['brapi:endpointUrl'], call, logger,
+                                                           source['session'], group='link')
+    if source.get('journal'):
+        source['journal'].record_link(link_key, link_values)
+    return link_key, link_values
+
+
+async def stream_all_entities(source, logger, entities, output_dir):
+    """
+    Stream the objects of each entity with "stream": true to files (see `etl.extract.brapi.stream_entity`)
+    """
+    for (entity_name, entity) in entities.items():
+        if not entity.get('stream') or 'list' not in entity:
+            continue
+        call = get_implemented_call(source, entity['list'])
+        if call is None:
+            continue
+
+        iterator = AsyncBreedingAPIIterator(source['brapi:endpointUrl'], call, logger, source['session'],
+                                            group='list')
+        with EntityStream(source, logger, entity, entities, output_dir) as entity_stream:
+            async with aclosing(iterator.fetch_pages(PAGE_CONCURRENCY)) as pages:
+                async for data_list in pages:
+                    for data in data_list:
+                        entity_stream.dump(data)
+
+
+async def extract_source(source, entities, config, output_dir, budget=None, slots=None):
+    """
+    Full JSON BrAPI source extraction process (asyncio version of `etl.extract.brapi.extract_source`).
+    The calls run as coroutines (as many at a time as the maximum concurrency of the source) and their requests are
+    sent within the global `budget` if any (`slots` being shared by the sessions sharing the budget).
+    """
+    source_name = source['schema:identifier']
+    logger, log_file = init_source_extraction(source, entities, config, budget,
+                                              partial(AsyncBrapiSession, slots=slots))
+    concurrency = source['session'].limiter.max_limit
+    loop = asyncio.get_running_loop()
+
+    logger.info("Extracting BrAPI {} (asyncio)...".format(source_name))
+    error = None
+    try:
+        # Fetch server implemented calls
+        if 'implemented-calls' not in source:
+            source['implemented-calls'] = await fetch_implemented_calls(source, logger, config)
+
+        # Fetch entities lists
+        await fetch_all_in_store(source, entities, list_object, get_list_arguments(source, logger, entities),
+                                 concurrency)
+        end_phase(logger, entities, 'List')
+
+        # Detail entities
+        replay_details(source, entities)
+        sample_results = list()
+        await run_all(fetch_details, get_detail_sample_arguments(source, logger, entities), concurrency,
+                      sample_results.append)
+        redundant_entity_names = check_redundant_details(source, logger, entities, sample_results)
+        await fetch_all_in_store(source, entities, fetch_details,
+                                 get_detail_arguments(source, logger, entities,
+                                                      skip_entity_names=redundant_entity_names), concurrency)
+        end_phase(logger, entities, 'Details')
+
+        # Stream high-volume entities to files (linked objects missing from the stores are linked and detailed next)
+        await stream_all_entities(source, logger, entities, output_dir)
+
+        # Fetch external object links, then link entities on an executor thread (the link values of objects added
+        # by the links are fetched on the event loop)
+        link_values_by_key = dict(source['journal'].links) if source.get('journal') else dict()
+        link_args = get_external_link_arguments(source, logger, entities, link_values_by_key)
+        if link_args:
+            logger.info("Fetching {} external object links...".format(len(link_args)))
+            await run_all(fetch_link_values, link_args, concurrency,
+                          lambda result: link_values_by_key.update([result]))
+
+        def fetch_link_values_threadsafe(options):
+            return asyncio.run_coroutine_threadsafe(fetch_link_values(options), loop).result()
+
+        await loop.run_in_executor(None, partial(fetch_all_links, source, logger, entities, link_values_by_key,
+                                                 fetch_link_values_threadsafe))
+        linked_ids_by_entity = end_phase(logger, entities, 'Links')
+
+        # Detail entities (only for objects that might have been discovered by links)
+        await fetch_all_in_store(source, entities, fetch_details,
+                                 get_detail_arguments(source, logger, entities, linked_ids_by_entity), concurrency)
+        end_phase(logger, entities, 'Linked object details')
+
+        remove_internal_objects(entities)
+    except Exception:
+        error = traceback.format_exc()
+    source['session'].close()
+
+    # Save the stores on an executor thread (without blocking the calls of the other sources)
+    await loop.run_in_executor(None, end_source_extraction, source, entities, config, logger, log_file, output_dir,
+                               error)
+
+
+async def extract_sources(sources, config):
+    """
+    Extract BrAPI sources (list of source, entities and output directory) concurrently on the running event loop
+    (with a global and a per host limit of requests in flight)
+    """
+    http_config = get_http_config(config)
+    budget = RequestBudget(http_config.get('max-global-concurrency', MAX_GLOBAL_CONCURRENCY),
+                           http_config.get('max-host-concurrency', NB_THREADS))
+    slots = RequestSlots()
+    await asyncio.gather(*[extract_source(source, entities, config, output_dir, budget, slots)
+                           for (source, entities, output_dir) in sources])
+
+
+def main(config):
+    sources = list()
+    threads = list()
+    for (source, entities, source_json_dir) in prepare_sources(config):
+        if "brapi:endpointUrl" in source:
+            sources.append((deepcopy(source), deepcopy(entities), source_json_dir))
+
+        elif "brapi:static-file-repository-url" in source:
+            thread = threading.Thread(target=extract_statics_files, args=(source, source_json_dir, entities, config))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+    asyncio.run(extract_sources(sources, config))
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(500)
@@ -1,8 +1,10 @@
 import threading
 import traceback
-import json
 import time
 
+from etl.common import json_codec
+from etl.common.compression import open_file, find_file
+from etl.common.store import list_entity_files
 from etl.common.utils import *
 from etl.transform.generate_datadiscovery import generate_datadiscovery
 from etl.transform.transform_cards import do_card_transform
@@ -166,32 +168,33 @@ def clean_nulls_in_lists(obj):
 
 
 #TODO : still very naive and memory inefficient. Uses more than 18Go of memory
-def _handle_observation_units(source, source_bulk_dir, config, document_type, input_json_filepath, logger, start_time):
+def _handle_observation_units(source, source_bulk_dir, config, document_type, input_json_filepaths, logger, start_time):
     logger.info("Loading observationUnit from " + source['schema:identifier']  )
     obsUnitDict= {}
     obsUnitDict["observationUnit"] = {}
     i = 0
-    if not os.path.isfile(input_json_filepath):
+    if not input_json_filepaths:
         logger.info("No observationUnit in " + source['schema:identifier'])
     else:
         try:
-            with open(input_json_filepath, 'r') as json_file:
-                json_list = list(json_file)
-                for json_line in json_list:
-                    json_line_data = json.loads(json_line)
-                    # transform observationUnit
-                    #uri = get_generated_uri_from_dict(source, document_type["document-type"], json_line_data)
-                    transformed_obsUnit = _handle_DbId_URI(json_line_data, "observationUnit",
-                                                                         documents_dbid_fields_plus_field_type, source)
-                    transformed_obsUnit = simple_transformations(transformed_obsUnit, source, "observationUnit")
+            # observationUnit.json or the files of a streamed extraction (observationUnit-1.json, ...), maybe compressed
+            for input_json_filepath in input_json_filepaths:
+                with open_file(input_json_filepath, 'r') as json_file:
+                    for json_line in json_file:
+                        json_line_data = json_codec.loads(json_line)
+                        # transform observationUnit
+                        #uri = get_generated_uri_from_dict(source, document_type["document-type"], json_line_data)
+                        transformed_obsUnit = _handle_DbId_URI(json_line_data, "observationUnit",
+                                                                             documents_dbid_fields_plus_field_type, source)
+                        transformed_obsUnit = simple_transformations(transformed_obsUnit, source, "observationUnit")
 
-                    transformed_obsUnit = clean_nulls_in_lists(transformed_obsUnit)
+                        transformed_obsUnit = clean_nulls_in_lists(transformed_obsUnit)
 
-                    # Apply base64 encoding transformations
-                    #transformed_obsUnit = _handle_observation_unit_dbid_fields(transformed_obsUnit, source, fields_to_encode_obs_unit)
+                        # Apply base64 encoding transformations
+                        #transformed_obsUnit = _handle_observation_unit_dbid_fields(transformed_obsUnit, source, fields_to_encode_obs_unit)
 
-                    obsUnitDict["observationUnit"][str(i)] = transformed_obsUnit
-                    i += 1
+                        obsUnitDict["observationUnit"][str(i)] = transformed_obsUnit
+                        i += 1
 
         except FileNotFoundError as e:
             print("No " + document_type["document-type"] + " in " + source['schema:identifier'])
@@ -204,22 +207,28 @@ def _handle_observation_units(source, source_bulk_dir, config, document_type, in
 def load_input_json(source, doc_types, source_json_dir, config, logger, start_time, source_bulk_dir):
     data_dict = {}
     if source_json_dir:
-        _handle_observation_units(source, source_bulk_dir, config, doc_types, source_json_dir + "/observationUnit.json", logger, start_time)
+        observation_unit_files = []
+        if os.path.isdir(source_json_dir):
+            observation_unit_files = sorted(file_path for (entity_name, file_path) in list_entity_files(source_json_dir)
+                                            if entity_name == "observationUnit")
+        _handle_observation_units(source, source_bulk_dir, config, doc_types, observation_unit_files, logger, start_time)
         # all_files = list_entity_files(source_json_dir)
         # filtered_files = list(filter(lambda x: x[0] in source_entities, all_files))
         for document_type in doc_types:
 
             input_json_filepath = source_json_dir + "/" + document_type["document-type"] + ".json"
+            # The extraction output might be compressed (ex: study.json.gz)
+            input_json_filepath = find_file(input_json_filepath) or input_json_filepath
 
             if document_type["document-type"] == "observationUnit":
                 continue
 
             data_dict[document_type["document-type"]] = {}
             try:
-                with open(input_json_filepath, 'r') as json_file:
+                with open_file(input_json_filepath, 'r') as json_file:
                     json_list = list(json_file)
                     for json_line in json_list:
-                        data = json.loads(json_line)
+                        data = json_codec.loads(json_line)
                         uri = get_generated_uri_from_dict(source, document_type["document-type"], data, keep_urn=True)
                         data_dict[document_type["document-type"]][uri] = data
             #                    links = get_entity_links(data, 'DbId')
@@ -4,11 +4,11 @@
 # 3. Add @context annotation
 
 import functools
-import json
 import os
 import re
 import urllib
 
+from etl.common import json_codec
 from etl.common.utils import get_file_path, get_folder_path, join_url_path, pool_worker
 
 
@@ -80,18 +80,17 @@ def transform_to_jsonld(options):
     entity_add_jsonld, json_path, jsonld_path = options
 
     data_list = []
-    with open(json_path, 'r') as json_file:
+    with open(json_path, 'r', encoding='utf-8') as json_file:
         for line in json_file:
-            data = json.loads(line)
+            data = json_codec.loads(line)
 
             # Annotate json object with JSON-LD's @id, @context and @type
             entity_add_jsonld(data)
             data_list.append(data)
 
     # Write to JSON-LD file
-    with open(jsonld_path, 'a') as jsonld_file:
-        json.dump(data_list, jsonld_file)
-        jsonld_file.write('\n')
+    with open(jsonld_path, 'a', encoding='utf-8') as jsonld_file:
+        json_codec.dump_line(data_list, jsonld_file)
 
 
 def transform_folder(institution_add_jsonld, json_dir, jsonld_dir):
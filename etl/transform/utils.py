@@ -1,7 +1,6 @@
 import base64
 import glob
 import gzip
-import json
 import os
 import re
 import shutil
@@ -11,6 +10,10 @@ from xml.sax import saxutils as su
 import rfc3987
 
 from etl.common.brapi import get_identifier
+from etl.common import json_codec
+from etl.common.compression import open_file, get_codec, get_compressed_path
+from etl.common.json_stream import convert_json_file_to_lines
+from etl.common.store import list_entity_files
 
 
 def get_generated_uri_from_dict(source: dict, entity: str, data: dict, do_base64 = False, keep_urn = False) -> str:
@@ -70,8 +73,8 @@ def save_json(source_dir, json_dict, logger):
         saved_documents = 0
         documents_list = documents.values()
         while saved_documents < len(documents_list):
-            with open(source_dir + "/" + type + '-' + str(file_number) + '.json', 'w') as f:
-                json.dump(list(documents_list)[saved_documents:file_number * 10000], f, ensure_ascii=False)
+            with open(source_dir + "/" + type + '-' + str(file_number) + '.json', 'w', encoding='utf-8') as f:
+                f.write(json_codec.dumps(list(documents_list)[saved_documents:file_number * 10000]))
             with open(source_dir + "/" + type + '-' + str(file_number) + '.json', 'rb') as f:
                 with gzip.open(source_dir + "/" + type + '-' + str(file_number) + '.json.gz', 'wb') as f_out:
                     shutil.copyfileobj(f, f_out)
@@ -119,34 +122,21 @@ def json_to_jsonl(source_json_dir):
     """
     json_files = glob.glob(source_json_dir + "/*.json")
     for json_file in json_files:
-        # read the file
-        try:
-            with open(json_file) as old_json_file:
-                data = json.load(old_json_file)
-        except json.decoder.JSONDecodeError:
+        # convert JSON arrays in constant memory (overriding the old json)
+        if not convert_json_file_to_lines(json_file):
             print("INFO: The file '{}' is already flattened. Removing HTML tags if any ..".format(json_file))
-            continue
-        # write the new one (overriding the old json)
-        with open(json_file, 'w') as new_json_file:
-            for entry in data:
-                json.dump(entry, new_json_file)
-                new_json_file.write('\n')
 
 
 def rm_tags(source_json_dir):
-    json_files = glob.glob(source_json_dir + "/*.json")
+    # JSON files of the extraction might be compressed (ex: study.json.gz)
+    json_files = [json_file for (_, json_file) in list_entity_files(source_json_dir)]
     for json_file in json_files:
-        new_json_list = []
-        with open(json_file) as old_json_file:
-            json_list = list(old_json_file)
-        for json_str in json_list:
-            line = json.loads(json_str)
-            if "studyDescription" in line:
-                # remove escaped html
-                line["studyDescription"] = remove_html_tags(line["studyDescription"])
-            new_json_list.append(line)
-
-        with open(json_file, 'w') as new_json_file:
-            for entry in new_json_list:
-                json.dump(entry, new_json_file)
-                new_json_file.write('\n')
+        # remove escaped html line by line in a new file (overriding the old json)
+        tmp_json_file = get_compressed_path(json_file + '.tmp', get_codec(json_file))
+        with open_file(json_file) as old_json_file, open_file(tmp_json_file, 'w') as new_json_file:
+            for json_str in old_json_file:
+                line = json_codec.loads(json_str)
+                if "studyDescription" in line:
+                    line["studyDescription"] = remove_html_tags(line["studyDescription"])
+                json_codec.dump_line(line, new_json_file)
+        os.replace(tmp_json_file, json_file)
@@ -4,6 +4,7 @@ import signal
 import sys
 
 import etl.extract.brapi
+import etl.extract.brapi_async
 import etl.transform.datadiscovery_cards
 import etl.transform.jsonld
 import etl.transform.rdf
@@ -37,7 +38,10 @@ def main():
 
     # Execute ETL actions based on CLI arguments:
     if 'extract' in options or 'etl_es' in options or 'etl_virtuoso' in options:
-        etl.extract.brapi.main(config)
+        if options.get('async_extract'):
+            etl.extract.brapi_async.main(config)
+        else:
+            etl.extract.brapi.main(config)
 
     if 'transform_elasticsearch' in options or 'etl_es' in options:
         etl.transform.datadiscovery_cards.main(config)
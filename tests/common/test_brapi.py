@@ -1,6 +1,14 @@
+import json
+import os
+import tempfile
+import time
 import unittest
 
-from etl.common.brapi import get_identifier, get_entity_links
+from etl.common.brapi import get_identifier, get_canonical_json, get_entity_links, BreedingAPIIterator, BrapiSession, \
+    BrapiServerError, PageSizeTuner
+from etl.common.store import ExtractionJournal
+from etl.common.utils import remove_falsey
+from tests.extract.utils import FakeBrapiServer
 
 
 class TestGetIdentifier(unittest.TestCase):
@@ -34,6 +42,20 @@ class TestGetIdentifier(unittest.TestCase):
         actual2 = get_identifier(entity, data2)
         self.assertEqual(actual, actual2)
 
+    def test_canonical_json(self):
+        data = {
+            'name': 'Jöhn "J"',
+            'email': '',
+            'orcid': None,
+            'coordinates': [1.5, 0, None, -2, 10 ** 20],
+            'type': {'a': {}, 'b': [[], {'c': False}], 'd': True},
+            'tags': {'x'},
+            'nested': ({'z': 1, 'y': 0.0},),
+        }
+        expected = json.dumps(remove_falsey(data, predicate=lambda x: x and not isinstance(x, set)), sort_keys=True)
+        self.assertEqual(expected, get_canonical_json(data))
+        self.assertEqual('null', get_canonical_json({'foo': ''}))
+
 
 class TestListLinks(unittest.TestCase):
     """
@@ -105,3 +127,194 @@ class TestListLinks(unittest.TestCase):
         ]
         actual = get_entity_links(self.data, 'DbId')
         self.assertEqual(expected, actual)
+
+
+class TestBrapiSession(unittest.TestCase):
+    """
+    Fetch BrAPI pages through a pooled keep-alive session
+    """
+
+    def test_connection_reuse(self):
+        studies = [{'studyDbId': str(i)} for i in range(5)]
+        call = {'method': 'GET', 'path': 'studies', 'page-size': 2}
+        session = BrapiSession(pool_size=2)
+        with FakeBrapiServer(lists={'studies': studies}) as server:
+            actual = list(BreedingAPIIterator.fetch_all(server.url, call, session=session))
+            stats = session.get_connection_stats()
+        session.close()
+
+        self.assertEqual(studies, actual)
+        self.assertEqual({'requests': 3, 'connections': 1, 'reused': 2}, stats)
+
+    def test_compressed_transfer(self):
+        germplasm = [{'germplasmDbId': str(i), 'genus': 'Triticum', 'species': 'aestivum'} for i in range(100)]
+        call = {'method': 'GET', 'path': 'germplasm', 'page-size': 50}
+        session = BrapiSession()
+        with FakeBrapiServer(lists={'germplasm': germplasm}, compress=True) as server:
+            actual = list(BreedingAPIIterator.fetch_all(server.url, call, session=session, group='list'))
+        session.close()
+
+        self.assertEqual(germplasm, actual)
+        stats = session.transfer_stats['list']
+        self.assertEqual(2, stats['requests'])
+        self.assertLess(stats['wire'] * 5, stats['decoded'])
+
+
+class TestFetchPages(unittest.TestCase):
+    """
+    Fetch the pages of a BrAPI list concurrently once the total number of pages is known
+    """
+    germplasm = [{'germplasmDbId': str(i)} for i in range(10)]
+    call = {'method': 'GET', 'path': 'germplasm', 'page-size': 3}
+
+    def test_ordered(self):
+        with FakeBrapiServer(lists={'germplasm': self.germplasm}) as server:
+            actual = list(BreedingAPIIterator.fetch_all(server.url, self.call, concurrency=3))
+            requested_pages = sorted(int(params['page']) for (_, _, params) in server.requests)
+
+        self.assertEqual(self.germplasm, actual)
+        self.assertEqual([0, 1, 2, 3], requested_pages)
+
+    def test_unordered(self):
+        with FakeBrapiServer(lists={'germplasm': self.germplasm}) as server:
+            actual = list(BreedingAPIIterator.fetch_all(server.url, self.call, concurrency=2, ordered=False))
+
+        key = lambda data: data['germplasmDbId']
+        self.assertEqual(sorted(self.germplasm, key=key), sorted(actual, key=key))
+
+    def test_stream(self):
+        session = BrapiSession()
+        with FakeBrapiServer(lists={'germplasm': self.germplasm}, compress=True) as server:
+            iterator = BreedingAPIIterator.fetch_all(server.url, self.call, session=session, group='list', stream=True)
+            first = next(iterator)
+            nb_requests = len(server.requests)
+            actual = [first] + list(iterator)
+        session.close()
+
+        self.assertEqual(self.germplasm, actual)
+        self.assertEqual(1, nb_requests)
+        self.assertEqual(4, session.transfer_stats['list']['requests'])
+        self.assertGreater(session.transfer_stats['list']['decoded'], session.transfer_stats['list']['wire'])
+
+    def test_stream_unordered(self):
+        delays = {'germplasm': [0] + [0.3] * 3}
+        with FakeBrapiServer(lists={'germplasm': self.germplasm}, delays=delays) as server:
+            start = time.perf_counter()
+            actual = list(BreedingAPIIterator.fetch_all(server.url, self.call, concurrency=3, ordered=False,
+                                                        stream=True))
+            duration = time.perf_counter() - start
+
+        key = lambda data: data['germplasmDbId']
+        self.assertEqual(sorted(self.germplasm, key=key), sorted(actual, key=key))
+        # Remaining pages streamed concurrently
+        self.assertLess(duration, 0.6)
+
+    def test_stream_unordered_error(self):
+        with FakeBrapiServer(lists={'germplasm': self.germplasm}) as server:
+            iterator = BreedingAPIIterator.fetch_all(server.url, self.call, concurrency=3, ordered=False, stream=True)
+            next(iterator)
+            # One of the remaining pages fails
+            server.errors['germplasm'] = [500]
+            with self.assertRaises(BrapiServerError):
+                list(iterator)
+
+    def test_stream_journal(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            journal_path = os.path.join(tmp_dir, 'journal.jsonl')
+            with FakeBrapiServer(lists={'germplasm': self.germplasm}) as server:
+                journal = ExtractionJournal(journal_path)
+                list(BreedingAPIIterator.fetch_all(server.url, self.call, journal=journal, stream=True))
+                journal.close()
+
+            # Replay the pages from the journal (the server is down)
+            journal = ExtractionJournal(journal_path, resume=True)
+            actual = list(BreedingAPIIterator.fetch_all(server.url, self.call, journal=journal, stream=True))
+            journal.close()
+
+        self.assertEqual(self.germplasm, actual)
+
+
+class TestPageSizeTuner(unittest.TestCase):
+    """
+    Learn the page size of BrAPI calls
+    """
+
+    def test_grow_while_item_latency_improves(self):
+        tuner = PageSizeTuner(max_size=5000)
+        tuner.record_page('GET germplasm', 500, 500, 500, 1.0)
+        self.assertEqual(1000, tuner.get_page_size('GET germplasm', 500))
+        tuner.record_page('GET germplasm', 1000, 1000, 1000, 1.2)
+        self.assertEqual(2000, tuner.get_page_size('GET germplasm', 500))
+        tuner.record_page('GET germplasm', 2000, 2000, 2000, 4.0)
+        self.assertEqual(1000, tuner.get_page_size('GET germplasm', 500))
+
+        # Settled
+        tuner.record_page('GET germplasm', 1000, 1000, 1000, 0.1)
+        self.assertEqual(1000, tuner.get_page_size('GET germplasm', 500))
+
+    def test_grow_against_persisted_baseline(self):
+        # Latency per item getting worse as pages grow, one list call (one page size) per extraction
+        def extract(state, page_size):
+            tuner = PageSizeTuner(state, max_size=5000)
+            page_size = tuner.get_page_size('GET germplasm', page_size)
+            for _ in range(3):
+                tuner.record_page('GET germplasm', page_size, page_size, page_size, page_size * page_size * 1e-6)
+            return json.loads(json.dumps(tuner.get_state())), tuner.get_page_size('GET germplasm', page_size)
+
+        state, page_size = extract(None, 500)
+        self.assertEqual(1000, page_size)
+        state, page_size = extract(state, 500)
+        self.assertEqual(500, page_size)
+        self.assertEqual(['GET germplasm'], state['settled'])
+        state, page_size = extract(state, 500)
+        self.assertEqual(500, page_size)
+
+    def test_persist_honoured_page_size(self):
+        tuner = PageSizeTuner()
+        tuner.record_page('GET germplasm', 2000, 1000, 1000, 1.0)
+        tuner = PageSizeTuner(tuner.get_state())
+        tuner.record_page('GET germplasm', 1000, 1000, 1000, 0.1)
+        self.assertEqual(1000, tuner.get_page_size('GET germplasm', 2000))
+
+    def test_ignore_partial_pages(self):
+        tuner = PageSizeTuner()
+        tuner.record_page('GET germplasm', 500, 500, 20, 1.0)
+        self.assertEqual(500, tuner.get_page_size('GET germplasm', 500))
+
+    def test_shrink_on_error(self):
+        tuner = PageSizeTuner(min_size=100)
+        tuner.record_error('GET germplasm', 500)
+        self.assertEqual(250, tuner.get_page_size('GET germplasm', 500))
+        tuner.record_error('GET germplasm', 150)
+        self.assertEqual(100, tuner.get_page_size('GET germplasm', 500))
+
+    def test_grow_after_error(self):
+        tuner = PageSizeTuner(max_size=5000)
+        tuner.record_error('GET germplasm', 2000)
+        self.assertEqual(1000, tuner.get_page_size('GET germplasm', 500))
+        self.assertEqual([], tuner.get_state()['settled'])
+
+        # Not grown back to the failed page size
+        tuner = PageSizeTuner(tuner.get_state())
+        tuner.record_page('GET germplasm', 1000, 1000, 1000, 1.0)
+        self.assertEqual(1000, tuner.get_page_size('GET germplasm', 500))
+
+        # Until the error expires
+        state = tuner.get_state()
+        state['errors']['GET germplasm'][1] -= 8 * 24 * 3600
+        tuner = PageSizeTuner(state)
+        tuner.record_page('GET germplasm', 1000, 1000, 1000, 0.5)
+        self.assertEqual(2000, tuner.get_page_size('GET germplasm', 500))
+
+    def test_honoured_page_size(self):
+        germplasm = [{'germplasmDbId': str(i)} for i in range(10)]
+        call = {'method': 'GET', 'path': 'germplasm', 'page-size': 5}
+        session = BrapiSession(page_size_tuner=PageSizeTuner())
+        with FakeBrapiServer(lists={'germplasm': germplasm}, max_page_size=3) as server:
+            actual = list(BreedingAPIIterator.fetch_all(server.url, call, session=session))
+            iterator = BreedingAPIIterator(server.url, call, session=session)
+        session.close()
+
+        self.assertEqual(germplasm, actual)
+        self.assertEqual({'GET germplasm': 3}, session.page_size_tuner.sizes)
+        self.assertEqual(3, iterator.page_size)
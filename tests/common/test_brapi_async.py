@@ -0,0 +1,139 @@
+import asyncio
+import time
+import unittest
+
+import requests
+
+from etl.common.async_http import AsyncHTTPClient
+from etl.common.brapi import BrapiServerError
+from etl.common.brapi_async import AsyncBrapiSession, AsyncBreedingAPIIterator, fetch_search_results
+from etl.common.concurrency import AdaptiveLimiter
+from tests.extract.utils import FakeBrapiServer
+
+
+class TestAsyncHTTPClient(unittest.TestCase):
+    """
+    Send requests with the asyncio client to a local stand-in BrAPI server
+    """
+    studies = [{'studyDbId': str(i), 'studyName': 'Study ' + 'é' * i} for i in range(100)]
+
+    def test_keep_alive(self):
+        async def fetch(server):
+            client = AsyncHTTPClient(pool_size=2)
+            responses = list()
+            for page in range(3):
+                responses.append(await client.request('GET', server.url + 'studies',
+                                                      params={'page': page, 'pageSize': 10}))
+            client.close()
+            return client, responses
+
+        with FakeBrapiServer(lists={'studies': self.studies}) as server:
+            client, responses = asyncio.run(fetch(server))
+
+        self.assertEqual([200] * 3, [response.status_code for response in responses])
+        self.assertEqual(self.studies[20:30], responses[2].json()['result']['data'])
+        self.assertEqual({'requests': 3, 'connections': 1}, client.stats)
+
+    def test_chunked_gzip(self):
+        with FakeBrapiServer(lists={'studies': self.studies}, compress=True, chunked=True) as server:
+            client = AsyncHTTPClient()
+            response = asyncio.run(client.request('GET', server.url + 'studies', params={'pageSize': 100}))
+
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual(self.studies, response.json()['result']['data'])
+        self.assertLess(response.wire_bytes, len(response.content))
+
+    def test_post_json(self):
+        with FakeBrapiServer(searches={'germplasm-search': [{'germplasmDbId': 'G1'}, {'germplasmDbId': 'G2'}]}) \
+                as server:
+            client = AsyncHTTPClient()
+            response = asyncio.run(client.request('POST', server.url + 'germplasm-search',
+                                                  json={'germplasmDbIds': ['G2']}))
+
+        self.assertEqual([{'germplasmDbId': 'G2'}], response.json()['result']['data'])
+        self.assertEqual(('POST', 'germplasm-search', {'germplasmDbIds': ['G2']}), server.requests[0])
+
+    def test_read_timeout(self):
+        with FakeBrapiServer(objects={'studies/1': {}}, delays={'studies/1': [1]}) as server:
+            client = AsyncHTTPClient(timeout=(1, 0.2))
+            with self.assertRaises(requests.Timeout):
+                asyncio.run(client.request('GET', server.url + 'studies/1'))
+
+    def test_connection_error(self):
+        with FakeBrapiServer() as server:
+            url = server.url
+        with self.assertRaises(requests.ConnectionError):
+            asyncio.run(AsyncHTTPClient().request('GET', url + 'studies'))
+
+
+async def fetch_all(server, call, session, **kwargs):
+    try:
+        return await AsyncBreedingAPIIterator.fetch_all(server.url, call, session=session, **kwargs)
+    finally:
+        session.close()
+
+
+async def search(server, call, session, **kwargs):
+    try:
+        return await fetch_search_results(server.url, call, session=session, **kwargs)
+    finally:
+        session.close()
+
+
+class TestAsyncBreedingAPIIterator(unittest.TestCase):
+    germplasm = [{'germplasmDbId': str(i)} for i in range(10)]
+    call = {'method': 'GET', 'path': 'germplasm', 'page-size': 2}
+
+    def test_concurrent_pages(self):
+        limiter = AdaptiveLimiter(10, min_limit=10)
+        with FakeBrapiServer(lists={'germplasm': self.germplasm}) as server:
+            # The second page is the slowest
+            server.delays['germplasm'] = [0, 0.3]
+            session = AsyncBrapiSession(limiter=limiter)
+            start = time.perf_counter()
+            actual = asyncio.run(fetch_all(server, self.call, session, concurrency=4))
+            duration = time.perf_counter() - start
+
+        self.assertEqual(self.germplasm, sorted(actual, key=lambda data: int(data['germplasmDbId'])))
+        self.assertEqual(self.germplasm[2:4], actual[-2:])
+        self.assertLess(duration, 0.6)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_retry_overloaded(self):
+        with FakeBrapiServer(lists={'germplasm': self.germplasm}, errors={'germplasm': [503, 429]}) as server:
+            session = AsyncBrapiSession(retry_base_delay=0)
+            actual = asyncio.run(fetch_all(server, self.call, session))
+
+        self.assertEqual(self.germplasm, actual)
+        self.assertEqual(2, session.retry_count)
+
+    def test_server_error(self):
+        with FakeBrapiServer(lists={'germplasm': self.germplasm}) as server:
+            session = AsyncBrapiSession()
+            with self.assertRaises(BrapiServerError):
+                asyncio.run(fetch_all(server, {'method': 'GET', 'path': 'studies/1'}, session))
+
+    def test_async_search(self):
+        call = {'method': 'POST', 'path': 'search/germplasm', 'page-size': 2, 'async-search': True,
+                'param': {'germplasmDbIds': ['1', '2', '3']}}
+        with FakeBrapiServer(searches={'search/germplasm': self.germplasm}, async_search=True) as server:
+            session = AsyncBrapiSession()
+            actual = asyncio.run(search(server, call, session, poll_interval=0))
+
+        self.assertEqual(self.germplasm[1:4], actual)
+
+    def test_hedged_request(self):
+        limiter = AdaptiveLimiter(4)
+        session = AsyncBrapiSession(limiter=limiter, hedge_percentile=90, hedge_min_samples=5, max_hedge_ratio=1)
+        for _ in range(5):
+            session.latency.record('GET studies/1', 0.05)
+        with FakeBrapiServer(objects={'studies/1': {'studyDbId': '1'}}, delays={'studies/1': [2]}) as server:
+            start = time.perf_counter()
+            actual = asyncio.run(fetch_all(server, {'method': 'GET', 'path': 'studies/1'}, session))
+            duration = time.perf_counter() - start
+
+        # The stuck request is cancelled once its duplicate answered
+        self.assertEqual([{'studyDbId': '1'}], actual)
+        self.assertLess(duration, 1)
+        self.assertEqual({'sent': 1, 'won': 1}, session.hedge_stats)
+        self.assertEqual(0, limiter.in_flight)
@@ -0,0 +1,62 @@
+import tempfile
+import unittest
+
+from etl.common.brapi import BreedingAPIIterator, BrapiSession
+from etl.common.cache import ResponseCache
+from tests.extract.utils import FakeBrapiServer
+
+
+class TestResponseCache(unittest.TestCase):
+    """
+    Reuse cached BrAPI responses from one session to the next
+    """
+    studies = [{'studyDbId': str(i)} for i in range(3)]
+    call = {'method': 'GET', 'path': 'studies', 'page-size': 10}
+
+    def fetch_twice(self, server, cache):
+        results = list()
+        for _ in range(2):
+            session = BrapiSession(cache=cache)
+            results.append(list(BreedingAPIIterator.fetch_all(server.url, self.call, session=session)))
+            session.close()
+        return results
+
+    def test_ttl_reuse(self):
+        cache = ResponseCache(tempfile.mkdtemp(), ttl=60)
+        with FakeBrapiServer(lists={'studies': self.studies}) as server:
+            results = self.fetch_twice(server, cache)
+
+        self.assertEqual([self.studies, self.studies], results)
+        self.assertEqual(1, len(server.requests))
+        self.assertEqual({'hit': 1, 'revalidated': 0, 'miss': 1}, cache.stats)
+
+    def test_ttl_expired(self):
+        cache = ResponseCache(tempfile.mkdtemp(), ttl=0)
+        with FakeBrapiServer(lists={'studies': self.studies}) as server:
+            self.fetch_twice(server, cache)
+
+        self.assertEqual(2, len(server.requests))
+        self.assertEqual({'hit': 0, 'revalidated': 0, 'miss': 2}, cache.stats)
+
+    def test_etag_revalidation(self):
+        cache = ResponseCache(tempfile.mkdtemp(), ttl=60)
+        with FakeBrapiServer(lists={'studies': self.studies}, etag=True) as server:
+            results = self.fetch_twice(server, cache)
+
+        self.assertEqual([self.studies, self.studies], results)
+        self.assertEqual(2, len(server.requests))
+        self.assertEqual({'hit': 0, 'revalidated': 1, 'miss': 1}, cache.stats)
+
+    def test_key(self):
+        key = ResponseCache.get_key('GET', 'http://brapi/studies', {'page': 0, 'pageSize': 10})
+        self.assertEqual(key, ResponseCache.get_key('GET', 'http://brapi/studies', {'pageSize': 10, 'page': 0}))
+        self.assertNotEqual(key, ResponseCache.get_key('POST', 'http://brapi/studies', {'page': 0, 'pageSize': 10}))
+
+    def test_key_pagination(self):
+        key = ResponseCache.get_key('POST', 'http://brapi/search/studies', {'page': 1, 'pageSize': 10, 'name': '2'})
+        self.assertEqual(key, ResponseCache.get_key('POST', 'http://brapi/search/studies',
+                                                    '{"pageSize": "10", "name": "2", "page": "1"}'))
+        self.assertNotEqual(key, ResponseCache.get_key('POST', 'http://brapi/search/studies',
+                                                       {'page': 1, 'pageSize': 10, 'name': 2}))
+        self.assertNotEqual(key, ResponseCache.get_key('POST', 'http://brapi/search/studies',
+                                                       {'page': 1, 'pageSize': 20, 'name': '2'}))
@@ -0,0 +1,303 @@
+import threading
+import time
+import unittest
+
+import requests
+
+from etl.common.brapi import BreedingAPIIterator, BrapiSession, BrapiServerError
+from etl.common.concurrency import AdaptiveLimiter, LatencyTracker, RequestBudget, WorkScheduler, get_retry_delay
+from tests.extract.utils import FakeBrapiServer
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    def test_additive_increase(self):
+        limiter = AdaptiveLimiter(max_limit=4)
+        self.assertEqual(2, limiter.limit)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(latency=0.1)
+        self.assertEqual(4, limiter.limit)
+
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveLimiter(max_limit=8, min_limit=2)
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(overloaded=True)
+        # A burst of overloaded responses only halves the limit once
+        self.assertEqual(2, limiter.limit)
+        self.assertEqual({'requests': 3, 'overloaded': 3}, limiter.stats)
+
+    def test_latency_compared_by_endpoint(self):
+        limiter = AdaptiveLimiter(max_limit=10)
+        for i in range(100):
+            limiter.acquire()
+            if i % 2:
+                limiter.release(latency=1.0, endpoint='GET studies')
+            else:
+                limiter.release(latency=0.05, endpoint='GET studies/{studyDbId}')
+        # Slow pages are not a latency spike of fast detail calls
+        self.assertEqual(10, limiter.limit)
+
+        for _ in range(5):
+            limiter.acquire()
+            limiter.release(latency=0.5, endpoint='GET studies/{studyDbId}')
+        self.assertEqual(5, limiter.limit)
+
+    def test_acquire_waits_for_release(self):
+        limiter = AdaptiveLimiter(max_limit=1)
+        limiter.acquire()
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release(latency=0.1)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+
+class TestRetryDelay(unittest.TestCase):
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(3, get_retry_delay(0, '3'))
+        self.assertEqual(60, get_retry_delay(0, '3600', max_delay=60))
+
+    def test_retry_after_date(self):
+        retry_after = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 10))
+        self.assertTrue(8 <= get_retry_delay(0, retry_after) <= 10)
+
+    def test_exponential_backoff(self):
+        self.assertTrue(2 <= get_retry_delay(2, base_delay=1) <= 4)
+        self.assertTrue(2 <= get_retry_delay(2, 'invalid date', base_delay=1) <= 4)
+
+
+class TestSessionRetries(unittest.TestCase):
+    call = {'method': 'GET', 'path': 'studies/1'}
+
+    def test_retry_overloaded(self):
+        session = BrapiSession(limiter=AdaptiveLimiter(max_limit=2))
+        with FakeBrapiServer(objects={'studies/1': {'studyDbId': '1'}}, errors={'studies/1': [503, 429]}) as server:
+            actual = list(BreedingAPIIterator.fetch_all(server.url, self.call, session=session))
+        session.close()
+
+        self.assertEqual([{'studyDbId': '1'}], actual)
+        self.assertEqual(2, session.retry_count)
+        self.assertEqual(2, session.limiter.stats['overloaded'])
+
+    def test_max_retries(self):
+        session = BrapiSession(max_retries=1, retry_base_delay=0)
+        with FakeBrapiServer(objects={'studies/1': {'studyDbId': '1'}}, errors={'studies/1': [502, 502]}) as server:
+            with self.assertRaises(BrapiServerError):
+                list(BreedingAPIIterator.fetch_all(server.url, self.call, session=session))
+        session.close()
+        self.assertEqual(2, len(server.requests))
+
+
+class TestLatencyTracker(unittest.TestCase):
+
+    def test_percentiles(self):
+        tracker = LatencyTracker(window=100)
+        for latency in range(200):
+            tracker.record('GET studies', latency)
+        self.assertEqual(200, tracker.count('GET studies'))
+        self.assertEqual(150, tracker.percentile('GET studies', 50))
+        self.assertEqual({'GET studies': (200, 150, 199)}, tracker.get_stats())
+        self.assertIsNone(tracker.percentile('GET germplasm', 50))
+
+
+class TestSessionTimeouts(unittest.TestCase):
+    call = {'method': 'GET', 'path': 'studies/1'}
+
+    def test_read_timeout(self):
+        session = BrapiSession(max_retries=0, timeout=(1, 0.2))
+        with FakeBrapiServer(objects={'studies/1': {'studyDbId': '1'}}, delays={'studies/1': [1]}) as server:
+            with self.assertRaises(requests.Timeout):
+                list(BreedingAPIIterator.fetch_all(server.url, self.call, session=session))
+        session.close()
+
+    def test_hedged_request(self):
+        session = BrapiSession(hedge_percentile=90, hedge_min_samples=5, max_hedge_ratio=1)
+        with FakeBrapiServer(objects={'studies/1': {'studyDbId': '1'}}) as server:
+            for _ in range(5):
+                list(BreedingAPIIterator.fetch_all(server.url, self.call, session=session))
+
+            # The next request is stuck: its duplicate answers first
+            server.delays['studies/1'] = [2]
+            start = time.perf_counter()
+            actual = list(BreedingAPIIterator.fetch_all(server.url, self.call, session=session))
+            duration = time.perf_counter() - start
+        session.close()
+
+        self.assertEqual([{'studyDbId': '1'}], actual)
+        self.assertLess(duration, 1)
+        self.assertEqual({'sent': 1, 'won': 1}, session.hedge_stats)
+        self.assertEqual(7, len(server.requests))
+
+    def test_hedge_delay_after_send(self):
+        session = BrapiSession(pool_size=1, hedge_percentile=50, hedge_min_samples=5, max_hedge_ratio=1)
+        for _ in range(5):
+            session.latency.record('GET studies/1', 0.5)
+        # The primary request waits for the only executor thread longer than the hedge delay
+        session.hedge_executor.submit(time.sleep, 1)
+        with FakeBrapiServer(objects={'studies/1': {'studyDbId': '1'}}) as server:
+            actual = list(BreedingAPIIterator.fetch_all(server.url, self.call, session=session))
+        session.close()
+
+        self.assertEqual([{'studyDbId': '1'}], actual)
+        self.assertEqual({'sent': 0, 'won': 0}, session.hedge_stats)
+        self.assertEqual(1, len(server.requests))
+
+    def test_hedge_within_limiter(self):
+        for (max_limit, nb_hedges) in [(2, 0), (4, 1)]:
+            limiter = AdaptiveLimiter(max_limit)
+            session = BrapiSession(hedge_percentile=90, hedge_min_samples=5, max_hedge_ratio=1, limiter=limiter)
+            with FakeBrapiServer(objects={'studies/1': {'studyDbId': '1'}}) as server:
+                for _ in range(5):
+                    list(BreedingAPIIterator.fetch_all(server.url, self.call, session=session))
+                # A request of another call holds a request slot (the limit grew to 2 and 3 requests in flight)
+                limiter.acquire()
+                server.delays['studies/1'] = [1]
+                list(BreedingAPIIterator.fetch_all(server.url, self.call, session=session))
+                limiter.release()
+                session.close()
+
+            self.assertEqual(nb_hedges, session.hedge_stats['sent'])
+            self.assertEqual(6 + nb_hedges, len(server.requests))
+            self.assertEqual(0, limiter.in_flight)
+
+
+class TestRequestBudget(unittest.TestCase):
+
+    def test_max_per_host(self):
+        budget = RequestBudget(3, max_per_host=2)
+        self.assertTrue(budget.acquire('a'))
+        self.assertTrue(budget.acquire('a'))
+        self.assertFalse(budget.acquire('a', blocking=False))
+        self.assertTrue(budget.acquire('b'))
+        self.assertFalse(budget.acquire('c', blocking=False))
+        budget.release('a')
+        self.assertTrue(budget.acquire('c', blocking=False))
+
+    def test_shared_by_sessions(self):
+        max_in_flight = list()
+
+        class RecordingBudget(RequestBudget):
+            def acquire(self, host, blocking=True):
+                acquired = super(RecordingBudget, self).acquire(host, blocking)
+                max_in_flight.append(self.in_flight)
+                return acquired
+
+        budget = RecordingBudget(2)
+        germplasm = [{'germplasmDbId': str(i)} for i in range(8)]
+        call = {'method': 'GET', 'path': 'germplasm', 'page-size': 1}
+        sessions = [BrapiSession(budget=budget), BrapiSession(budget=budget)]
+        with FakeBrapiServer(lists={'germplasm': germplasm}, delays={'germplasm': [0.02] * 16}) as server:
+            # Each session fetches its pages 4 at a time
+            threads = [threading.Thread(target=lambda session: list(BreedingAPIIterator.fetch_all(
+                server.url, call, session=session, concurrency=4)), args=(session,)) for session in sessions]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        for session in sessions:
+            session.close()
+
+        self.assertEqual(16, len(server.requests))
+        self.assertEqual(2, max(max_in_flight))
+        self.assertEqual(0, budget.in_flight)
+
+
+class TestWorkScheduler(unittest.TestCase):
+    """
+    Schedule the tasks of several sources on shared workers
+    """
+
+    def test_max_per_host(self):
+        running = {'a': 0, 'b': 0}
+        max_running = {'a': 0, 'b': 0}
+        lock = threading.Lock()
+
+        def task(host):
+            with lock:
+                running[host] += 1
+                max_running[host] = max(max_running[host], running[host])
+            time.sleep(0.02)
+            with lock:
+                running[host] -= 1
+            return host
+
+        scheduler = WorkScheduler(6, max_per_host=2)
+        pools = [scheduler.get_pool('a'), scheduler.get_pool('a'), scheduler.get_pool('b')]
+        results = [pool.imap_unordered(task, [pool.host] * 10) for pool in pools]
+        actual = [list(result) for result in results]
+        scheduler.close()
+
+        self.assertEqual([['a'] * 10, ['a'] * 10, ['b'] * 10], actual)
+        self.assertEqual({'a': 2, 'b': 2}, max_running)
+
+    def test_largest_first(self):
+        started = list()
+        scheduler = WorkScheduler(1)
+        blocker = threading.Event()
+        pool_small, pool_large = scheduler.get_pool('small'), scheduler.get_pool('large')
+
+        # Keep the only worker busy while both sources submit their tasks
+        blocking = scheduler.get_pool('other').imap_unordered(lambda _: blocker.wait(), [None])
+        small = pool_small.imap_unordered(started.append, ['small'] * 2)
+        large = pool_large.imap_unordered(started.append, ['large'] * 4)
+        blocker.set()
+        list(blocking), list(small), list(large)
+        scheduler.close()
+
+        # Ties go to the first source
+        self.assertEqual(['large', 'large', 'small', 'large', 'small', 'large'], started)
+
+    def test_limiter_capacity(self):
+        running = [0]
+        max_running = [0]
+        lock = threading.Lock()
+
+        def task(_):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        # Workers are not given tasks of a source without capacity in its limiter
+        scheduler = WorkScheduler(4)
+        pool = scheduler.get_pool('host', AdaptiveLimiter(max_limit=2, min_limit=1))
+        pool.limiter.limit = 1
+        list(pool.imap_unordered(task, range(5)))
+        scheduler.close()
+        self.assertEqual(1, max_running[0])
+
+    def test_terminate_join(self):
+        finished = list()
+
+        def task(value):
+            if value == 0:
+                raise ZeroDivisionError()
+            time.sleep(0.2)
+            finished.append(value)
+
+        scheduler = WorkScheduler(2)
+        pool = scheduler.get_pool('host')
+        with self.assertRaises(ZeroDivisionError):
+            list(pool.imap_unordered(task, [1, 0, 2, 3]))
+        pool.terminate()
+        pool.join()
+        scheduler.close()
+        # The tasks running when the other failed are waited for, the pending ones are cancelled
+        self.assertEqual(0, pool.running)
+        self.assertIn(1, finished)
+        self.assertNotIn(3, finished)
+
+    def test_error(self):
+        scheduler = WorkScheduler(2)
+        pool = scheduler.get_pool('host')
+        with self.assertRaises(ZeroDivisionError):
+            list(pool.imap_unordered(lambda value: 1 / value, [1, 0, 2]))
+        self.assertEqual([1.0], list(pool.imap_unordered(lambda value: 1 / value, [1])))
+        scheduler.close()
@@ -0,0 +1,47 @@
+import json
+import unittest
+
+from etl.common import json_codec
+
+
+class TestJSONCodec(unittest.TestCase):
+    """
+    Encode and decode JSON with each installed backend
+    """
+    data = {'germplasmDbId': '1', 'name': 'é', 'studyDbIds': {'S1'}, 'bytes': b'abc', 'size': 12.5, 'none': None,
+            'big': 2 ** 70, 'object': {1: [True, False]}}
+    expected = {'germplasmDbId': '1', 'name': 'é', 'studyDbIds': ['S1'], 'bytes': 'abc', 'size': 12.5, 'none': None,
+                'big': 2 ** 70, 'object': {'1': [True, False]}}
+
+    def tearDown(self):
+        json_codec.set_backend()
+
+    def get_backends(self):
+        return ['json'] + (['orjson'] if json_codec.orjson is not None else [])
+
+    def test_dumps_loads(self):
+        for backend in self.get_backends():
+            json_codec.set_backend(backend)
+            text = json_codec.dumps(self.data)
+            self.assertEqual(self.expected, json.loads(text))
+            self.assertEqual(self.expected, json_codec.loads(text))
+            self.assertEqual(self.expected, json_codec.loads(text.encode()))
+
+    def test_same_output(self):
+        data = {'name': 'Peuplier noir é', 'studyDbIds': ['S1', 'S2'], 'size': 12.5, 'object': {'a': [True, None]}}
+        outputs = set()
+        for backend in self.get_backends():
+            json_codec.set_backend(backend)
+            outputs.add(json_codec.dumps(data))
+        expected = '{"name":"Peuplier noir é","studyDbIds":["S1","S2"],"size":12.5,"object":{"a":[true,null]}}'
+        self.assertEqual({expected}, outputs)
+
+    def test_not_serializable(self):
+        for backend in self.get_backends():
+            json_codec.set_backend(backend)
+            with self.assertRaises(TypeError):
+                json_codec.dumps({'object': object()})
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            json_codec.set_backend('simplejson')
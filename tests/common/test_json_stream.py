@@ -0,0 +1,101 @@
+import json
+import os
+import tempfile
+import unittest
+
+from etl.common.json_stream import JSONArrayStreamParser, iter_json_array_stream, JSONLinesWriter, \
+    convert_json_file_to_lines
+
+
+class TestJSONArrayStreamParser(unittest.TestCase):
+    """
+    Parse the elements of a JSON array incrementally
+    """
+    document = {
+        'metadata': {'pagination': {'currentPage': 0, 'totalPages': 2}, 'status': [], 'datafiles': []},
+        'result': {'data': [{'germplasmDbId': '1', 'synonyms': ['a', 'b]'], 'name': 'é{'}, 12.5, 'x', None,
+                            [1, 2]],
+                   'other': {'data': [1]}},
+    }
+
+    def parse(self, text, chunk_size, path=('result', 'data')):
+        body = text.encode('utf-8')
+        chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+        parser = JSONArrayStreamParser(path)
+        elements = list()
+        for chunk in chunks:
+            elements.extend(parser.feed(chunk))
+        elements.extend(parser.close())
+        return elements, parser.document
+
+    def test_chunk_sizes(self):
+        text = json.dumps(self.document, indent=2, ensure_ascii=False)
+        expected_document = dict(self.document, result=dict(self.document['result'], data=[]))
+        for chunk_size in [1, 2, 7, 64, len(text)]:
+            elements, document = self.parse(text, chunk_size)
+            self.assertEqual(self.document['result']['data'], elements)
+            self.assertEqual(expected_document, document)
+
+    def test_path_not_found(self):
+        text = json.dumps({'metadata': {}, 'result': {'germplasmDbId': '1'}})
+        elements, document = self.parse(text, 5)
+        self.assertEqual([], elements)
+        self.assertEqual(json.loads(text), document)
+
+    def test_unterminated_array(self):
+        parser = JSONArrayStreamParser(['data'])
+        parser.feed('{"data": [1, 2')
+        with self.assertRaises(ValueError):
+            parser.close()
+
+    def test_iter_json_array_stream(self):
+        chunks = ['{"data": [{"a"', ': 1}, {"b": 2}', ']}']
+        self.assertEqual([{'a': 1}, {'b': 2}], list(iter_json_array_stream(chunks, ['data'])))
+
+    def test_document_array(self):
+        self.assertEqual([{'a': 1}, [2], 3], list(iter_json_array_stream(['[{"a": 1}, [2]', ', 3]'])))
+
+
+class TestConvertJSONFileToLines(unittest.TestCase):
+    """
+    Convert JSON array files into JSON lines files
+    """
+    data = [{'germplasmDbId': str(i), 'name': 'é' * i} for i in range(100)]
+
+    def write_file(self, content):
+        json_path = os.path.join(tempfile.mkdtemp(), 'germplasm.json')
+        with open(json_path, 'wb') as json_file:
+            json_file.write(content)
+        return json_path
+
+    def read_lines(self, json_path):
+        with open(json_path, 'r') as json_file:
+            return [json.loads(line) for line in json_file]
+
+    def test_convert_in_place(self):
+        json_path = self.write_file(b'\xef\xbb\xbf\n ' + json.dumps(self.data, indent=2, ensure_ascii=False).encode())
+        self.assertTrue(convert_json_file_to_lines(json_path, chunk_size=7))
+        self.assertEqual(self.data, self.read_lines(json_path))
+
+        # Already in JSON lines
+        self.assertFalse(convert_json_file_to_lines(json_path))
+        self.assertEqual(self.data, self.read_lines(json_path))
+        self.assertEqual(['germplasm.json'], os.listdir(os.path.dirname(json_path)))
+
+    def test_copy_json_lines(self):
+        json_path = self.write_file(''.join(json.dumps(data) + '\n' for data in self.data).encode())
+        self.assertFalse(convert_json_file_to_lines(json_path, json_path + '.out', chunk_size=7))
+        self.assertEqual(self.data, self.read_lines(json_path + '.out'))
+
+    def test_writer_fed_by_chunks(self):
+        json_path = os.path.join(tempfile.mkdtemp(), 'germplasm.json')
+        writer = JSONLinesWriter(json_path)
+        for chunk in [b'  ', b'\n[', b'{"a"', b': 1}, 2', b']']:
+            writer.feed(chunk)
+        writer.close()
+        self.assertEqual([{'a': 1}, 2], self.read_lines(json_path))
+
+        writer = JSONLinesWriter(json_path)
+        writer.feed(b'[{"a": 1}, {')
+        writer.discard()
+        self.assertFalse(os.path.exists(json_path))
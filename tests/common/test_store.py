@@ -1,10 +1,12 @@
+import json
 import os
 import tempfile
 import unittest
 
 from multiprocessing.pool import Pool
 
-from etl.common.store import MergeStore
+from etl.common.compression import open_file
+from etl.common.store import MergeStore, JSONSplitStore, list_entity_files, load_entity_lines, get_change_set
 
 
 class TestMergeStore(unittest.TestCase):
@@ -44,4 +46,150 @@ class TestMergeStore(unittest.TestCase):
         actual = len(lines)
         self.assertEqual(expected, actual)
 
+    def test_dirty_ids(self):
+        store = MergeStore('source', 'entity')
+        store.add({'entityDbId': '1'})
+        store.add({'entityDbId': '2'})
+        self.assertEqual({'1', '2'}, store.reset_dirty())
 
+        store.add({'entityDbId': '2', 'name': 'foo'})
+        store.add({'entityDbId': '3'})
+        self.assertEqual({'2', '3'}, store.reset_dirty())
+        self.assertEqual(set(), store.reset_dirty())
+
+    def test_spill(self):
+        tmp_dir = tempfile.mkdtemp()
+        store = MergeStore('source', 'entity', spill_threshold=3, spill_dir=tmp_dir, hot_cache_size=2)
+        for i in range(5):
+            store.add({'entityDbId': str(i), 'name': 'foo'})
+        self.assertIsNotNone(store.database)
+        self.assertEqual(5, len(store))
+        self.assertEqual(2, len(dict(dict.items(store))))
+
+        # Merge by id and changes in place are kept
+        store.add({'entityDbId': '0', 'bar': 'baz'})
+        for (data_id, data) in store.items():
+            data['index'] = int(data_id)
+        self.assertIn('4', store)
+        self.assertNotIn('5', store)
+        self.assertEqual({'entityDbId': '0', 'name': 'foo', 'bar': 'baz', 'source': 'source', 'index': 0}, store['0'])
+        self.assertEqual(['0', '1', '2', '3', '4'], list(store.keys()))
+
+        store.save(tmp_dir)
+        with open(os.path.join(tmp_dir, 'entity.json'), 'r') as json_file:
+            saved = [json.loads(line) for line in json_file]
+        self.assertEqual(list(range(5)), [data['index'] for data in saved])
+
+        store.clear()
+        self.assertEqual(0, len(store))
+        self.assertEqual(['entity.json'], os.listdir(tmp_dir))
+
+    def test_save_link_sets(self):
+        tmp_dir = tempfile.mkdtemp()
+        store = MergeStore('source', 'entity')
+        store.add({'entityDbId': '1'})
+        store['1']['studyDbIds'] = {'S2', 'S10', 'S1'}
+        store.save(tmp_dir)
+
+        with open(os.path.join(tmp_dir, 'entity.json'), 'r') as json_file:
+            self.assertEqual(['S1', 'S10', 'S2'], json.load(json_file)['studyDbIds'])
+
+    def test_spill_hot_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        store = MergeStore('source', 'entity', spill_threshold=4, spill_dir=tmp_dir, hot_cache_size=2)
+        for i in range(5):
+            store.add({'entityDbId': str(i)})
+        # The most recently added objects are kept in memory
+        self.assertEqual(['3', '4'], sorted(dict.keys(store)))
+
+        # Then the most recently used ones
+        store['0']['name'] = 'foo'
+        store.add({'entityDbId': '5'})
+        self.assertEqual(['0', '5'], sorted(dict.keys(store)))
+        store.add({'entityDbId': '6'})
+        self.assertEqual(['5', '6'], sorted(dict.keys(store)))
+        self.assertEqual('foo', store['0']['name'])
+
+    def test_spill_iter_changed(self):
+        tmp_dir = tempfile.mkdtemp()
+        store = MergeStore('source', 'entity', spill_threshold=1, spill_dir=tmp_dir, hot_cache_size=1)
+        for i in range(3):
+            store.add({'entityDbId': str(i)})
+        # Changed in memory only, then evicted while iterating before its row is reached
+        store.add({'entityDbId': '1', 'name': 'foo'})
+
+        self.assertEqual({'0': None, '1': 'foo', '2': None},
+                         {data_id: data.get('name') for (data_id, data) in store.items()})
+        self.assertEqual('foo', store['1']['name'])
+
+    def test_spill_link_sets(self):
+        tmp_dir = tempfile.mkdtemp()
+        store = MergeStore('source', 'entity', spill_threshold=1, spill_dir=tmp_dir, hot_cache_size=1)
+        store.add({'entityDbId': '1', 'germplasmDbIds': ['G2', 'G1']})
+        store['1']['studyDbIds'] = {'S2', 'S10', 'S1'}
+        store.add({'entityDbId': '2'})
+        store.add({'entityDbId': '3'})
+        self.assertIsNone(dict.get(store, '1'))
+
+        # Sets are restored from the database, lists are kept as they are
+        self.assertEqual({'S2', 'S10', 'S1'}, store['1']['studyDbIds'])
+        self.assertEqual(['G2', 'G1'], store['1']['germplasmDbIds'])
+        store.save(tmp_dir)
+        with open(os.path.join(tmp_dir, 'entity.json'), 'r') as json_file:
+            saved = json.loads(json_file.readline())
+        self.assertEqual(['S1', 'S10', 'S2'], saved['studyDbIds'])
+        self.assertEqual(['G2', 'G1'], saved['germplasmDbIds'])
+
+    def test_is_redundant(self):
+        store = MergeStore('source', 'entity')
+        store.add({'entityDbId': '1', 'name': 'foo', 'object': {'a': 'b'}})
+        self.assertTrue(store.is_redundant({'entityDbId': '1', 'name': 'foo', 'object': {'a': 'b'}, 'empty': None}))
+        self.assertTrue(store.is_redundant({'entityDbId': '1', 'object': {'a': 'b'}}))
+        self.assertFalse(store.is_redundant({'entityDbId': '1', 'object': {'c': 'd'}}))
+        self.assertFalse(store.is_redundant({'entityDbId': '2'}))
+        self.assertEqual({'entityDbId': '1', 'name': 'foo', 'object': {'a': 'b'}, 'source': 'source'}, store['1'])
+
+    def test_save_compressed(self):
+        for (codec, extension) in [('gzip', '.gz'), ('bz2', '.bz2'), ('lzma', '.xz')]:
+            tmp_dir = tempfile.mkdtemp()
+            store = MergeStore('source', 'entity', compression=codec)
+            store.add({'entityDbId': '1', 'name': 'é'})
+            store.add({'entityDbId': '2'})
+            store.save(tmp_dir)
+
+            self.assertEqual([('entity', os.path.join(tmp_dir, 'entity.json' + extension))],
+                             list(list_entity_files(tmp_dir)))
+            lines = list(load_entity_lines(list(list_entity_files(tmp_dir))[0]))
+            self.assertEqual({'entityDbId': '1', 'name': 'é', 'source': 'source'}, json.loads(lines[0][1]))
+
+
+    def test_save_fingerprints(self):
+        fingerprints = dict()
+        store = MergeStore('source', 'entity')
+        store.add({'entityDbId': '1', 'name': 'foo'})
+        store.add({'entityDbId': '2', 'name': 'bar'})
+        store['2']['studyDbIds'] = {'S1'}
+        store.save(tempfile.mkdtemp(), fingerprints)
+        self.assertEqual(['1', '2'], sorted(fingerprints))
+
+        previous_fingerprints = dict(fingerprints, **{'3': 0})
+        store['1']['name'] = 'baz'
+        store.save(tempfile.mkdtemp(), fingerprints)
+        self.assertEqual({'added': [], 'changed': ['1'], 'removed': ['3']},
+                         get_change_set(previous_fingerprints, fingerprints))
+
+class TestJSONSplitStore(unittest.TestCase):
+
+    def test_split_compressed(self):
+        tmp_dir = tempfile.mkdtemp()
+        store = JSONSplitStore(tmp_dir, 'entity', buffer_size=2, max_file_byte_size=50, compression='gzip')
+        for i in range(5):
+            store.dump({'entityDbId': str(i), 'name': 'foo'})
+        store.close()
+
+        self.assertEqual(['entity-1.json.gz', 'entity-2.json.gz', 'entity-3.json.gz'], sorted(os.listdir(tmp_dir)))
+        data_ids = list()
+        for file_name in sorted(os.listdir(tmp_dir)):
+            with open_file(os.path.join(tmp_dir, file_name)) as json_file:
+                data_ids.extend(json.loads(line)['entityDbId'] for line in json_file)
+        self.assertEqual(['0', '1', '2', '3', '4'], data_ids)
@@ -1,13 +1,24 @@
+import asyncio
+import hashlib
+import json
 import unittest
 import tempfile
+import threading
+import time
 import os
 
-from etl.extract.brapi import extract_statics_files
+from etl.common.compression import open_file
+from etl.common.concurrency import RequestBudget, WorkScheduler
+from etl.common.store import load_change_set
+from etl.extract.brapi import extract_statics_files, extract_source, save_source_state
+from etl.extract.brapi_async import extract_sources
+from tests.extract.utils import FakeBrapiServer, FakeFileServer
 
 class MyTestCase(unittest.TestCase):
     def test_extract_statics_files(self):
         config = {
             "log-dir": "./log",
+            "data-dir": tempfile.mkdtemp(),
             "options": { "verbose": True}
         }
         source = {
@@ -31,5 +42,425 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue("study.json" in files)
         self.assertFalse("toto.json" in files)
 
+
+class TestExtractStaticFiles(unittest.TestCase):
+    config = {
+        'log-dir': tempfile.mkdtemp(),
+        'options': {'verbose': False}
+    }
+
+    def get_test_server(self):
+        studies = [{'studyDbId': str(i), 'studyName': 'Study ' + str(i) * 100} for i in range(1000)]
+        germplasm = [{'germplasmDbId': 'G1'}]
+        return FakeFileServer(files={'study.json': json.dumps(studies).encode(),
+                                     'germplasm.json': json.dumps(germplasm).encode()})
+
+    def extract(self, server, config, output_dir):
+        source = {'schema:identifier': 'STATIC', 'brapi:static-file-repository-url': server.url}
+        server.requests.clear()
+        extract_statics_files(source, output_dir, ['study', 'germplasm', 'trial'], config)
+        with open(os.path.join(output_dir, 'study.json')) as json_file:
+            self.assertEqual(1000, len([json.loads(line) for line in json_file]))
+        return {path: headers for (path, headers) in server.requests}
+
+    def test_unchanged_files(self):
+        output_dir = tempfile.mkdtemp()
+        config = dict(self.config, **{'data-dir': tempfile.mkdtemp()})
+        with self.get_test_server() as server:
+            self.assertEqual({}, self.extract(server, config, output_dir)['study.json'])
+            self.assertEqual(['germplasm.json', 'study.json'], sorted(os.listdir(output_dir)))
+
+            # Conditional requests on the next extraction
+            self.assertIn('If-None-Match', self.extract(server, config, output_dir)['study.json'])
+
+            server.files['germplasm.json'] = json.dumps([{'germplasmDbId': 'G2'}]).encode()
+            self.extract(server, config, output_dir)
+        with open(os.path.join(output_dir, 'germplasm.json')) as json_file:
+            self.assertEqual({'germplasmDbId': 'G2'}, json.load(json_file))
+
+    def test_resume_download(self):
+        output_dir = tempfile.mkdtemp()
+        config = dict(self.config, **{'data-dir': tempfile.mkdtemp()})
+        with self.get_test_server() as server:
+            server.cuts['study.json'] = 200000
+            source = {'schema:identifier': 'STATIC', 'brapi:static-file-repository-url': server.url}
+            extract_statics_files(source, output_dir, ['study'], config)
+            self.assertEqual(['study.json.part'], os.listdir(output_dir))
+            part_size = os.path.getsize(os.path.join(output_dir, 'study.json.part'))
+            self.assertGreater(part_size, 0)
+
+            headers = self.extract(server, config, output_dir)['study.json']
+        self.assertEqual('bytes={}-'.format(part_size), headers['Range'])
+        self.assertEqual(['germplasm.json', 'study.json'], sorted(os.listdir(output_dir)))
+
+    def test_resume_complete_download(self):
+        for extra in [b'', b'garbage']:
+            output_dir = tempfile.mkdtemp()
+            config = dict(self.config, **{'data-dir': tempfile.mkdtemp()})
+            with self.get_test_server() as server:
+                # Downloaded but not converted by a previous extraction, the file size being unknown
+                content = server.files['study.json']
+                with open(os.path.join(output_dir, 'study.json.part'), 'wb') as part_file:
+                    part_file.write(content + extra)
+                etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+                save_source_state(config, 'STATIC', 'static-files', {'study': {
+                    'url': server.url + 'study.json', 'etag': etag, 'modified': None, 'size': None,
+                    'complete': False}})
+
+                self.extract(server, config, output_dir)
+                ranges = [headers.get('Range') for (path, headers) in server.requests if path == 'study.json']
+            # Complete (416 with the size of the part file) or downloaded again from the start
+            range_header = 'bytes={}-'.format(len(content + extra))
+            self.assertEqual([range_header, None] if extra else [range_header], ranges)
+            self.assertEqual(['germplasm.json', 'study.json'], sorted(os.listdir(output_dir)))
+
+
+def get_test_entities():
+    return {
+        'study': {
+            'name': 'study',
+            'list': {'call': {'method': 'GET', 'path': 'studies', 'page-size': 2}},
+            'detail': {'call': {'method': 'GET', 'path': 'studies/{studyDbId}'}},
+            'links': [{'type': 'external-object', 'entity': 'germplasm',
+                       'call': {'method': 'GET', 'path': 'studies/{studyDbId}/germplasm', 'page-size': 2}}]
+        },
+        'germplasm': {
+            'name': 'germplasm',
+            'detail': {'call': {'method': 'GET', 'path': 'germplasm/{germplasmDbId}'}}
+        }
+    }
+
+
+def get_test_server(nb_studies=3):
+    lists = {'studies': [{'studyDbId': str(i)} for i in range(nb_studies)]}
+    objects = {}
+    for i in range(nb_studies):
+        objects['studies/' + str(i)] = {'studyDbId': str(i), 'studyName': 'Study ' + str(i)}
+        lists['studies/' + str(i) + '/germplasm'] = [{'germplasmDbId': 'G' + str(i)}, {'germplasmDbId': 'G0'}]
+        objects['germplasm/G' + str(i)] = {'germplasmDbId': 'G' + str(i), 'germplasmName': 'Germplasm ' + str(i)}
+    return FakeBrapiServer(lists=lists, objects=objects)
+
+
+def get_test_source(server):
+    return {
+        'schema:identifier': 'TEST',
+        'brapi:endpointUrl': server.url,
+        'implemented-calls': {'GET studies', 'GET studies/{studyDbId}', 'GET studies/{studyDbId}/germplasm',
+                              'GET germplasm/{germplasmDbId}'}
+    }
+
+
+def load_output(output_dir):
+    output = {}
+    for file_name in os.listdir(output_dir):
+        if os.path.isdir(os.path.join(output_dir, file_name)):
+            continue
+        with open_file(os.path.join(output_dir, file_name)) as json_file:
+            # Streamed entities are split in several files (ex: observationUnit-1.json)
+            entity_name = file_name.split('.')[0].split('-')[0]
+            output[file_name] = {data[entity_name + 'DbId']: data
+                                 for data in map(json.loads, json_file)}
+    return output
+
+
+class TestExtractSource(unittest.TestCase):
+    config = {
+        'log-dir': tempfile.mkdtemp(),
+        'data-dir': tempfile.mkdtemp(),
+        'options': {'verbose': False}
+    }
+
+    def extract_source(self, source, entities, config, output_dir, scheduler=None):
+        extract_source(source, entities, config, output_dir, scheduler)
+
+    def test_extract_source(self):
+        output_dir = tempfile.mkdtemp()
+        with get_test_server() as server:
+            self.extract_source(get_test_source(server), get_test_entities(), self.config, output_dir)
+
+        output = load_output(output_dir)
+        self.assertEqual(['germplasm.json', 'study.json'], sorted(output))
+        study = output['study.json']['1']
+        self.assertEqual('Study 1', study['studyName'])
+        self.assertEqual(['G0', 'G1'], sorted(study['germplasmDbIds']))
+        self.assertEqual('Germplasm 2', output['germplasm.json']['G2']['germplasmName'])
+        self.assertEqual(['0', '1', '2'], sorted(output['germplasm.json']['G0']['studyDbIds']))
+
+    def test_extract_source_spilled(self):
+        output_dir = tempfile.mkdtemp()
+        config = dict(self.config, **{'extract-brapi': {'store': {'spill-threshold': 1, 'hot-cache-size': 1}}})
+        with get_test_server() as server:
+            self.extract_source(get_test_source(server), get_test_entities(), config, output_dir)
+
+        output = load_output(output_dir)
+        self.assertEqual('Study 1', output['study.json']['1']['studyName'])
+        self.assertEqual(['G0', 'G1'], sorted(output['study.json']['1']['germplasmDbIds']))
+        self.assertEqual('Germplasm 2', output['germplasm.json']['G2']['germplasmName'])
+        self.assertEqual(['0', '1', '2'], sorted(output['germplasm.json']['G0']['studyDbIds']))
+
+    def test_extract_source_compressed(self):
+        output_dir = tempfile.mkdtemp()
+        config = dict(self.config, **{'extract-brapi': {'store': {'compression': 'gzip', 'compression-level': 1}}})
+        with get_test_server() as server:
+            self.extract_source(get_test_source(server), get_test_entities(), config, output_dir)
+
+        output = load_output(output_dir)
+        self.assertEqual(['germplasm.json.gz', 'study.json.gz'], sorted(output))
+        self.assertEqual('Study 1', output['study.json.gz']['1']['studyName'])
+
+    def extract_bulk_details(self, bulk_call, implemented_calls, async_search=False):
+        output_dir = tempfile.mkdtemp()
+        entities = get_test_entities()
+        entities['germplasm']['bulk-detail'] = {'ids-param': 'germplasmDbIds', 'batch-size': 2, 'poll-interval': 0,
+                                                'call': bulk_call}
+        with get_test_server() as server:
+            # G2 is missing from the search results
+            server.searches = {bulk_call['path']: [server.objects['germplasm/G' + str(i)] for i in range(2)]}
+            server.async_search = async_search
+            source = get_test_source(server)
+            source['implemented-calls'] = source['implemented-calls'] | implemented_calls
+            self.extract_source(source, entities, self.config, output_dir)
+            requested_paths = [path for (_, path, _) in server.requests]
+
+        output = load_output(output_dir)
+        self.assertEqual(['Germplasm 0', 'Germplasm 1', 'Germplasm 2'],
+                         sorted(germplasm['germplasmName'] for germplasm in output['germplasm.json'].values()))
+        return requested_paths
+
+    def test_bulk_details(self):
+        bulk_call = {'method': 'POST', 'path': 'germplasm-search', 'page-size': 10}
+        requested_paths = self.extract_bulk_details(bulk_call, {'POST germplasm-search'})
+        self.assertEqual(2, requested_paths.count('germplasm-search'))
+        self.assertEqual(['germplasm/G2'], [path for path in requested_paths if path.startswith('germplasm/')])
+
+    def test_bulk_details_async_search(self):
+        bulk_call = {'method': 'POST', 'path': 'search/germplasm', 'page-size': 10, 'async-search': True}
+        requested_paths = self.extract_bulk_details(bulk_call, {'POST search/germplasm'}, async_search=True)
+        self.assertEqual(2, requested_paths.count('search/germplasm'))
+        # Two polls per search, the results of the second one being used as first page
+        self.assertEqual(2, requested_paths.count('search/germplasm/0'))
+        self.assertEqual(['germplasm/G2'], [path for path in requested_paths if path.startswith('germplasm/')])
+
+    def test_bulk_details_async_search_answered(self):
+        # Results answered directly by the search call
+        bulk_call = {'method': 'POST', 'path': 'search/germplasm', 'page-size': 10, 'async-search': True}
+        requested_paths = self.extract_bulk_details(bulk_call, {'POST search/germplasm'})
+        self.assertEqual(2, requested_paths.count('search/germplasm'))
+        self.assertEqual(['germplasm/G2'], [path for path in requested_paths if path.startswith('germplasm/')])
+
+    def test_bulk_details_not_implemented(self):
+        bulk_call = {'method': 'POST', 'path': 'germplasm-search', 'page-size': 10}
+        requested_paths = self.extract_bulk_details(bulk_call, set())
+        self.assertNotIn('germplasm-search', requested_paths)
+        self.assertEqual(3, len([path for path in requested_paths if path.startswith('germplasm/')]))
+
+    def test_redundant_details(self):
+        output_dir = tempfile.mkdtemp()
+        with get_test_server(nb_studies=30) as server:
+            # Listed studies are already complete
+            server.lists['studies'] = [server.objects['studies/' + str(i)] for i in range(30)]
+            self.extract_source(get_test_source(server), get_test_entities(), self.config, output_dir)
+            requested_paths = [path for (_, path, _) in server.requests]
+
+        output = load_output(output_dir)
+        self.assertEqual('Study 12', output['study.json']['12']['studyName'])
+        study_details = [path for path in requested_paths if path.startswith('studies/') and '/germplasm' not in path]
+        self.assertEqual(10, len(study_details))
+
+    def test_sampled_details(self):
+        output_dir = tempfile.mkdtemp()
+        with get_test_server(nb_studies=30) as server:
+            self.extract_source(get_test_source(server), get_test_entities(), self.config, output_dir)
+            requested_paths = [path for (_, path, _) in server.requests]
+
+        output = load_output(output_dir)
+        self.assertEqual(['Study ' + str(i) for i in range(30)],
+                         sorted((study['studyName'] for study in output['study.json'].values()),
+                                key=lambda name: int(name.split()[1])))
+        study_details = [path for path in requested_paths if path.startswith('studies/') and '/germplasm' not in path]
+        self.assertEqual(30, len(study_details))
+
+    def test_cached_implemented_calls(self):
+        config = dict(self.config, **{'data-dir': tempfile.mkdtemp()})
+        with get_test_server() as server:
+            source = get_test_source(server)
+            server.lists['calls'] = [{'call': call.split(' ')[1], 'methods': [call.split(' ')[0]]}
+                                     for call in source.pop('implemented-calls')]
+            calls_requests = list()
+            for options in [{'verbose': False}, {'verbose': False}, {'verbose': False, 'refresh_calls': True}]:
+                server.requests.clear()
+                self.extract_source(dict(source), get_test_entities(), dict(config, options=options),
+                                    tempfile.mkdtemp())
+                calls_requests.append(len([path for (_, path, _) in server.requests if path == 'calls']))
+
+        self.assertEqual([1, 0, 1], calls_requests)
+
+    def test_linked_object_details(self):
+        output_dir = tempfile.mkdtemp()
+        with get_test_server() as server:
+            self.extract_source(get_test_source(server), get_test_entities(), self.config, output_dir)
+            requested_paths = [path for (_, path, _) in server.requests]
+
+        # Only objects discovered by links are detailed after the link phase (each object once)
+        self.assertEqual(1, requested_paths.count('studies/0'))
+        self.assertEqual(1, requested_paths.count('germplasm/G0'))
+        self.assertEqual(['germplasm/G0', 'germplasm/G1', 'germplasm/G2'],
+                         sorted(path for path in requested_paths if path.startswith('germplasm/')))
+
+    def test_stream_entity(self):
+        output_dir = tempfile.mkdtemp()
+        entities = get_test_entities()
+        entities['observationUnit'] = {
+            'name': 'observationUnit',
+            'stream': True,
+            'list': {'call': {'method': 'GET', 'path': 'observationunits', 'page-size': 2}},
+            'links': [{'type': 'internal', 'entity': 'study', 'json-path': '.'},
+                      {'type': 'internal', 'entity': 'observationVariable', 'json-path': '.observations'}]
+        }
+        with get_test_server() as server:
+            # Study 9 is not listed
+            server.objects['studies/9'] = {'studyDbId': '9', 'studyName': 'Study 9'}
+            server.lists['studies/9/germplasm'] = []
+            server.lists['observationunits'] = [{'observationUnitDbId': 'OU' + str(i), 'studyDbId': str(i % 3)}
+                                                for i in range(5)]
+            server.lists['observationunits'].append({'observationUnitDbId': 'OU9', 'studyDbId': '9'})
+            source = get_test_source(server)
+            source['implemented-calls'] = source['implemented-calls'] | {'GET observationunits'}
+            self.extract_source(source, entities, self.config, output_dir)
+
+        output = load_output(output_dir)
+        self.assertEqual(['germplasm.json', 'observationUnit-1.json', 'study.json'], sorted(output))
+        observation_units = output['observationUnit-1.json']
+        self.assertEqual(['OU0', 'OU1', 'OU2', 'OU3', 'OU4', 'OU9'], sorted(observation_units))
+        self.assertEqual(['9'], observation_units['OU9']['studyDbIds'])
+        self.assertEqual('TEST', observation_units['OU9']['source'])
+
+        # Linked objects missing from the stores are added by id and detailed, without the streamed object ids
+        studies = output['study.json']
+        self.assertEqual('Study 9', studies['9']['studyName'])
+        self.assertNotIn('observationUnitDbIds', studies['0'])
+
+    def test_change_sets(self):
+        config = dict(self.config, **{'data-dir': tempfile.mkdtemp()})
+        output_dir = tempfile.mkdtemp()
+        with get_test_server() as server:
+            self.extract_source(get_test_source(server), get_test_entities(), config, output_dir)
+        # No previous extraction to compare with
+        self.assertIsNone(load_change_set(output_dir, 'study'))
+
+        output_dir = tempfile.mkdtemp()
+        with get_test_server(nb_studies=4) as server:
+            server.lists['studies'] = [data for data in server.lists['studies'] if data['studyDbId'] != '2']
+            server.objects['studies/1']['studyName'] = 'Renamed study 1'
+            self.extract_source(get_test_source(server), get_test_entities(), config, output_dir)
+
+        self.assertEqual({'added': {'3'}, 'changed': {'1'}, 'removed': {'2'}}, load_change_set(output_dir, 'study'))
+        self.assertEqual({'added': {'G3'}, 'changed': {'G0'}, 'removed': {'G2'}},
+                         load_change_set(output_dir, 'germplasm'))
+        self.assertEqual(['0', '1', '3'], sorted(load_output(output_dir)['study.json']))
+
+    def test_concurrent_links(self):
+        output_dir = tempfile.mkdtemp()
+        with get_test_server(nb_studies=6) as server:
+            for i in range(6):
+                server.delays['studies/' + str(i) + '/germplasm'] = [0.5]
+            source = dict(get_test_source(server), **{'etl:min-concurrency': 6})
+            start = time.perf_counter()
+            self.extract_source(source, get_test_entities(), self.config, output_dir)
+            duration = time.perf_counter() - start
+
+        output = load_output(output_dir)
+        self.assertEqual([str(i) for i in range(6)], sorted(output['germplasm.json']['G0']['studyDbIds']))
+        self.assertLess(duration, 6 * 0.5 / 2)
+
+    def test_extract_source_scheduler(self):
+        output_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        scheduler = WorkScheduler(4, max_per_host=2)
+        budget = RequestBudget(4, max_per_host=2)
+        with get_test_server() as server1, get_test_server(nb_studies=5) as server2:
+            threads = list()
+            for (i, (server, output_dir)) in enumerate(zip([server1, server2], output_dirs)):
+                source = dict(get_test_source(server), **{'schema:identifier': 'TEST' + str(i)})
+                threads.append(threading.Thread(target=extract_source,
+                                                args=(source, get_test_entities(), self.config, output_dir,
+                                                      scheduler, budget)))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        scheduler.close()
+
+        output1, output2 = map(load_output, output_dirs)
+        self.assertEqual(['0', '1', '2'], sorted(output1['study.json']))
+        self.assertEqual(['0', '1', '2', '3', '4'], sorted(output2['germplasm.json']['G0']['studyDbIds']))
+
+    def test_failed_list_waits_for_running_lists(self):
+        output_dir = tempfile.mkdtemp()
+        entities = get_test_entities()
+        entities['germplasm']['list'] = {'call': {'method': 'GET', 'path': 'germplasm', 'page-size': 100}}
+        with get_test_server() as server:
+            server.lists['germplasm'] = [{'germplasmDbId': 'G' + str(i)} for i in range(3)]
+            server.delays['germplasm'] = [0.5]
+            server.errors['studies'] = [500]
+            source = get_test_source(server)
+            source['implemented-calls'] = source['implemented-calls'] | {'GET germplasm'}
+            scheduler = WorkScheduler(4)
+            self.extract_source(source, entities, self.config, output_dir, scheduler)
+            scheduler.close()
+
+        # The germplasm list still running when the study list failed is saved entirely
+        output = load_output(output_dir + '-failed')
+        self.assertEqual(['G0', 'G1', 'G2'], sorted(output['germplasm.json']))
+
+    def test_resume_extraction(self):
+        output_dir = tempfile.mkdtemp()
+        config = dict(self.config, **{'data-dir': tempfile.mkdtemp()})
+        with get_test_server() as server:
+            # Fail on the last study detail call
+            study_2 = server.objects.pop('studies/2')
+            self.extract_source(get_test_source(server), get_test_entities(), config, output_dir)
+            self.assertTrue(os.path.exists(output_dir + '-failed'))
+
+            server.objects['studies/2'] = study_2
+            server.requests.clear()
+            resume_config = dict(config, options={'verbose': False, 'resume': True})
+            self.extract_source(get_test_source(server), get_test_entities(), resume_config, output_dir)
+            requested_paths = [path for (_, path, _) in server.requests]
+
+        self.assertNotIn('studies', requested_paths)
+        self.assertNotIn('studies/0', requested_paths)
+        self.assertIn('studies/2', requested_paths)
+        output = load_output(output_dir)
+        self.assertEqual(['Study 0', 'Study 1', 'Study 2'],
+                         sorted(study['studyName'] for study in output['study.json'].values()))
+        self.assertEqual(['0', '1', '2'], sorted(output['germplasm.json']['G0']['studyDbIds']))
+
+
+
+class TestExtractSourceAsync(TestExtractSource):
+    """
+    Same extractions with the asyncio engine
+    """
+
+    def extract_source(self, source, entities, config, output_dir, scheduler=None):
+        asyncio.run(extract_sources([(source, entities, output_dir)], config))
+
+    def test_extract_source_scheduler(self):
+        output_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        config = dict(self.config, **{'extract-brapi': {'http': {'max-global-concurrency': 4,
+                                                                 'max-host-concurrency': 2}}})
+        with get_test_server() as server1, get_test_server(nb_studies=5) as server2:
+            sources = [(dict(get_test_source(server), **{'schema:identifier': 'TEST' + str(i)}), get_test_entities(),
+                        output_dir)
+                       for (i, (server, output_dir)) in enumerate(zip([server1, server2], output_dirs))]
+            asyncio.run(extract_sources(sources, config))
+
+        output1, output2 = map(load_output, output_dirs)
+        self.assertEqual(['0', '1', '2'], sorted(output1['study.json']))
+        self.assertEqual(['0', '1', '2', '3', '4'], sorted(output2['study.json']))
+        self.assertEqual('Study 4', output2['study.json']['4']['studyName'])
+        self.assertEqual(['0', '1', '2', '3', '4'], sorted(output2['germplasm.json']['G0']['studyDbIds']))
+
+
 if __name__ == '__main__':
     unittest.main()
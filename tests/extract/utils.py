@@ -0,0 +1,228 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeBrapiServer(object):
+    """
+    Local stand-in BrAPI server serving paginated lists and single objects from memory.
+
+    lists: dict of call path (ex: 'studies') to list of BrAPI objects
+    objects: dict of call path (ex: 'studies/1') to BrAPI object
+    etag: send ETag headers and answer conditional requests
+    errors: dict of call path to list of HTTP error status to answer before the actual content
+    delays: dict of call path to list of delays (in seconds) before answering the next requests
+    compress: gzip responses for clients accepting it
+    max_page_size: maximum page size honoured (silently)
+    searches: dict of search call path (ex: 'germplasm-search') to list of BrAPI objects filtered by the '...DbIds'
+              search parameters
+    async_search: answer searches with a searchResultsDbId (BrAPI v2), results being available on the second poll
+    chunked: send responses with chunked transfer encoding (instead of a Content-Length)
+    """
+
+    def __init__(self, lists=None, objects=None, etag=False, errors=None, delays=None, compress=False,
+                 max_page_size=1000, searches=None, async_search=False, chunked=False):
+        self.lists = lists or {}
+        self.objects = objects or {}
+        self.searches = searches or {}
+        self.async_search = async_search
+        self.search_results = dict()
+        self.etag = etag
+        self.errors = errors or {}
+        self.delays = delays or {}
+        self.compress = compress
+        self.max_page_size = max_page_size
+        self.chunked = chunked
+        self.requests = list()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *_):
+                pass
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                params = {k: v[0] for (k, v) in urllib.parse.parse_qs(url.query).items()}
+                server.respond(self, 'GET', url.path, params)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                params = json.loads(body) if body else {}
+                server.respond(self, 'POST', urllib.parse.urlparse(self.path).path, params)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/brapi/v1/'.format(self.httpd.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_content(self, method, path, params):
+        with self.lock:
+            if self.errors.get(path):
+                return self.errors[path].pop(0), {'metadata': {'status': [{'message': 'Server error'}]}}
+        if method == 'POST' and path in self.searches:
+            data = [data for data in self.searches[path]
+                    if all(data.get(name[:-1]) in values for (name, values) in params.items() if name.endswith('DbIds'))]
+            if self.async_search:
+                with self.lock:
+                    search_results_id = str(len(self.search_results))
+                    self.search_results[search_results_id] = {'data': data, 'polls': 0}
+                return 202, {'metadata': {}, 'result': {'searchResultsDbId': search_results_id}}
+            return 200, self.get_page(data, params)
+        search_path, _, search_results_id = path.rpartition('/')
+        if search_path in self.searches and search_results_id in self.search_results:
+            with self.lock:
+                search_results = self.search_results[search_results_id]
+                search_results['polls'] += 1
+            if search_results['polls'] < 2:
+                return 202, {'metadata': {}, 'result': {'searchResultsDbId': search_results_id}}
+            return 200, self.get_page(search_results['data'], params)
+        if path in self.lists:
+            return 200, self.get_page(self.lists[path], params)
+        if path in self.objects:
+            return 200, {'metadata': {}, 'result': self.objects[path]}
+        return 404, {'metadata': {'status': [{'message': 'Not found: ' + path}]}}
+
+    def get_page(self, data, params):
+        page = int(params.get('page', 0))
+        page_size = min(int(params.get('pageSize', self.max_page_size)), self.max_page_size)
+        total_pages = (len(data) + page_size - 1) // page_size
+        pagination = {'currentPage': page, 'pageSize': page_size,
+                      'totalCount': len(data), 'totalPages': total_pages}
+        return {'metadata': {'pagination': pagination}, 'result': {'data': data[page * page_size:(page + 1) * page_size]}}
+
+    def respond(self, handler, method, path, params):
+        path = path.replace('/brapi/v1/', '', 1)
+        with self.lock:
+            self.requests.append((method, path, params))
+            delay = self.delays[path].pop(0) if self.delays.get(path) else 0
+        time.sleep(delay)
+        status, content = self.get_content(method, path, params)
+        body = json.dumps(content).encode()
+        if self.etag and status == 200:
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            if handler.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+            handler.send_response(status)
+            handler.send_header('ETag', etag)
+        else:
+            handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        if self.compress and 'gzip' in handler.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            handler.send_header('Content-Encoding', 'gzip')
+        if status in (429, 503):
+            handler.send_header('Retry-After', '0')
+        if self.chunked and body:
+            handler.send_header('Transfer-Encoding', 'chunked')
+            handler.end_headers()
+            for start in range(0, len(body), 100):
+                chunk = body[start:start + 100]
+                handler.wfile.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+            handler.wfile.write(b'0\r\n\r\n')
+            return
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class FakeFileServer(object):
+    """
+    Local stand-in static file repository serving files from memory with ETag and Range support.
+
+    files: dict of file path (ex: 'study.json') to file content (bytes)
+    cuts: dict of file path to number of bytes sent before closing the connection (once)
+    """
+
+    def __init__(self, files=None, cuts=None):
+        self.files = files or {}
+        self.cuts = cuts or {}
+        self.requests = list()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *_):
+                pass
+
+            def do_GET(self):
+                server.respond(self, urllib.parse.urlparse(self.path).path.lstrip('/'))
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/files/'.format(self.httpd.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def respond(self, handler, path):
+        path = path.replace('files/', '', 1)
+        headers = {name: handler.headers.get(name) for name in ('If-None-Match', 'Range', 'If-Range')
+                   if handler.headers.get(name)}
+        with self.lock:
+            self.requests.append((path, headers))
+            cut = self.cuts.pop(path, None)
+        if path not in self.files:
+            handler.send_response(404)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+
+        content = self.files[path]
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        if headers.get('If-None-Match') == etag:
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.end_headers()
+            return
+        start = 0
+        if headers.get('Range') and headers.get('If-Range', etag) == etag:
+            start = int(headers['Range'][len('bytes='):].rstrip('-'))
+            if start >= len(content):
+                handler.send_response(416)
+                handler.send_header('Content-Range', 'bytes */{}'.format(len(content)))
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+            handler.send_response(206)
+            handler.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(content) - 1, len(content)))
+        else:
+            handler.send_response(200)
+        handler.send_header('ETag', etag)
+        handler.send_header('Content-Length', str(len(content) - start))
+        handler.end_headers()
+        body = content[start:]
+        if cut is not None:
+            handler.wfile.write(body[:cut])
+            handler.wfile.flush()
+            handler.close_connection = True
+            return
+        handler.wfile.write(body)
@@ -0,0 +1,34 @@
+import os
+import tempfile
+import unittest
+
+from etl.common import json_codec
+from etl.transform.jsonld import transform_to_jsonld
+
+
+def add_type(data):
+    data['@type'] = 'Germplasm'
+    data['studyPUI'] = map(str.upper, data['studyDbIds'])
+
+
+class TestTransformToJSONLD(unittest.TestCase):
+
+    def tearDown(self):
+        json_codec.set_backend()
+
+    def test_transform_to_jsonld(self):
+        for backend in ['json'] + (['orjson'] if json_codec.orjson is not None else []):
+            json_codec.set_backend(backend)
+            with tempfile.TemporaryDirectory() as temp_dir:
+                json_path = os.path.join(temp_dir, 'germplasm-1.json')
+                jsonld_path = os.path.join(temp_dir, 'germplasm-1.jsonld')
+                with open(json_path, 'w', encoding='utf-8') as json_file:
+                    json_file.write('{"germplasmName":"Blé","studyDbIds":["s1"]}\n{"studyDbIds":[]}\n')
+
+                transform_to_jsonld((add_type, json_path, jsonld_path))
+
+                with open(jsonld_path, encoding='utf-8') as jsonld_file:
+                    self.assertEqual(
+                        '[{"germplasmName":"Blé","studyDbIds":["s1"],"@type":"Germplasm","studyPUI":["S1"]},'
+                        '{"studyDbIds":[],"@type":"Germplasm","studyPUI":[]}]\n',
+                        jsonld_file.read())